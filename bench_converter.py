@@ -0,0 +1,666 @@
+"""
+converter.py 的性能基准。
+
+用法:
+    python bench_converter.py lexer [--repeat N]
+    python bench_converter.py builder [--max-size N]
+    python bench_converter.py ast [--pages N]
+    python bench_converter.py lazy [--pages N]
+    python bench_converter.py parallel [--pages N] [--workers N]
+    python bench_converter.py daemon [--requests N]
+    python bench_converter.py chat [--messages N]
+    python bench_converter.py bundle [--pages N]
+    python bench_converter.py suite [--scale F] [--output FILE] [--baseline FILE] [--save-baseline FILE]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from converter import ChatExtractor, OEOSConverter, ScriptBundle, _dumps_json
+
+
+class LegacyRegexConverter(OEOSConverter):
+    """旧版逐行正则解析实现（仅用于对比基准）。"""
+
+    def _parse_v4_line(self, line: str) -> (dict, dict):
+        parts = line.split(' ', 1)
+        cmd_name = parts[0]
+        args_str = parts[1] if len(parts) > 1 else ''
+        params, block_info = {}, {}
+        if line.startswith('"'):
+            return self._parse_v4_option(line)
+        if cmd_name in ['commands', 'timerCommands']:
+            return {cmd_name: {}}, {'sub_block': True}
+        param_key = self.V4_SHORTCUT_COMMANDS.get(cmd_name)
+        is_named_param_syntax = param_key and args_str.lstrip().startswith(param_key + ':')
+        if cmd_name in self.V4_SHORTCUT_COMMANDS and not is_named_param_syntax:
+            match = re.match(r'(".*?"|\S+)\s*(.*)', args_str)
+            if match:
+                value, remaining_args = match.groups()
+                params[param_key] = self._parse_value_v1(value)
+                args_str = remaining_args
+        named_args = re.findall(r'(\w+):\s*(".*?"|true|false|-?\d+\.?\d*|\$\S+)', args_str)
+        for key, value in named_args:
+            params[key] = self._parse_value_v1(value)
+        if cmd_name == 'if' or (cmd_name == 'else' and 'if' in args_str):
+            params = {'condition': args_str.replace('if', '').strip(), 'commands': []}
+            block_info['new_block'] = True
+            if cmd_name == 'else': block_info['is_else'] = True
+            cmd_name = 'if'
+        elif cmd_name == 'else':
+            params = {'commands': []}
+            block_info['new_block'] = True
+            block_info['is_else'] = True
+            cmd_name = 'if'
+        elif cmd_name == 'choice':
+            params['options'] = []
+            block_info['new_options_block'] = True
+        elif cmd_name == 'notification.create':
+            block_info['new_notif_block'] = True
+        elif cmd_name == 'timer':
+            params['commands'] = []
+            block_info['new_block'] = True
+        elif cmd_name == 'eval' and 'code' not in params:
+            params['action'] = ""
+            block_info['is_multiline_eval'] = True
+        elif cmd_name == 'eval' and 'code' in params:
+            params['action'] = params.pop('code')
+        return {cmd_name: params}, block_info
+
+    def _parse_v4_option(self, line: str) -> (dict, dict):
+        commands, block_info = [], {}
+        if '->' in line:
+            parts = line.split('->', 1)
+            line = parts[0].strip()
+            cmd_parts = parts[1].strip().split(' ', 1)
+            if cmd_parts[0] == 'end': commands.append({'end': {}})
+            elif cmd_parts[0] == 'goto': commands.append({'goto': {'target': self._parse_value_v1(cmd_parts[1])}})
+            else: raise ValueError(f"-> 快捷方式只支持 'end' 和 'goto', 但得到 '{cmd_parts[0]}'")
+        else:
+            block_info['new_block'] = True
+        match = re.match(r'(".*?")\s*(.*)', line)
+        if not match: raise ValueError(f"无法解析 option 行: {line}")
+        label_str, args_str = match.groups()
+        option = {'label': self._parse_value_v1(label_str), 'commands': commands}
+        named_args = re.findall(r'(when|color|keep):\s*(".*?"|true|false|-?\d+\.?\d*|\$\S+)', args_str)
+        for key, value in named_args:
+            if key == 'when': option['visible'] = value
+            else: option[key] = self._parse_value_v1(value)
+        return option, block_info
+
+    def _parse_value_v1(self, value_str: str):
+        value_str = value_str.strip()
+        if value_str.startswith('"') and value_str.endswith('"'): return json.loads(value_str)
+        if value_str == 'true': return True
+        if value_str == 'false': return False
+        if value_str.startswith('$'): return value_str
+        try: return int(value_str)
+        except ValueError:
+            try: return float(value_str)
+            except ValueError: return value_str
+
+
+# 典型的页面命令行，覆盖快捷语法、命名参数、表达式和选项
+LEXER_SAMPLE_LINES = [
+    'say "你走到了一个十字路口。"',
+    'say "你好, <eval>storage.get(\'playerName\')</eval>！" mode: "instant" skip: true',
+    'image "media/bg1.jpg"',
+    'goto forest_path',
+    'storage.set key: "gold" value: 50',
+    'storage.set key: "hp" value: $storage.get(\'hp\') - 10',
+    'audio.play "media/bgm.mp3" id: "bgm" loops: 0 background: true volume: 0.5',
+    'timer duration: "30s" id: "bomb" style: "bar"',
+    'notification.create id: "quest" label: "新任务：找到钥匙" button: "接受" duration: "10s"',
+    'eval code: "storage.set(\'quest_accepted\', true)"',
+    'if $storage.get(\'gold\') >= 100',
+    'else if $storage.get(\'gold\') >= 50',
+    '"向左走"',
+    '"向右走" when: $storage.get(\'hasMap\') color: "blue"',
+    '"原地等待" -> goto waiting_event',
+    '"查看状态" keep: true',
+]
+
+
+def _time_per_line(converter: OEOSConverter, lines: list, repeat: int) -> float:
+    parse = converter._parse_v4_line
+    def run():
+        for line in lines:
+            parse(line)
+    best = min(timeit.repeat(run, number=repeat, repeat=5))
+    return best / (repeat * len(lines))
+
+
+def bench_lexer(args):
+    legacy = _time_per_line(LegacyRegexConverter(), LEXER_SAMPLE_LINES, args.repeat)
+    current = _time_per_line(OEOSConverter(), LEXER_SAMPLE_LINES, args.repeat)
+    print(f"逐行解析 ({len(LEXER_SAMPLE_LINES)} 种典型行, 每轮 {args.repeat} 次):")
+    print(f"  旧版正则:   {legacy * 1e6:8.2f} µs/行")
+    print(f"  单遍词法器: {current * 1e6:8.2f} µs/行")
+    print(f"  加速比:     {legacy / current:8.2f}x")
+    # 各类行的差别很大：if/else if 和简单快捷参数行明显更快，带 $ 表达式和多个命名参数的行与旧版相当或更慢
+    print("逐行明细 (旧版 / 词法器 µs, 加速比):")
+    for line in LEXER_SAMPLE_LINES:
+        legacy = _time_per_line(LegacyRegexConverter(), [line], args.repeat)
+        current = _time_per_line(OEOSConverter(), [line], args.repeat)
+        print(f"  {legacy * 1e6:6.2f} / {current * 1e6:6.2f}  {legacy / current:5.2f}x  {line}")
+
+
+def _else_if_ladder(size: int) -> list:
+    lines = ["> start", "  if $n == 0", "    say \"0\""]
+    for i in range(1, size):
+        lines.append(f"  else if $n == {i}")
+        lines.append(f"    say \"{i}\"")
+    lines += ["  else", "    say \"other\""]
+    return lines
+
+
+def _deep_nesting(depth: int) -> list:
+    lines = ["> start"]
+    for i in range(depth):
+        lines.append("  " * (i + 1) + f"if $n > {i}")
+    lines.append("  " * (depth + 1) + "eval code: \"done()\"")
+    lines.append("  " * (depth + 1) + "timer duration: 1")
+    return lines
+
+
+def bench_builder(args):
+    converter = OEOSConverter()
+    for title, generate in (("else if 链长度", _else_if_ladder), ("嵌套深度", _deep_nesting)):
+        print(f"{title}:")
+        size = args.max_size // 16
+        while size <= args.max_size:
+            lines = generate(size)
+            start = time.perf_counter()
+            converter.to_v1_main_loop(lines, {"pages": {}})
+            elapsed = time.perf_counter() - start
+            chars = sum(len(line) + 1 for line in lines)
+            # 深层嵌套时每行的缩进随深度增长，输入总量是深度的平方，因此同时给出按字符计的开销
+            print(f"  {size:7d}: {elapsed * 1e3:9.2f} ms  {elapsed / len(lines) * 1e6:7.2f} µs/行  {elapsed / chars * 1e9:7.2f} ns/字符")
+            size *= 2
+        # 命令行 to_v1 的其余环节（JSON 输出、diff）在最大规模下也必须跑得通，不能撞上递归上限。
+        # 带缩进的输出总量随深度平方增长，这里用紧凑格式，走的是同一条显式栈路径；改动放在链首/最深处，diff 要逐层比较
+        text = "\n".join(generate(args.max_size))
+        v1_data, other = converter.to_v1(text), converter.to_v1(text.replace('"0"', '"zero"').replace("done()", "other()"))
+        start = time.perf_counter()
+        output = _dumps_json(v1_data, separators=(',', ':'))
+        serialized = time.perf_counter() - start
+        start = time.perf_counter()
+        converter.diff(v1_data, other)
+        diffed = time.perf_counter() - start
+        print(f"  JSON 输出: {serialized * 1e3:9.2f} ms ({len(output)} 字符)  diff: {diffed * 1e3:9.2f} ms")
+
+
+# 一个典型页面，{i} 会被替换为页号，使各页内容互不相同
+SAMPLE_PAGE = """> page{i}
+  say "第 {i} 页：你走到了一个十字路口。" mode: "instant"
+  image "media/bg{i}.jpg"
+  storage.set key: "visited_{i}" value: true
+  if $storage.get('gold') >= {i}
+    say "你买得起第 {i} 件商品。"
+  else
+    say "金币不够。"
+  choice
+    "向左走"
+      say "你选择了左边的路。"
+      goto page{left}
+    "向右走" when: $storage.get('hasMap') color: "blue" -> goto page{right}
+  timer duration: "5s" id: "t{i}"
+    goto page{left}
+"""
+
+
+def generate_pages(count: int) -> str:
+    return "\n".join(SAMPLE_PAGE.format(i=i, left=(i + 1) % count, right=(i * 7) % count) for i in range(count))
+
+
+def _traced_size(build):
+    tracemalloc.start()
+    try:
+        result = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def bench_ast(args):
+    script = generate_pages(args.pages)
+    lines = script.split("\n")
+    converter = OEOSConverter()
+    v1_data, dict_size = _traced_size(lambda: converter.to_v1_main_loop(lines, {"pages": {}}))
+    document, node_size = _traced_size(lambda: converter.to_v1_nodes(lines))
+    assert document.to_dict() == v1_data
+    assert converter.to_v4(document) == converter.to_v4(v1_data)
+    scale = 10000 / args.pages
+    print(f"命令树常驻内存 ({args.pages} 页，换算为每 1 万页):")
+    print(f"  v1 字典:   {dict_size * scale / 2**20:8.2f} MiB")
+    print(f"  紧凑节点: {node_size * scale / 2**20:8.2f} MiB")
+    print(f"  节省:     {(1 - node_size / dict_size) * 100:8.1f} %")
+
+
+def _open_and_get(converter: OEOSConverter, path: str, page_id: str):
+    script = converter.open_lazy(path)
+    script[page_id]
+    return script
+
+
+def _parse_file(converter: OEOSConverter, path: str):
+    with open(path, encoding='utf-8') as fp:
+        return converter.to_v1_main_loop(fp, {"pages": {}})
+
+
+def bench_lazy(args):
+    with tempfile.NamedTemporaryFile('w', suffix='.oeos', encoding='utf-8', delete=False) as f:
+        f.write(generate_pages(args.pages))
+    converter = OEOSConverter()
+    page_id = f"page{args.pages // 2}"
+    try:
+        print(f"打开 {os.path.getsize(f.name) / 2**20:.1f} MiB 脚本 ({args.pages} 页) 并取出 {page_id}:")
+        for title, build in (("完整解析", lambda: _parse_file(converter, f.name)),
+                             ("懒加载  ", lambda: _open_and_get(converter, f.name, page_id))):
+            gc.collect()
+            start = time.perf_counter()
+            build()
+            elapsed = time.perf_counter() - start
+            result, size = _traced_size(build)
+            if hasattr(result, 'close'): result.close()
+            del result  # 不让上一轮的大结果留在堆上干扰下一轮的 GC
+            print(f"  {title}: {elapsed * 1e3:9.2f} ms  {size / 2**20:8.2f} MiB")
+    finally:
+        os.unlink(f.name)
+
+
+def bench_parallel(args):
+    script = generate_pages(args.pages)
+    converter = OEOSConverter()
+    workers = args.workers or os.cpu_count()
+    v1_data = converter.to_v1(script)
+    print(f"{len(script) / 2**20:.1f} MiB 脚本 ({args.pages} 页)，{workers} 个进程 (本机 {os.cpu_count()} 核):")
+    for title, serial, parallel in (
+            ("to_v1", lambda: converter.to_v1(script), lambda: converter.to_v1_parallel(script, workers)),
+            ("to_v4", lambda: converter.to_v4(v1_data), lambda: converter.to_v4_parallel(v1_data, workers))):
+        timings = []
+        for run in (serial, parallel):
+            gc.collect()
+            start = time.perf_counter()
+            result = run()
+            timings.append(time.perf_counter() - start)
+        assert result == serial()
+        print(f"  {title}: 串行 {timings[0] * 1e3:9.2f} ms  并行 {timings[1] * 1e3:9.2f} ms  加速比 {timings[0] / timings[1]:5.2f}x")
+
+
+def bench_daemon(args):
+    converter_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "converter.py")
+    page = SAMPLE_PAGE.format(i=1, left=2, right=3)
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "page.oeos")
+        with open(input_path, "w", encoding="utf-8") as f: f.write(page)
+        spawn = []
+        for _ in range(5):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, converter_path, "to_v1", input_path, os.path.join(tmp, "page.json")],
+                           check=True, stdout=subprocess.DEVNULL)
+            spawn.append(time.perf_counter() - start)
+    server = subprocess.Popen([sys.executable, converter_path, "serve"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              text=True, encoding="utf-8")
+    try:
+        round_trips, server_times = [], []
+        for i in range(args.requests):
+            request = json.dumps({"id": i, "method": "to_v1", "params": {"script": page}}, ensure_ascii=False)
+            start = time.perf_counter()
+            server.stdin.write(request + "\n")
+            server.stdin.flush()
+            response = json.loads(server.stdout.readline())
+            round_trips.append(time.perf_counter() - start)
+            assert "result" in response, response
+            server_times.append(response["time_ms"])
+    finally:
+        server.stdin.close()
+        server.wait()
+    print("单页 to_v1 延迟:")
+    print(f"  每次启动进程:     {statistics.median(spawn) * 1e3:8.2f} ms (中位数)")
+    print(f"  常驻服务往返:     {statistics.median(round_trips) * 1e3:8.3f} ms (中位数, {args.requests} 次)")
+    print(f"  其中服务端处理:   {statistics.median(server_times):8.3f} ms")
+
+
+def _write_chat_log(path: str, messages: int, pages: int):
+    # 每 5 条消息中有一条带 <game><Pages> 和 <summary>，页面反复被改写
+    rng = random.Random(0)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"user_name": "User", "character_name": "OEOS", "chat_metadata": {}}) + "\n")
+        for i in range(messages):
+            if i % 5:
+                message = {"name": "User", "is_user": True, "mes": "继续 " * rng.randrange(5, 60)}
+            else:
+                page = rng.randrange(pages)
+                body = SAMPLE_PAGE.format(i=page, left=(page + 1) % pages, right=(page * 7) % pages).strip()
+                message = {"name": "OEOS", "is_user": False,
+                           "mes": f"<think>...</think>\n<game>\n<Pages>\n{body}\n</Pages>\n</game>\n"
+                                  f"<summary>\npage{page}: 第 {i} 条消息的版本;\n</summary>"}
+            f.write(json.dumps(message, ensure_ascii=False) + "\n")
+
+
+def _extract_all_at_once(path: str) -> ChatExtractor:
+    # 对照组：像插件那样先把整段聊天记录读成消息数组再逐条匹配
+    with open(path, encoding="utf-8") as f:
+        chat = [json.loads(line) for line in f]
+    extractor = ChatExtractor()
+    for message in chat:
+        if isinstance(message.get("mes"), str): extractor.feed_message(message["mes"])
+    return extractor
+
+
+def bench_chat(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"从聊天记录中提取页面 ({args.pages} 个不同页面):")
+        for messages in (args.messages, args.messages * 4):
+            path = os.path.join(tmp, f"chat{messages}.jsonl")
+            _write_chat_log(path, messages, args.pages)
+            size = os.path.getsize(path) / 2**20
+            for title, run in (("整体读入", lambda: _extract_all_at_once(path)),
+                               ("流式    ", lambda: ChatExtractor().feed_file(path))):
+                gc.collect()
+                elapsed = _best_time(run, 3)
+                peak = _peak_memory(run)
+                print(f"  {messages:7d} 条 ({size:6.1f} MiB) {title}: {elapsed * 1e3:9.2f} ms "
+                      f"{size / elapsed:7.1f} MiB/s  峰值 {peak / 2**20:7.2f} MiB")
+            assert _extract_all_at_once(path).script() == ChatExtractor().feed_file(path).script()
+
+
+def bench_bundle(args):
+    converter = OEOSConverter()
+    v1_data = TeaseGenerator(seed=0, pages=args.pages).v1()
+    page_id = list(v1_data["pages"])[args.pages // 2]
+    with tempfile.TemporaryDirectory() as tmp:
+        formats = {}
+        for name, data in (("JSON (indent=2)", json.dumps(v1_data, indent=2, ensure_ascii=False).encode("utf-8")),
+                           ("JSON (紧凑)     ", json.dumps(v1_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")),
+                           ("脚本包          ", converter.to_bundle(v1_data))):
+            path = os.path.join(tmp, f"{len(formats)}.bin")
+            with open(path, "wb") as f: f.write(data)
+            formats[name] = path
+        converter.verify_bundle(ScriptBundle(path), v1_data)
+
+        def load_json(path):
+            with open(path, "rb") as f: return json.loads(f.read())
+
+        def load_bundle(path):
+            with ScriptBundle(path) as bundle: return bundle.to_dict()
+
+        def load_page(path):
+            with ScriptBundle(path) as bundle: return bundle[page_id]
+
+        print(f"{args.pages} 页脚本的加载耗时 (取 {page_id} 为单页):")
+        for name, path in formats.items():
+            full = _best_time(lambda: (load_bundle if path.endswith("2.bin") else load_json)(path), 5)
+            line = f"  {name}: {os.path.getsize(path) / 2**10:9.1f} KiB  完整加载 {full * 1e3:8.2f} ms"
+            if path.endswith("2.bin"):
+                line += f"  单页 {_best_time(lambda: load_page(path), 5) * 1e3:8.3f} ms"
+            print(line)
+
+
+# ---- 基准套件：可复现的合成脚本与回归门限 ----
+
+# 需要转义的字符（引号、反斜杠、换行、制表符）以及多字节字符
+_ESCAPE_PIECES = ['\\"引号\\"', '反斜杠 \\\\ ', '换行\\n', '制表\\t', '<eval>storage.get("x")</eval>', '😀', "'单引号'"]
+_WORDS = ["你", "走到", "了", "一个", "路口", "森林", "城市", "钥匙", "金币", "地图", "the", "door", "opens", "slowly"]
+
+
+class TeaseGenerator:
+    """
+    按种子生成结构可控的 OEOScript 脚本，同一组参数总是得到相同的文本。
+
+    pages: 页面数；depth: 每页嵌套 if 的深度；ladder: else if 链长度；options: 每个 choice 的选项数；
+    eval_lines: 多行 eval 的行数；escaping: 字符串中掺入需要转义的字符的比例 (0~1)。
+    """
+
+    def __init__(self, seed: int = 0, pages: int = 100, depth: int = 2, ladder: int = 3, options: int = 3,
+                 eval_lines: int = 3, escaping: float = 0.2):
+        self.seed = seed
+        self.params = {'pages': pages, 'depth': depth, 'ladder': ladder, 'options': options,
+                       'eval_lines': eval_lines, 'escaping': escaping}
+
+    def script(self) -> str:
+        rng = random.Random(self.seed)
+        p = self.params
+        page_ids = ['start'] + [f"page_{i}" for i in range(1, p['pages'])]
+        lines = ["---", "init: |", "  var visits = 0;", "  storage.set('gold', 0);", "---"]
+        for page_id in page_ids:
+            lines.append(f"> {page_id}")
+            self._page(rng, lines, page_ids)
+        return "\n".join(lines) + "\n"
+
+    def v1(self) -> dict:
+        return OEOSConverter().to_v1(self.script())
+
+    def _text(self, rng) -> str:
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(2, 8))]
+        if rng.random() < self.params['escaping']:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(_ESCAPE_PIECES))
+        return '"' + " ".join(words) + '"'
+
+    def _page(self, rng, lines: list, page_ids: list):
+        p = self.params
+        target = lambda: rng.choice(page_ids)
+        lines.append(f"  say {self._text(rng)} mode: \"instant\"")
+        lines.append(f"  image \"media/img_{rng.randrange(1000)}.jpg\"")
+        lines.append(f"  storage.set key: \"k{rng.randrange(100)}\" value: {rng.randint(-50, 500)}")
+        for level in range(p['depth']):
+            indent = "  " * (level + 1)
+            lines.append(f"{indent}if $storage.get('k{level}') > {rng.randrange(100)}")
+            lines.append(f"{indent}  say {self._text(rng)}")
+        if p['ladder']:
+            indent = "  " * (p['depth'] + 1)
+            lines.append(f"{indent}if $storage.get('gold') >= {p['ladder'] * 10}")
+            lines.append(f"{indent}  say {self._text(rng)}")
+            for i in range(p['ladder'] - 1, 0, -1):
+                lines.append(f"{indent}else if $storage.get('gold') >= {i * 10}")
+                lines.append(f"{indent}  say {self._text(rng)}")
+            lines.append(f"{indent}else")
+            lines.append(f"{indent}  goto {target()}")
+        if p['eval_lines']:
+            lines.append("  eval")
+            for i in range(p['eval_lines']):
+                lines.append(f"    var v{i} = storage.get('k{i}') + {rng.randrange(10)};")
+        if rng.random() < 0.3:
+            lines.append(f"  timer duration: \"{rng.randint(1, 60)}s\" id: \"t{rng.randrange(10)}\"")
+            lines.append(f"    goto {target()}")
+        if rng.random() < 0.2:
+            lines.append(f"  notification.create id: \"n{rng.randrange(10)}\" label: {self._text(rng)} button: \"ok\"")
+            lines.append("    commands")
+            lines.append(f"      say {self._text(rng)}")
+            lines.append("    timerCommands")
+            lines.append(f"      goto {target()}")
+        if p['options']:
+            lines.append("  choice")
+            for _ in range(p['options']):
+                label = self._text(rng)
+                roll = rng.random()
+                if roll < 0.4:
+                    lines.append(f"    {label} -> goto {target()}")
+                elif roll < 0.5:
+                    lines.append(f"    {label} -> end")
+                else:
+                    extra = f" when: $storage.get('k{rng.randrange(10)}') > 1 color: \"blue\"" if roll < 0.7 else ""
+                    lines.append(f"    {label}{extra}")
+                    lines.append(f"      say {self._text(rng)}")
+                    lines.append(f"      goto {target()}")
+        else:
+            lines.append(f"  goto {target()}")
+
+
+SUITE_SCENARIOS = {
+    'typical':  dict(pages=1000, depth=2, ladder=3, options=4, eval_lines=4, escaping=0.2),
+    'ladder':   dict(pages=20, depth=0, ladder=500, options=0, eval_lines=0, escaping=0.0),
+    'deep':     dict(pages=20, depth=100, ladder=0, options=0, eval_lines=0, escaping=0.0),
+    'options':  dict(pages=100, depth=0, ladder=0, options=150, eval_lines=0, escaping=0.1),
+    'eval':     dict(pages=50, depth=0, ladder=0, options=1, eval_lines=1000, escaping=0.0),
+    'escaping': dict(pages=1000, depth=1, ladder=1, options=3, eval_lines=0, escaping=1.0),
+}
+# 这些参数按 scale 放大；其余参数保持不变，以便单独观察某个维度的伸缩性
+_SUITE_SCALED = {'typical': 'pages', 'ladder': 'ladder', 'deep': 'depth', 'options': 'options', 'eval': 'eval_lines',
+                 'escaping': 'pages'}
+
+
+def _best_time(run, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _peak_memory(run) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_scenario(params: dict, seed: int, repeat: int) -> dict:
+    converter = OEOSConverter()
+    script = TeaseGenerator(seed, **params).script()
+    lines = script.split("\n")
+    v1_data = converter.to_v1(script)
+    # 比较文本而不是嵌套的字典：长 else if 链在 v1 中是很深的嵌套，直接比较会超出递归深度
+    v4_text = converter.to_v4(v1_data)
+    if converter.to_v4(converter.to_v1(v4_text)) != v4_text:
+        raise AssertionError(f"往返转换结果不一致: {params}")
+    size = len(script.encode("utf-8"))
+    operations = {
+        'to_v1_main_loop': lambda: converter.to_v1_main_loop(lines, {"pages": {}}),
+        'to_v1': lambda: converter.to_v1(script),
+        'to_v4': lambda: converter.to_v4(v1_data),
+        'round_trip': lambda: converter.to_v1(converter.to_v4(v1_data)),
+    }
+    result = {'params': params, 'bytes': size, 'lines': len(lines), 'ops': {}}
+    for name, run in operations.items():
+        seconds = _best_time(run, repeat)
+        result['ops'][name] = {'seconds': seconds, 'mib_per_s': size / 2**20 / seconds,
+                               'peak_mib': _peak_memory(run) / 2**20}
+    return result
+
+
+def check_regressions(results: dict, baseline: dict, threshold: float) -> list:
+    """返回吞吐量比基线低超过 threshold（比例）的 (场景, 操作, 当前, 基线) 列表。"""
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None or base['params'] != scenario['params']: continue
+        for op, stats in scenario['ops'].items():
+            base_stats = base['ops'].get(op)
+            if base_stats and stats['mib_per_s'] < base_stats['mib_per_s'] * (1 - threshold):
+                regressions.append((name, op, stats['mib_per_s'], base_stats['mib_per_s']))
+    return regressions
+
+
+def check_scaling(results: dict, limit: float) -> list:
+    """每个场景在 1 倍和 4 倍规模下的单字节耗时之比应接近 1；超过 limit 说明出现了超线性（如平方级）行为。"""
+    problems = []
+    for name, scenario in results['scenarios'].items():
+        larger = results['scaling'].get(name)
+        if larger is None: continue
+        for op in ('to_v1', 'to_v4'):
+            per_byte = scenario['ops'][op]['seconds'] / scenario['bytes']
+            ratio = larger['ops'][op]['seconds'] / larger['bytes'] / per_byte
+            if ratio > limit: problems.append((name, op, ratio))
+    return problems
+
+
+def bench_suite(args):
+    results = {'python': platform.python_version(), 'seed': args.seed, 'scale': args.scale,
+               'scenarios': {}, 'scaling': {}}
+    selected = args.scenario or list(SUITE_SCENARIOS)
+    for name in selected:
+        params = dict(SUITE_SCENARIOS[name])
+        key = _SUITE_SCALED[name]
+        params[key] = max(1, int(params[key] * args.scale))
+        scenario = run_scenario(params, args.seed, args.repeat)
+        results['scenarios'][name] = scenario
+        ops = "  ".join(f"{op} {stats['mib_per_s']:6.2f} MiB/s" for op, stats in scenario['ops'].items())
+        peak = max(stats['peak_mib'] for stats in scenario['ops'].values())
+        print(f"{name:9s} {scenario['bytes'] / 2**20:6.2f} MiB  {ops}  峰值 {peak:.1f} MiB")
+        if not args.no_scaling:
+            params[key] *= 4
+            results['scaling'][name] = run_scenario(params, args.seed, 1)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"结果已写入 '{args.output}'")
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f: json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"基线已写入 '{args.save_baseline}'")
+    failed = False
+    for name, op, ratio in ([] if args.no_scaling else check_scaling(results, args.max_scaling)):
+        print(f"超线性: {name}/{op} 规模扩大 4 倍后单字节耗时变为 {ratio:.2f} 倍", file=sys.stderr)
+        failed = True
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+        for name, op, current, base in check_regressions(results, baseline, args.threshold):
+            print(f"性能回退: {name}/{op} {current:.2f} MiB/s，基线 {base:.2f} MiB/s ({current / base - 1:+.0%})", file=sys.stderr)
+            failed = True
+    if failed: sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="converter.py 性能基准。")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    lexer = sub.add_parser("lexer", help="对比旧版正则与单遍词法器的逐行解析开销。")
+    lexer.add_argument("--repeat", type=int, default=2000, help="每轮重复次数。")
+    lexer.set_defaults(func=bench_lexer)
+    builder = sub.add_parser("builder", help="用 else if 长链和深层嵌套验证树构建是线性的。")
+    builder.add_argument("--max-size", type=int, default=16000, help="最大链长/嵌套深度。")
+    builder.set_defaults(func=bench_builder)
+    ast = sub.add_parser("ast", help="对比 v1 字典与紧凑节点表示的内存占用。")
+    ast.add_argument("--pages", type=int, default=10000, help="生成的页面数。")
+    ast.set_defaults(func=bench_ast)
+    lazy = sub.add_parser("lazy", help="对比完整解析与懒加载单个页面的耗时和内存。")
+    lazy.add_argument("--pages", type=int, default=20000, help="生成的页面数。")
+    lazy.set_defaults(func=bench_lazy)
+    parallel = sub.add_parser("parallel", help="对比串行与按页面分片的多进程转换。")
+    parallel.add_argument("--pages", type=int, default=20000, help="生成的页面数。")
+    parallel.add_argument("--workers", type=int, default=0, help="进程数，0 表示 CPU 核数。")
+    parallel.set_defaults(func=bench_parallel)
+    daemon = sub.add_parser("daemon", help="对比每次启动进程与常驻服务的单页转换延迟。")
+    daemon.add_argument("--requests", type=int, default=2000, help="发给常驻服务的请求数。")
+    daemon.set_defaults(func=bench_daemon)
+    chat = sub.add_parser("chat", help="对比整体读入与流式提取聊天记录中页面的耗时和峰值内存。")
+    chat.add_argument("--messages", type=int, default=50000, help="聊天消息条数（另测 4 倍规模）。")
+    chat.add_argument("--pages", type=int, default=500, help="不同页面的数量。")
+    chat.set_defaults(func=bench_chat)
+    bundle = sub.add_parser("bundle", help="对比 JSON 与二进制脚本包的大小、完整加载和单页加载耗时。")
+    bundle.add_argument("--pages", type=int, default=5000, help="生成的页面数。")
+    bundle.set_defaults(func=bench_bundle)
+    suite = sub.add_parser("suite", help="用可复现的合成脚本跑完整基准，可与基线比较并在回退时失败。")
+    suite.add_argument("--scenario", action="append", choices=list(SUITE_SCENARIOS), help="只运行指定场景（可重复）。")
+    suite.add_argument("--scale", type=float, default=1.0, help="各场景主维度的放大倍数。")
+    suite.add_argument("--seed", type=int, default=0, help="生成器种子。")
+    suite.add_argument("--repeat", type=int, default=3, help="每项计时取最好的一次。")
+    suite.add_argument("--output", help="把结果以 JSON 写入该文件。")
+    suite.add_argument("--save-baseline", help="把本次结果另存为基线。")
+    suite.add_argument("--baseline", help="与该基线比较吞吐量。")
+    suite.add_argument("--threshold", type=float, default=0.25, help="吞吐量低于基线超过该比例时失败。")
+    suite.add_argument("--no-scaling", action="store_true", help="跳过 4 倍规模的线性度检查。")
+    suite.add_argument("--max-scaling", type=float, default=2.0, help="4 倍规模下单字节耗时允许的最大增幅。")
+    suite.set_defaults(func=bench_suite)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,40 @@
 import json
 import re
 import argparse
+import contextlib
+import hashlib
+import marshal
+import os
+import stat
+import struct
 import sys
-from collections import deque
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+# 只有部分子命令用到的模块（cProfile、difflib、glob、mmap、shutil、signal、socketserver、tempfile、concurrent.futures）
+# 在用到的函数内导入，一次性的 to_v1/to_v4 命令行调用不必为它们付出启动开销
+
+class OEOSParseError(ValueError):
+    """
+    OEOScript 解析错误，带有出错位置：line/column 从 1 开始，page 为出错行所在的页面（页面之外为 None）。
+
+    恢复模式下这些错误不会抛出，而是收集到调用方提供的 diagnostics 列表中。
+    """
+
+    def __init__(self, message: str, line: int = None, column: int = None, page: str = None):
+        super().__init__(message)
+        self.message = message
+        self.line = line
+        self.column = column
+        self.page = page
+
+    def __reduce__(self):
+        return type(self), (self.message, self.line, self.column, self.page)
+
+    def to_dict(self) -> dict:
+        return {'page': self.page, 'line': self.line, 'column': self.column, 'message': self.message}
+
 
 class OEOSConverter:
     """
@@ -14,28 +46,233 @@ class OEOSConverter:
         'notification.remove': 'id'
     }
 
-    def to_v4(self, v1_data: dict) -> str:
-        """将 v1 JSON 数据转换为 v4 OEOScript 字符串。"""
+    # OEOScript 词法：预编译的主正则，一次匹配一个词法单元（`key: value` 作为一次匹配）
+    _V4_VALUE_PATTERN = r'''
+          (?P<{p}string>"[^"\\]*(?:\\.[^"\\]*)*")
+        | (?P<{p}int>-?\d+)(?=\s|$)
+        | (?P<{p}float>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)(?=\s|$)
+        | (?P<{p}literal>true|false|null)(?=\s|$)
+        | (?P<{p}expr>\${expr_body})(?=\s+(?:[A-Za-z_]\w*:(?!/)|->(?:\s|$))|\s*$)
+        | (?P<{p}exprstart>\$)
+        | (?P<{p}word>[^\s"]+)
+        | (?P<{p}unterminated>")
+    '''
+    # $ 表达式的快速路径：引号和一层括号内可以出现空白与 `key:`，更深的嵌套交给 _scan_v4_expr
+    _V4_QUOTED = r'"[^"\\]*(?:\\.[^"\\]*)*"' + '|' + r"'[^'\\]*(?:\\.[^'\\]*)*'"
+    # 写成 "普通字符串 (特殊单元 普通字符串)*" 的展开形式：特殊单元的首字符不在普通字符集中，匹配失败时回溯是线性的
+    _V4_EXPR_BODY = (r'''[^\s"'`()\[\]{}]*(?:(?:''' + _V4_QUOTED
+                     + r'''|\([^"'`()\[\]{}]*(?:(?:''' + _V4_QUOTED + r''')[^"'`()\[\]{}]*)*\)'''
+                     + r'''|\[[^"'`()\[\]{}]*(?:(?:''' + _V4_QUOTED + r''')[^"'`()\[\]{}]*)*\]'''
+                     + r'''|\{[^"'`()\[\]{}]*(?:(?:''' + _V4_QUOTED + r''')[^"'`()\[\]{}]*)*\}'''
+                     + r'''|\s+(?!\s|[A-Za-z_]\w*:(?!/)|->(?:\s|$)))[^\s"'`()\[\]{}]*)*''')
+    _V4_TOKEN_RE = re.compile(r'''\s*(?:
+          (?P<eol>$)
+        | (?P<key>[A-Za-z_]\w*):(?!/)\s*(?:''' + _V4_VALUE_PATTERN.format(p='kv_', expr_body=_V4_EXPR_BODY) + r''')?
+        | (?P<arrow>->)(?=\s|$)
+        | ''' + _V4_VALUE_PATTERN.format(p='', expr_body=_V4_EXPR_BODY) + r'''
+    )''', re.VERBOSE)
+    _V4_EXPR_STOP_RE = re.compile(r'''["'`()\[\]{}]|\s+(?=[A-Za-z_]\w*:(?!/)|->(?:\s|$))''')
+    _V4_QUOTE_END_RE = {q: re.compile(rf'[^{q}\\]*(?:\\.[^{q}\\]*)*{q}') for q in '"\'`'}
+    _V4_LITERALS = {'true': True, 'false': False, 'null': None}
+    _CLOSED_IF_CHAIN = object()  # if_tail 哨兵：if 链已经以纯 else 结束
+    _EDGE_COMMANDS = ('goto', 'enable', 'disable')
+    # 通过 url 参数引用资源的命令 -> 资源种类；文本中的 HTML 标签另见 HTML_ASSET_TAGS
+    ASSET_COMMANDS = {'image': 'image', 'audio.play': 'audio'}
+    HTML_ASSET_TAGS = {'img': 'image', 'audio': 'audio', 'video': 'video', 'source': 'media'}
+    _HTML_SRC_RE = re.compile(r'''<(img|audio|video|source)\b[^>]*?\bsrc\s*=\s*(["'])(.*?)\2''', re.I | re.S)
+    # 开头的空行、缩进注释和 `---` 元数据块；并行分片只在它之后切分
+    _V4_META_RE = re.compile(r'(?:[^\S\n]*\n|[^\S\n]+#[^\n]*\n)*[^\S\n]*---[^\S\n]*\n(?:[^\n]*\n)*?[^\S\n]*---[^\S\n]*(?:\n|\Z)')
+    # 以 `---` 开头（元数据块起点）的脚本
+    _V4_META_START_RE = re.compile(r'(?:[^\S\n]*\n|[^\S\n]+#[^\n]*\n)*[^\S\n]*---[^\S\n]*(?:\n|\Z)')
+    # 可以作为分片起点的页面头（与 feed_line 的判断一致）
+    _V4_PAGE_HEADER_RE = re.compile(r'\n(?=[^\S \n]*>|#)')
+    # 与播放器默认值相同的参数（见 oeos-commands.md），精简输出时省略。值为可接受的默认值元组，比较时类型也必须一致
+    V4_PARAM_DEFAULTS = {
+        'say': {'mode': ('auto',), 'duration': (0,), 'skip': (True,), 'align': ('left',)},
+        'audio.play': {'loops': (1,), 'volume': (1, 1.0), 'background': (False,)},
+        'prompt': {'value': ('',)},
+        'notification.create': {'button': ('',)},
+        'timer': {'loops': (1,), 'paused': (False,)},
+    }
+    EVAL_PLACEHOLDER = '…'  # 精简输出省略 eval 代码时的占位内容
+    # 低于这些规模时进程池的启动和序列化开销得不偿失，并行接口直接走串行路径
+    PARALLEL_MIN_CHARS = 1 << 20
+    PARALLEL_MIN_PAGES = 2000
+
+    def __init__(self, page_cache: 'PageCache' = None, stats: 'ConversionStats' = None):
+        # 可选的页面级解析缓存，见 PageCache
+        self.page_cache = page_cache
+        # 可选的统计收集，见 ConversionStats；为 None 时各处只多一次 None 判断
+        self.stats = None
+        if stats is not None: stats.attach(self)
+
+    def to_v4(self, v1_data: dict, workers: int = None) -> str:
+        """
+        将 v1 JSON 数据转换为 v4 OEOScript 字符串。workers 大于 1 时按页面分片并行转换，见 to_v4_parallel。
+        命令树每层嵌套递归一次，嵌套深度受 Python 递归上限限制（默认约 900 层）；else if 链是平铺的，长度不受限制。
+        """
+        if workers is not None and workers > 1:
+            return self.to_v4_parallel(v1_data, workers)
+        lines = self._meta_to_v4(v1_data.get('meta', {}))
+        pages = v1_data.get("pages", {})
+        for page_id, commands in pages.items():
+            lines.extend(self._page_to_v4(page_id, commands))
+        text = "\n".join(lines)
+        if self.stats is not None:
+            for commands in pages.values(): self.stats.count_page(commands)
+            self.stats.count_text(text_out=text)
+        return text
+
+    def to_v4_parallel(self, v1_data: dict, workers: int = None) -> str:
+        """
+        多进程版 to_v4：把页面按原顺序切成若干片，在 ProcessPoolExecutor 中分别转换后按顺序拼接，输出与 to_v4 完全一致。
+        页面数少于 PARALLEL_MIN_PAGES 时直接串行转换。
+        """
+        workers = workers or os.cpu_count() or 1
+        pages = list(v1_data.get("pages", {}).items())
+        if len(pages) < max(self.PARALLEL_MIN_PAGES, 2) or workers <= 1:
+            return self.to_v4(v1_data)
+        step = -(-len(pages) // (workers * 4))
+        with self._shard_executor(workers) as executor:
+            parts = list(executor.map(_to_v4_shard, [pages[i:i + step] for i in range(0, len(pages), step)]))
+        meta_lines = self._meta_to_v4(v1_data.get('meta', {}))
+        if meta_lines: parts.insert(0, "\n".join(meta_lines))
+        text = "\n".join(parts)
+        if self.stats is not None: self.stats.count_text(text_out=text)
+        return text
+
+    def to_v4_compact(self, v1_data: dict, elide_eval: bool = False, prune_from: str = None,
+                      report: dict = None, verify: bool = False) -> str:
+        """
+        生成尽量短的 OEOScript，用于注入 LLM 上下文：省略与默认值相同的参数，能不加引号的值不加引号，页面之间不留空行。
+        elide_eval 为 True 时把 eval 代码替换为 EVAL_PLACEHOLDER；给出 prune_from 时删除从该页面出发不可达的页面
+        （存在 $ 表达式跳转时无法静态判断，不删除）。
+
+        提供 report 字典时写入省略与删除的计数，以及与普通 to_v4 输出相比的字符数（需要额外做一次普通输出）。
+        verify 为 True 时把文本解析回 v1，确认与普通 to_v4 输出解析出的命令树一致，不一致时抛出 ValueError；开销较大，只用于调试。
+        嵌套深度的限制与 to_v4 相同。
+        """
+        counts = {'removed_params': 0, 'elided_evals': 0, 'pruned_pages': []}
+        pages = v1_data.get('pages', {})
+        if prune_from is not None:
+            graph = self.build_graph(v1_data)
+            reachable = graph.distances(prune_from)
+            if any(page_id in graph.dynamic for page_id in reachable):
+                counts['prune_skipped'] = "可达页面中存在 $ 表达式跳转，无法判断可达性"
+            else:
+                counts['pruned_pages'] = [page_id for page_id in pages if page_id not in reachable]
+        pruned = set(counts['pruned_pages'])
+        compact_data = {'pages': {page_id: self._compact_commands(commands, elide_eval, counts)
+                                  for page_id, commands in pages.items() if page_id not in pruned}}
+        if v1_data.get('meta'): compact_data['meta'] = v1_data['meta']
+        with self.stats.phase('emit') if self.stats is not None else contextlib.nullcontext():
+            text = _CompactV4Emitter().to_v4(compact_data)
+        if self.stats is not None:
+            for commands in compact_data['pages'].values(): self.stats.count_page(commands)
+            self.stats.count_text(text_out=text)
+        # 校验和基线输出用不挂统计、不带缓存的转换器，不计入本次转换
+        plain = OEOSConverter()
+        if verify and plain.to_v1(text) != plain.to_v1(plain.to_v4(compact_data)):
+            raise ValueError("精简输出解析回 v1 后与原命令树不一致")
+        if report is not None:
+            report.update(counts)
+            report['chars'] = len(text)
+            report['baseline_chars'] = len(plain.to_v4(v1_data))
+            report['reduction'] = 1 - report['chars'] / report['baseline_chars'] if report['baseline_chars'] else 0.0
+        return text
+
+    def _compact_commands(self, commands: list, elide_eval: bool, report: dict) -> list:
+        """复制命令树，去掉默认值参数并按需省略 eval 代码，不修改输入。"""
+        compacted = []
+        for command_obj in commands:
+            cmd_name, params = self._command_parts(command_obj)
+            defaults = self.V4_PARAM_DEFAULTS.get(cmd_name, {})
+            new_params = {}
+            for key, value in params.items():
+                if key in defaults and any(type(value) is type(d) and value == d for d in defaults[key]):
+                    report['removed_params'] += 1
+                    continue
+                if key in ('commands', 'elseCommands', 'timerCommands'):
+                    value = self._compact_commands(value, elide_eval, report)
+                elif key == 'options':
+                    value = [{k: self._compact_commands(v, elide_eval, report) if k == 'commands' else v
+                              for k, v in option.items()} for option in value]
+                elif key == 'action' and cmd_name == 'eval' and elide_eval and value:
+                    value = self.EVAL_PLACEHOLDER
+                    report['elided_evals'] += 1
+                new_params[key] = value
+            compacted.append({cmd_name: new_params})
+        return compacted
+
+    def _shard_executor(self, workers: int) -> 'ProcessPoolExecutor':
+        # 工作进程各自持有一个转换器；磁盘页面缓存可以跨进程共享，内存缓存则不行
+        from concurrent.futures import ProcessPoolExecutor
+        cache = self.page_cache
+        return ProcessPoolExecutor(workers, initializer=_init_worker,
+                                   initargs=(cache.directory if cache is not None else None,))
+
+    def to_v4_stream(self, input_fp, output_fp, chunk_size: int = 1 << 16, graph: 'PageGraph' = None):
+        """
+        流式版 to_v4：从 v1 JSON 文件对象中逐个读取页面，直接把 v4 文本写入 output_fp。
+        峰值内存只与最大的单个页面有关，输出与 to_v4 完全一致。传入 graph 时顺带收集页面跳转边。
+        """
+        reader = _JSONStreamReader(input_fp, chunk_size)
+        meta, pages_seen = None, False
+        writer = _V4LineWriter(output_fp)
+        spool = None
+        for key in reader.iter_object():
+            if key == 'meta':
+                meta = reader.read_value()
+                if not pages_seen: writer.write_lines(self._meta_to_v4(meta))
+            elif key == 'pages':
+                pages_seen = True
+                if meta is None:
+                    # meta 可能出现在 pages 之后（to_v1 的输出就是这样），而它必须写在最前面，
+                    # 所以先把页面写到临时文件（超过阈值会落盘），最后再拼接。
+                    import shutil, tempfile
+                    spool = tempfile.SpooledTemporaryFile(max_size=1 << 20, mode='w+', encoding='utf-8')
+                    page_writer = _V4LineWriter(spool)
+                else:
+                    page_writer = writer
+                for page_id in reader.iter_object():
+                    commands = reader.read_value()
+                    page_writer.write_lines(self._page_to_v4(page_id, commands))
+                    if graph is not None: graph.add_page(page_id, self._collect_edges(commands))
+                    if self.stats is not None: self.stats.count_page(commands)
+            else:
+                reader.read_value()
+        if spool is not None:
+            with spool:
+                writer.write_lines(self._meta_to_v4(meta))
+                spool.seek(0)
+                if writer.started and page_writer.started: writer.write('\n')
+                shutil.copyfileobj(spool, output_fp)
+            writer.bytes_written += page_writer.bytes_written
+        if self.stats is not None:
+            self.stats.bytes_in += reader.bytes_read
+            self.stats.bytes_out += writer.bytes_written
+
+    def _meta_to_v4(self, meta) -> list:
         lines = []
-        if v1_data.get('meta', {}).get('init'):
+        if meta and meta.get('init'):
             lines.append("---")
-            init_script = v1_data['meta']['init'].strip()
+            init_script = meta['init'].strip()
             indented_lines = ["  " + line for line in init_script.split('\n')]
             lines.append("init: |")
             lines.append('\n'.join(indented_lines))
             lines.append("---")
+        return lines
 
-        pages = v1_data.get("pages", {})
-        for page_id, commands in pages.items():
-            lines.append(f"\n> {page_id}")
-            lines.extend(self._commands_to_v4(commands, 1))
-        return "\n".join(lines)
+    def _page_to_v4(self, page_id: str, commands: list) -> list:
+        lines = [f"\n> {page_id}"]
+        lines.extend(self._commands_to_v4(commands, 1))
+        return lines
 
     def _commands_to_v4(self, commands: list, indent_level: int) -> list:
         lines = []
         indent = "  " * indent_level
         for command_obj in commands:
-            cmd_name, params = list(command_obj.items())[0]
+            cmd_name, params = self._command_parts(command_obj)
 
             if cmd_name == 'if':
                 condition = params.get('condition', 'true')
@@ -44,9 +281,8 @@ class OEOSConverter:
                 
                 else_commands = params.get('elseCommands', [])
                 while else_commands:
-                    next_block = else_commands[0]
-                    if 'if' in next_block:
-                        else_params = next_block['if']
+                    next_name, else_params = self._command_parts(else_commands[0])
+                    if next_name == 'if':
                         condition = else_params.get('condition')
                         if condition:
                             lines.append(f"{indent}else if {condition}")
@@ -76,11 +312,17 @@ class OEOSConverter:
                  lines.extend(self._commands_to_v4(params['commands'], indent_level + 1))
         return lines
         
+    @staticmethod
+    def _command_parts(command_obj) -> tuple:
+        """返回命令的 (cmd_name, params)，同时支持 CommandNode 与 v1 字典 {cmd_name: params}（含 OrderedDict 等任意映射）。"""
+        if isinstance(command_obj, CommandNode): return command_obj.name, command_obj
+        for item in command_obj.items(): return item
+
     def _format_command_to_v4(self, cmd_name: str, params: dict, indent_level: int) -> str:
         if cmd_name in self.V4_SHORTCUT_COMMANDS:
             param_key = self.V4_SHORTCUT_COMMANDS[cmd_name]
             if param_key in params:
-                value = self._format_value_v4(params[param_key])
+                value = self._format_shortcut_v4(params[param_key])
                 other_params = {k: v for k, v in params.items() if k != param_key}
                 param_str = " ".join(f"{k}: {self._format_value_v4(v)}" for k, v in other_params.items())
                 return f"{cmd_name} {value}{' ' if param_str else ''}{param_str}"
@@ -107,14 +349,18 @@ class OEOSConverter:
             args.append(f"keep: true")
         header = f"{indent}{label}{' ' if args else ''}{' '.join(args)}"
         commands = option.get('commands', [])
-        if len(commands) == 1 and list(commands[0].keys())[0] in ['goto', 'end']:
-            cmd_name, params = list(commands[0].items())[0]
+        if len(commands) == 1:
+            cmd_name, params = self._command_parts(commands[0])
             if cmd_name == 'end': return [f"{header} -> end"]
-            return [f"{header} -> goto {params.get('target')}"]
+            if cmd_name == 'goto': return [f"{header} -> goto {params.get('target')}"]
         lines = [header]
         lines.extend(self._commands_to_v4(commands, indent_level + 1))
         return lines
 
+    def _format_shortcut_v4(self, value) -> str:
+        # 快捷命令的位置参数（`say "..."` 中的文本）
+        return self._format_value_v4(value)
+
     def _format_value_v4(self, value) -> str:
         if isinstance(value, str):
             if value.startswith('$'): return value
@@ -123,158 +369,191 @@ class OEOSConverter:
         if isinstance(value, (int, float)): return str(value)
         return "null"
 
-    def to_v1(self, v4_script: str) -> dict:
-        """将 v4 OEOScript 字符串解析为 v1 JSON 数据。"""
-        lines = v4_script.split('\n')
+    def to_v1(self, v4_script: str, workers: int = None, diagnostics: list = None) -> dict:
+        """
+        将 v4 OEOScript 字符串解析为 v1 JSON 数据。workers 大于 1 时按页面分片并行解析，见 to_v1_parallel。
+        传入 diagnostics 列表时进入恢复模式，见 to_v1_main_loop。
+        """
+        if workers is not None and workers > 1:
+            return self.to_v1_parallel(v4_script, workers, diagnostics=diagnostics)
+        if self.stats is not None:
+            with self.stats.phase('split'): lines = v4_script.split('\n')
+            return self.to_v1_main_loop(lines, {"pages": {}}, diagnostics=diagnostics)
+        return self.to_v1_main_loop(v4_script.split('\n'), {"pages": {}}, diagnostics=diagnostics)
+
+    def to_v1_parallel(self, v4_script: str, workers: int = None, graph: 'PageGraph' = None,
+                       diagnostics: list = None) -> dict:
+        """
+        多进程版 to_v1：页面之间互相独立（每个页面头都会清空上下文栈），因此在页面头处把脚本切成若干片，
+        在 ProcessPoolExecutor 中分别解析，再按原顺序合并。每片带着它在原文件中的起始行号，错误信息中的行号不变；
+        多个分片出错时抛出最靠前的那个错误，与串行解析一致。
+        脚本短于 PARALLEL_MIN_CHARS 时直接串行解析。
+        """
+        workers = workers or os.cpu_count() or 1
+        if len(v4_script) < self.PARALLEL_MIN_CHARS or workers <= 1 or not self._can_shard(v4_script, diagnostics is not None):
+            return self.to_v1_main_loop(v4_script.split('\n'), {"pages": {}}, graph=graph, diagnostics=diagnostics)
+        if self.stats is not None: self.stats.count_text(v4_script)
+        shards = [(v4_script[start:end], first_line_num, graph is not None, diagnostics is not None)
+                  for start, end, first_line_num in self._split_v4_shards(v4_script, workers * 4)]
         v1_data = {"pages": {}}
-        
-        if lines and lines[0].strip() == '---':
-            try:
-                end_meta_index = lines.index('---', 1)
-                meta_lines = lines[1:end_meta_index]
-                lines = lines[end_meta_index + 1:]
-                for i, line in enumerate(meta_lines):
-                    if line.strip().startswith('init:'):
-                        init_script = '\n'.join(l.strip() for l in meta_lines[i + 1:])
-                        v1_data['meta'] = {'init': init_script}
-                        break
-            except ValueError:
-                raise ValueError("元数据块 '---' 未正确闭合")
+        pages = v1_data["pages"]
+        meta = None
+        with self._shard_executor(workers) as executor:
+            for shard_pages, shard_meta, shard_graph, shard_diagnostics in executor.map(_to_v1_shard, shards):
+                for page_id, commands in shard_pages:
+                    pages[page_id] = commands
+                if shard_meta: meta = shard_meta
+                if graph is not None: graph.update(shard_graph)
+                if shard_diagnostics: diagnostics.extend(shard_diagnostics)
+        if meta: v1_data['meta'] = meta
+        return v1_data
 
-        context_stack = deque()
-        for line_num, line in enumerate(lines, 1):
-            if not line.strip() or (line.strip().startswith('#') and not line.startswith('#')):
-                continue
-            indent_size = len(line) - len(line.lstrip(' '))
-            line_content = line.strip()
+    def _can_shard(self, text: str, recover: bool) -> bool:
+        """
+        开头的元数据块能被 _V4_META_RE 完整识别时才能分片，否则（如未闭合的 `---`）分片点可能落在元数据块内部，
+        与串行解析不一致。恢复模式下元数据块会在第一个页面头处结束，块内含页面头时同样交给串行解析。
+        """
+        if not self._V4_META_START_RE.match(text): return True
+        meta = self._V4_META_RE.match(text)
+        return meta is not None and not (recover and self._V4_PAGE_HEADER_RE.search(meta.group()))
 
-            while context_stack and indent_size <= context_stack[-1][1]:
-                context_stack.pop()
-            
-            if line_content.startswith(('>', '#')) and indent_size == 0:
-                page_id = line_content[1:].strip()
-                page_commands = []
-                v1_data["pages"][page_id] = page_commands
-                context_stack.clear()
-                context_stack.append((page_commands, -1))
-                continue
+    def _split_v4_shards(self, text: str, count: int) -> list:
+        """在页面头处把脚本切成大约 count 片，返回 [(start, end, first_line_num)]。元数据块总是留在第一片。"""
+        meta = self._V4_META_RE.match(text)
+        pos = meta.end() if meta else 0
+        target = max(len(text) // count, 1)
+        shards, start, line_num = [], 0, 1
+        while True:
+            match = self._V4_PAGE_HEADER_RE.search(text, max(pos, start + target))
+            if match is None: break
+            end = match.end()
+            shards.append((start, end, line_num))
+            line_num += text.count('\n', start, end)
+            start = end
+        shards.append((start, len(text), line_num))
+        return shards
 
-            if not context_stack:
-                 if line_content: raise ValueError(f"第 {line_num} 行: 在页面声明之外找到命令 '{line_content}'")
-                 continue
-            
-            parent_list, parent_indent = context_stack[-1]
+    def _tokenize_v4(self, text: str, offset: int = 0) -> list:
+        """
+        单遍扫描一行参数文本，切分为带类型的词法单元 (kind, value, raw)。
+        出错时抛出 OEOSParseError，column 为出错位置在整行命令文本中的列（text 在该行中的起始偏移由 offset 给出）。
 
-            try:
-                command_obj, block_info = self._parse_v4_line(line_content)
-                cmd_name = list(command_obj.keys())[0]
-
-                if cmd_name == 'if':
-                    is_else = block_info.get('is_else', False)
-                    if is_else:
-                        if not parent_list or 'if' not in parent_list[-1]:
-                            raise ValueError(f"第 {line_num} 行: 'else' 或 'else if' 没有匹配的 'if'")
-
-                        # last_if_struct is the dict like {'if': {...}}
-                        last_if_struct = parent_list[-1]
-
-                        # Traverse the chain of else ifs
-                        while 'elseCommands' in last_if_struct['if']:
-                            else_cmds = last_if_struct['if']['elseCommands']
-                            if not else_cmds: # empty else, can attach here
-                                break
-
-                            # The next link in the chain must be another 'if' statement.
-                            next_if_struct = else_cmds[0]
-                            if 'if' not in next_if_struct:
-                                # This is a terminal `else` block with actions, not another `else if`.
-                                raise ValueError(f"第 {line_num} 行: 在一个最终 'else' 块之后不允许 'else'/'else if'")
-
-                            last_if_struct = next_if_struct
-
-                        # Attach the new command to the last 'if' in the chain.
-                        if not command_obj.get('if', {}).get('condition'): # This is a pure 'else'
-                             last_if_struct['if']['elseCommands'] = command_obj['if']['commands']
-                        else: # This is an 'else if'
-                             last_if_struct['if']['elseCommands'] = [command_obj]
-                    else:
-                        parent_list.append(command_obj)
-                else:
-                    parent_list.append(command_obj)
+        kind 取值: 'string'（支持转义）、'number'、'bool'、'null'、'word'（裸标识符/裸值）、
+        'expr'（$ 表达式，可包含空格，直到下一个 `key:` 或 `->` 为止）、'key'（`key:`）、'arrow'（`->`）。
+        """
+        tokens = []
+        append = tokens.append
+        match = self._V4_TOKEN_RE.match
+        pos = 0
+        while True:
+            m = match(text, pos)
+            kind = m.lastgroup
+            if kind == 'eol': return tokens
+            pos = m.end()
+            if kind == 'key':
+                key = m.group('key')
+                append(('key', key, key + ':'))
+                continue
+            if kind.startswith('kv_'):
+                # `key: value` 是一次匹配，这里拆成两个词法单元
+                key = m.group('key')
+                append(('key', key, key + ':'))
+                kind = kind[3:]
+                # when 的值是一个表达式，即使没有 $ 前缀也整体读取
+                if key == 'when' and kind not in ('string', 'expr'): kind = 'exprstart'
+            raw = m.group(m.lastindex)
+            if kind == 'string':
+                append(('string', json.loads(raw) if '\\' in raw else raw[1:-1], raw))
+            elif kind == 'word':
+                append(('word', raw, raw))
+            elif kind == 'expr':
+                raw = raw.rstrip()
+                append(('expr', raw, raw))
+            elif kind == 'int':
+                append(('number', int(raw), raw))
+            elif kind == 'float':
+                append(('number', float(raw), raw))
+            elif kind == 'literal':
+                value = self._V4_LITERALS[raw]
+                append(('null' if value is None else 'bool', value, raw))
+            elif kind == 'arrow':
+                append(('arrow', raw, raw))
+            elif kind == 'exprstart':
+                start = m.start(m.lastindex)
+                pos = self._scan_v4_expr(text, start)
+                append(('expr', text[start:pos], text[start:pos]))
+            else:
+                start = m.start(m.lastindex)
+                raise OEOSParseError(f"字符串缺少结束引号: {text[start:]}", column=offset + start + 1)
 
-                if block_info.get('new_block'):
-                    new_list = command_obj[cmd_name]['commands']
-                    context_stack.append((new_list, indent_size))
-                elif block_info.get('new_options_block'):
-                    context_stack.append((command_obj[cmd_name]['options'], indent_size))
-                elif block_info.get('new_notif_block'):
-                     context_stack.append((command_obj[cmd_name], indent_size))
-                elif block_info.get('is_multiline_eval'):
-                    context_stack.append((command_obj[cmd_name], indent_size))
-
-            except Exception as e:
-                raise ValueError(f"解析第 {line_num} 行时出错: '{line_content}' -> {e}")
-
-        def cleanup(obj):
-            if isinstance(obj, dict):
-                for k, v in list(obj.items()):
-                    if isinstance(v, dict):
-                        if 'commands' in v and not v['commands'] and k == 'timer':
-                            del v['commands']
-                        cleanup(v)
-                    elif isinstance(v, list):
-                        cleanup(v)
-                    elif k == 'action' and isinstance(v, str):
-                        obj[k] = v.strip()
-            elif isinstance(obj, list):
-                for item in obj:
-                    cleanup(item)
-        cleanup(v1_data)
-        return v1_data
-        
-    def _parse_v4_line(self, line: str) -> (dict, dict):
-        # This is now a simplified line parser
-        parts = line.split(' ', 1)
-        cmd_name = parts[0]
-        args_str = parts[1] if len(parts) > 1 else ''
-        params, block_info = {}, {}
+    def _scan_v4_expr(self, text: str, pos: int) -> int:
+        """从 $ 表达式起点扫描到其结束位置：跳过引号内的内容和括号内的空白，在顶层遇到 ` key:`/` ->` 或行尾时停止。"""
+        depth = 0
+        search = self._V4_EXPR_STOP_RE.search
+        while True:
+            m = search(text, pos)
+            if not m: return len(text.rstrip())
+            ch = m.group()
+            if ch in '"\'`':
+                quoted = self._V4_QUOTE_END_RE[ch].match(text, m.end())
+                pos = quoted.end() if quoted else len(text)
+            elif ch in '([{':
+                depth += 1
+                pos = m.end()
+            elif ch in ')]}':
+                depth = max(depth - 1, 0)
+                pos = m.end()
+            elif depth == 0:
+                return m.start()
+            else:
+                pos = m.end()
 
+    def _parse_v4_line(self, line: str) -> (dict, dict):
         # Handle options separately as they are not standard commands
         if line.startswith('"'):
              return self._parse_v4_option(line)
-        
+
+        cmd_name, _, args_str = line.partition(' ')
+        params, block_info = {}, {}
+
         # Handle notification sub-blocks
         if cmd_name in ['commands', 'timerCommands']:
              return {cmd_name: {}}, {'sub_block': True}
 
-        # 检查是否使用了命名参数语法（例如 "say label: ..."）
-        # 如果第一个参数是命名参数的键（以冒号结尾），则不应该使用快捷参数语法
+        # 条件表达式整行原样保留，不做切分
+        if cmd_name == 'else':
+            rest = args_str.strip()
+            if rest == 'if' or rest.startswith(('if ', 'if\t')):
+                return {'if': {'condition': rest[2:].strip(), 'commands': []}}, {'new_block': True, 'is_else': True}
+            return {'if': {'commands': []}}, {'new_block': True, 'is_else': True}
+        if cmd_name == 'if':
+            return {'if': {'condition': args_str.strip(), 'commands': []}}, {'new_block': True}
+
+        tokens = self._tokenize_v4(args_str, len(cmd_name) + 1) if args_str else []
+        index, count = 0, len(tokens)
+
+        # 如果第一个参数是快捷参数本身的命名形式（例如 "say label: ..."），则不使用快捷参数语法
         param_key = self.V4_SHORTCUT_COMMANDS.get(cmd_name)
-        is_named_param_syntax = param_key and args_str.lstrip().startswith(param_key + ':')
-
-        if cmd_name in self.V4_SHORTCUT_COMMANDS and not is_named_param_syntax:
-            # More robustly handle quoted strings and the rest of the arguments
-            match = re.match(r'(".*?"|\S+)\s*(.*)', args_str)
-            if match:
-                value, remaining_args = match.groups()
-                # The shortcut param name is the same as the command name for timer.remove
-                params[param_key] = self._parse_value_v1(value)
-                args_str = remaining_args
-        named_args = re.findall(r'(\w+):\s*(".*?"|true|false|-?\d+\.?\d*|\$\S+)', args_str)
-        for key, value in named_args:
-            params[key] = self._parse_value_v1(value)
-
-        if cmd_name == 'if' or (cmd_name == 'else' and 'if' in args_str):
-            params = {'condition': args_str.replace('if', '').strip(), 'commands': []}
-            block_info['new_block'] = True
-            if cmd_name == 'else': block_info['is_else'] = True
-            cmd_name = 'if'
-        elif cmd_name == 'else':
-            params = {'commands': []}
-            block_info['new_block'] = True
-            block_info['is_else'] = True
-            cmd_name = 'if'
-        elif cmd_name == 'choice':
+        if param_key and count and tokens[0][0] == 'key' and tokens[0][1] != param_key:
+            # 其他 `xxx:` 开头的是含冒号的裸值（data:image/png;...、chapter:2），取到第一个空白为止
+            start = len(args_str) - len(args_str.lstrip())
+            end = start + len(args_str[start:].split(None, 1)[0])
+            params[param_key] = args_str[start:end]
+            tokens = self._tokenize_v4(args_str[end:], len(cmd_name) + 1 + end)
+            count = len(tokens)
+        elif param_key and count and tokens[0][0] not in ('key', 'arrow'):
+            params[param_key] = tokens[0][1]
+            index = 1
+        while index < count:
+            kind, value, _ = tokens[index]
+            if kind == 'key' and index + 1 < count and tokens[index + 1][0] not in ('key', 'arrow'):
+                params[value] = tokens[index + 1][1]
+                index += 2
+            else:
+                # 无法识别的片段与以前一样被忽略
+                index += 1
+
+        if cmd_name == 'choice':
             params['options'] = []
             block_info['new_options_block'] = True
         elif cmd_name == 'notification.create':
@@ -286,193 +565,2394 @@ class OEOSConverter:
             params['action'] = ""
             block_info['is_multiline_eval'] = True
         elif cmd_name == 'eval' and 'code' in params:
-            params['action'] = params.pop('code')
-        
+            action = params.pop('code')
+            params['action'] = action.strip() if isinstance(action, str) else action
+
         return {cmd_name: params}, block_info
 
     def _parse_v4_option(self, line: str) -> (dict, dict):
         commands, block_info = [], {}
-        if '->' in line:
-            parts = line.split('->', 1)
-            line = parts[0].strip()
-            cmd_parts = parts[1].strip().split(' ', 1)
-            if cmd_parts[0] == 'end': commands.append({'end': {}})
-            elif cmd_parts[0] == 'goto': commands.append({'goto': {'target': self._parse_value_v1(cmd_parts[1])}})
-            else: raise ValueError(f"-> 快捷方式只支持 'end' 和 'goto', 但得到 '{cmd_parts[0]}'")
-        else:
-            block_info['new_block'] = True
+        tokens = self._tokenize_v4(line)
+        if not tokens or tokens[0][0] != 'string': raise ValueError(f"无法解析 option 行: {line}")
+        option = {'label': tokens[0][1], 'commands': commands}
 
-        match = re.match(r'(".*?")\s*(.*)', line)
-        if not match: raise ValueError(f"无法解析 option 行: {line}")
-        label_str, args_str = match.groups()
-        option = {'label': self._parse_value_v1(label_str), 'commands': commands}
-        
-        named_args = re.findall(r'(when|color|keep):\s*(".*?"|true|false|-?\d+\.?\d*|\$\S+)', args_str)
-        for key, value in named_args:
-            if key == 'when': option['visible'] = value
-            else: option[key] = self._parse_value_v1(value)
+        index, count = 1, len(tokens)
+        while index < count:
+            kind, value, raw = tokens[index]
+            if kind == 'arrow':
+                action = tokens[index + 1][1] if index + 1 < count else ''
+                if action == 'end': commands.append({'end': {}})
+                elif action == 'goto' and index + 2 < count: commands.append({'goto': {'target': tokens[index + 2][1]}})
+                else: raise OEOSParseError(f"-> 快捷方式只支持 'end' 和 'goto', 但得到 '{action}'",
+                                           column=line.find('->', len(tokens[0][2])) + 1)
+                break
+            if kind == 'key' and value in ('when', 'color', 'keep') and index + 1 < count and tokens[index + 1][0] not in ('key', 'arrow'):
+                if value == 'when': option['visible'] = tokens[index + 1][2]
+                else: option[value] = tokens[index + 1][1]
+                index += 2
+            else:
+                index += 1
+        if not commands:
+            block_info['new_block'] = True
         return option, block_info
         
-    def _parse_value_v1(self, value_str: str):
-        value_str = value_str.strip()
-        if value_str.startswith('"') and value_str.endswith('"'): return json.loads(value_str)
-        if value_str == 'true': return True
-        if value_str == 'false': return False
-        if value_str.startswith('$'): return value_str
-        try: return int(value_str)
+    def to_v1_main_loop(self, lines, v1_data: dict, graph: 'PageGraph' = None, diagnostics: list = None):
+        """
+        主解析循环。lines 可以是任意行迭代器（列表、文件对象等）；传入 graph 时顺带构建页面跳转图。
+
+        传入 diagnostics 列表时进入恢复模式：出错的页面被整页丢弃，解析从下一个页面头继续，
+        每个错误以 OEOSParseError（含 page/line/column/message）追加到列表中，其余页面照常返回。
+        """
+        parser = OEOSStreamParser(self, graph=graph, diagnostics=diagnostics)
+        pages = v1_data.setdefault("pages", {})
+        if self.stats is not None: lines = self.stats.count_lines(lines)
+        for line in lines:
+            page = parser.feed_line(line)
+            if page: pages[page[0]] = page[1]
+        for page_id, commands in parser.close():
+            pages[page_id] = commands
+        if parser.meta: v1_data['meta'] = parser.meta
+        if self.stats is not None: self.stats.lines += parser.line_count
+        return v1_data
+
+    def iter_pages(self, chunks, diagnostics: list = None):
+        """
+        逐块读取 OEOScript 文本（文件对象、LLM token 流等），每当一个页面闭合即产出 (page_id, commands)。
+        传入 diagnostics 列表时跳过出错的页面并记录错误。
+        """
+        parser = OEOSStreamParser(self, diagnostics=diagnostics)
+        for chunk in chunks:
+            yield from parser.feed(chunk)
+        yield from parser.close()
+
+    def to_v1_nodes(self, lines, graph: 'PageGraph' = None) -> 'NodeDocument':
+        """
+        与 to_v1_main_loop 相同，但每个页面闭合后立即转成紧凑节点，字典形式的命令树只在单页范围内存在。
+        节点的构建与 to_dict 按嵌套层递归，嵌套深度的限制与 to_v4 相同。
+        """
+        parser = OEOSStreamParser(self, graph=graph)
+        document = NodeDocument()
+        pages = document.pages
+        for line in lines:
+            page = parser.feed_line(line)
+            if page: pages[page[0]] = tuple(CommandNode.from_dict(c) for c in page[1])
+        for page_id, commands in parser.close():
+            pages[page_id] = tuple(CommandNode.from_dict(c) for c in commands)
+        document.meta = parser.meta
+        return document
+
+    def open_lazy(self, path: str) -> 'LazyScript':
+        """以内存映射方式打开 OEOScript 文件，只建立页面偏移索引，页面在首次访问时才解析。"""
+        return LazyScript(path, self)
+
+    def diff(self, old, new, structural: bool = True) -> dict:
+        """
+        比较两个脚本（v1 数据或 OEOScript 文本，可以混用），得到页面级增量:
+        {"added": {id: commands}, "removed": [id], "modified": {id: commands}}，meta.init 变化时另有 "meta": 新的 init（删除为 None），
+        structural 为 True 时另有 "changes": {id: diff_commands 的结果}。
+
+        两侧都是文本时先比较页面原文的哈希，相同的页面不解析；只有空白或注释不同的页面解析后相同，不算修改。
+        """
+        old_pages, old_meta, old_text = self._document_view(old)
+        new_pages, new_meta, new_text = self._document_view(new)
+        delta = {'added': {}, 'removed': [page_id for page_id in old_pages if page_id not in new_pages], 'modified': {}}
+        if structural: delta['changes'] = {}
+        for page_id in new_pages:
+            if page_id not in old_pages:
+                delta['added'][page_id] = new_pages[page_id]
+                continue
+            if old_text is not None and new_text is not None and old_text.page_digest(page_id) == new_text.page_digest(page_id):
+                continue
+            old_commands, new_commands = old_pages[page_id], new_pages[page_id]
+            if old_commands is new_commands or _deep_equal(old_commands, new_commands): continue
+            delta['modified'][page_id] = new_commands
+            if structural: delta['changes'][page_id] = self.diff_commands(old_commands, new_commands)
+        old_init, new_init = (old_meta or {}).get('init'), (new_meta or {}).get('init')
+        if old_init != new_init: delta['meta'] = new_init
+        return delta
+
+    def diff_commands(self, old: list, new: list, options: bool = False) -> list:
+        """
+        两个命令列表的结构化差异，按旧列表中的下标描述，从后往前依次应用即可得到新列表:
+        {"op": "delete", "at": i, "count": n}、{"op": "insert", "at": i, "commands": [...]}、
+        {"op": "replace", "at": i, "count": n, "commands": [...]}，以及同名命令（选项则是同一位置）只改了参数时的
+        {"op": "update", "at": i, "set": {键: 新值}, "unset": [键], "blocks": {子块键: 子块的差异}}。
+        子块用显式栈逐层比较，嵌套深度不受递归上限限制。
+        """
+        from difflib import SequenceMatcher
+        digests = _json_digests(old, new)
+        result = []
+        pending = [(old, new, options, result)]
+        while pending:
+            old, new, options, ops = pending.pop()
+            old_keys = [digests.get(id(item), item) for item in old]
+            new_keys = [digests.get(id(item), item) for item in new]
+            for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_keys, new_keys, autojunk=False).get_opcodes():
+                if tag == 'equal': continue
+                if tag == 'delete':
+                    ops.append({'op': 'delete', 'at': i1, 'count': i2 - i1})
+                elif tag == 'insert':
+                    ops.append({'op': 'insert', 'at': i1, 'commands': new[j1:j2]})
+                elif i2 - i1 == j2 - j1:
+                    ops.extend(self._diff_item(old[i], new[j], i, options, pending, digests) for i, j in zip(range(i1, i2), range(j1, j2)))
+                else:
+                    ops.append({'op': 'replace', 'at': i1, 'count': i2 - i1, 'commands': new[j1:j2]})
+        return result
+
+    def _diff_item(self, old_item: dict, new_item: dict, index: int, options: bool, pending: list, digests: dict) -> dict:
+        """比较一对命令（或选项）；需要逐条比较的子块不在这里展开，而是连同写入位置压入 pending。"""
+        if options:
+            old_params, new_params = old_item, new_item
+        else:
+            old_name, old_params = self._command_parts(old_item)
+            new_name, new_params = self._command_parts(new_item)
+            if old_name != new_name: return {'op': 'replace', 'at': index, 'count': 1, 'commands': [new_item]}
+        op = {'op': 'update', 'at': index, 'set': {}, 'unset': [key for key in old_params if key not in new_params], 'blocks': {}}
+        for key, value in new_params.items():
+            if key in old_params and digests.get(id(old_params[key]), old_params[key]) == digests.get(id(value), value): continue
+            if key in ('commands', 'elseCommands', 'timerCommands', 'options') and key in old_params:
+                op['blocks'][key] = []
+                pending.append((old_params[key], value, key == 'options', op['blocks'][key]))
+            else:
+                op['set'][key] = value
+        return op
+
+    def apply_delta(self, document, delta: dict):
+        """
+        把 diff 得到的增量应用到文档上，返回新文档而不修改原文档。v1 数据得到 v1 数据；OEOScript 文本得到文本，
+        未变化的页面保留原文，修改的页面按 to_v4 格式重新输出并留在原位置，新增的页面追加在末尾。
+        """
+        removed = set(delta.get('removed', ()))
+        modified, added = delta.get('modified', {}), delta.get('added', {})
+        if isinstance(document, str):
+            script = LazyScript.from_text(document, self)
+            if 'meta' in delta:
+                parts = ["\n".join(self._meta_to_v4({'init': delta['meta']}))]
+            else:
+                parts = [script.get_meta_text()]
+            for page_id in script:
+                if page_id in removed: continue
+                if page_id in modified: parts.append("\n".join(self._page_to_v4(page_id, modified[page_id])))
+                else: parts.append(script.get_page_text(page_id))
+            parts.extend("\n".join(self._page_to_v4(page_id, commands)) for page_id, commands in added.items())
+            return "\n\n".join(part.strip('\n') for part in parts if part.strip())
+        pages = {page_id: modified.get(page_id, commands)
+                 for page_id, commands in document.get('pages', {}).items() if page_id not in removed}
+        pages.update(added)
+        result = {key: value for key, value in document.items() if key not in ('pages', 'meta')}
+        result['pages'] = pages
+        meta = dict(document.get('meta') or {})
+        if 'meta' in delta:
+            if delta['meta'] is None: meta.pop('init', None)
+            else: meta['init'] = delta['meta']
+        if meta: result['meta'] = meta
+        return result
+
+    def _document_view(self, document) -> (Mapping, dict, 'LazyScript'):
+        """diff 的输入统一为 (页面映射, meta, 文本索引)；v1 数据没有文本索引。"""
+        if isinstance(document, str):
+            script = LazyScript.from_text(document, self)
+            return script, script.meta, script
+        if isinstance(document, LazyScript):
+            return document, document.meta, document
+        return document.get('pages', {}), document.get('meta'), None
+
+    def asset_manifest(self, document, start: str = 'start', max_distance: int = None) -> dict:
+        """
+        汇总脚本引用的媒体资源，供前端或代理预取。document 可以是 v1 数据或 OEOScript 文本。
+
+        返回 {"start": start, "pages": {页面: [{url, kind, conditional}]}, "prefetch": [{url, kind, page, conditional, distance}],
+        "dynamic": [{page, kind, expression}]}。pages 是逐页清单（页内去重）；prefetch 在整个脚本内按 url 去重，
+        按从 start 出发的跳数排序（同一跳数内按页面顺序和命令顺序），不可达页面的资源排在最后，distance 为 None；
+        给出 max_distance 时只保留该跳数以内的资源。conditional 表示资源只在 if/else 分支、选项或通知按钮里使用。
+        url 是 $ 表达式的资源无法预取，列在 dynamic 中。
+        """
+        pages = self._document_view(document)[0]
+        graph = PageGraph()
+        manifest = {'start': start, 'pages': {}, 'prefetch': [], 'dynamic': []}
+        for page_id in pages:
+            commands = pages[page_id]
+            graph.add_page(page_id, self._collect_edges(commands))
+            entries = {}
+            for url, kind, conditional in self._collect_assets(commands):
+                if url.startswith('$'):
+                    manifest['dynamic'].append({'page': page_id, 'kind': kind, 'expression': url})
+                elif url not in entries:
+                    entries[url] = {'url': url, 'kind': kind, 'conditional': conditional}
+                elif not conditional:
+                    entries[url]['conditional'] = False
+            manifest['pages'][page_id] = list(entries.values())
+        distances = graph.distances(start)
+        page_ids = list(manifest['pages'])
+        order = sorted(range(len(page_ids)), key=lambda i: (distances.get(page_ids[i], float('inf')), i))
+        prefetch = {}
+        for page_id in (page_ids[i] for i in order):
+            distance = distances.get(page_id)
+            if max_distance is not None and (distance is None or distance > max_distance): continue
+            for entry in manifest['pages'][page_id]:
+                if entry['url'] not in prefetch:
+                    prefetch[entry['url']] = dict(entry, page=page_id, distance=distance)
+        manifest['prefetch'] = list(prefetch.values())
+        return manifest
+
+    def _collect_assets(self, commands: list) -> list:
+        """按文档顺序收集一个页面命令树中引用的资源 (url, kind, conditional)，遍历方式与 _collect_edges 相同。"""
+        assets = []
+        stack = [(iter(commands), False)]
+        while stack:
+            block, conditional = stack[-1]
+            command_obj = next(block, None)
+            if command_obj is None:
+                stack.pop()
+                continue
+            cmd_name, params = self._command_parts(command_obj)
+            url = params.get('url')
+            if cmd_name in self.ASSET_COMMANDS and isinstance(url, str) and url:
+                assets.append((url, self.ASSET_COMMANDS[cmd_name], conditional))
+            label = params.get('label')
+            if isinstance(label, str) and 'src' in label:
+                assets.extend((src, kind, conditional) for src, kind in self._label_assets(label))
+            if cmd_name == 'if':
+                stack.append((iter(params.get('elseCommands', [])), True))
+                stack.append((iter(params.get('commands', [])), True))
+            elif cmd_name == 'timer':
+                stack.append((iter(params.get('commands', [])), conditional))
+            elif cmd_name == 'choice':
+                # 选项文本与 choice 一起显示，按选项顺序收集；只有压栈的各选项子块需要倒序
+                options = params.get('options', [])
+                for option in options:
+                    label = option.get('label')
+                    if isinstance(label, str) and 'src' in label:
+                        assets.extend((src, kind, conditional) for src, kind in self._label_assets(label))
+                for option in reversed(options):
+                    stack.append((iter(option.get('commands', [])), True))
+            elif cmd_name == 'notification.create':
+                stack.append((iter(params.get('timerCommands', [])), conditional))
+                stack.append((iter(params.get('commands', [])), True))
+        return assets
+
+    def _label_assets(self, label: str) -> list:
+        """文本中 HTML 标签引用的资源；含 <eval> 的动态地址跳过。"""
+        return [(match.group(3), self.HTML_ASSET_TAGS[match.group(1).lower()])
+                for match in self._HTML_SRC_RE.finditer(label) if '<eval' not in match.group(3)]
+
+    def to_bundle(self, v1_data: dict) -> bytes:
+        """把 v1 数据编译为二进制脚本包，格式见 ScriptBundle。"""
+        return ScriptBundle.compile(v1_data)
+
+    def open_bundle(self, path: str) -> 'ScriptBundle':
+        """以内存映射方式打开脚本包，页面在首次访问时才解码。"""
+        return ScriptBundle(path)
+
+    def verify_bundle(self, bundle, source):
+        """
+        确认脚本包与源脚本无损一致：source 为 OEOScript 文本时与 to_v1 的结果比较，也可以直接给出 v1 数据。
+        比较区分类型（true 与 1、1 与 1.0）和键顺序，不一致时抛出 ValueError 并列出出错的页面。bundle 可以是字节串或 ScriptBundle。
+        """
+        expected = self.to_v1(source) if isinstance(source, str) else source
+        if not isinstance(bundle, ScriptBundle): bundle = ScriptBundle.from_bytes(bundle)
+        expected_pages = expected.get('pages', {})
+        if list(bundle) != list(expected_pages):
+            raise ValueError("脚本包的页面列表或顺序与源脚本不一致")
+        mismatched = [page_id for page_id in expected_pages if not _deep_equal(bundle[page_id], expected_pages[page_id], strict=True)]
+        if not _deep_equal(bundle.meta or {}, expected.get('meta') or {}, strict=True): mismatched.insert(0, 'meta')
+        if mismatched: raise ValueError(f"脚本包与源脚本不一致: {', '.join(mismatched)}")
+
+    def build_graph(self, v1_data: dict) -> 'PageGraph':
+        """从已有的 v1 数据构建页面跳转图（OEOScript 输入请直接在 to_v1_main_loop 中传入 graph）。"""
+        graph = PageGraph()
+        for page_id, commands in v1_data.get('pages', {}).items():
+            graph.add_page(page_id, self._collect_edges(commands))
+        return graph
+
+    def _collect_edges(self, commands: list) -> list:
+        """按与解析时相同的规则收集一个页面命令树中的跳转边，使用显式栈而非递归。"""
+        edges = []
+        stack = [(iter(commands), 'goto')]
+        while stack:
+            block, edge_kind = stack[-1]
+            command_obj = next(block, None)
+            if command_obj is None:
+                stack.pop()
+                continue
+            cmd_name, params = self._command_parts(command_obj)
+            if cmd_name in self._EDGE_COMMANDS and 'target' in params:
+                edges.append((params['target'], edge_kind if cmd_name == 'goto' else cmd_name))
+            # 子块按出现顺序的逆序入栈，使遍历顺序与解析时的文档顺序一致
+            if cmd_name == 'if':
+                stack.append((iter(params.get('elseCommands', [])), edge_kind))
+                stack.append((iter(params.get('commands', [])), edge_kind))
+            elif cmd_name == 'timer':
+                stack.append((iter(params.get('commands', [])), 'timer'))
+            elif cmd_name == 'choice':
+                for option in reversed(params.get('options', [])):
+                    stack.append((iter(option.get('commands', [])), 'option'))
+            elif cmd_name == 'notification.create':
+                stack.append((iter(params.get('timerCommands', [])), 'notification'))
+                stack.append((iter(params.get('commands', [])), 'notification'))
+        return edges
+
+    def _parse_block_line(self, context_stack: deque, line_content: str, indent_size: int, line_num: int, edges: list = None):
+        """
+        解析页面内的一行命令，并将其挂到 context_stack 栈顶的容器中。
+        若传入 edges 列表，顺带记录本行产生的页面跳转边 (target, kind)。
+        """
+        # 每个栈帧: [container, indent_level, context_name, owner, if_tail, edge_kind]
+        # owner 是拥有该块的命令参数；if_tail 指向本层最近一个 if 链的末端，供 else/else if 以 O(1) 挂接；
+        # edge_kind 是块内 goto 所属的边类型（页面主体、选项、计时器或通知）
+        frame = context_stack[-1]
+        parent_list, parent_context_name, edge_kind = frame[0], frame[2], frame[5]
+
+        try:
+            # Special handling for notification.create sub-blocks
+            if parent_context_name == 'notification.create':
+                if line_content in ['commands', 'timerCommands']:
+                    # The parent_list IS the notification dict in this case
+                    new_list = []
+                    parent_list[line_content] = new_list
+                    context_stack.append([new_list, indent_size, 'commands', None, None, edge_kind])
+                    return
+                else: # A command inside notification's commands/timerCommands list
+                    pass # Fall through to normal command parsing
+
+            # Special handling for choice blocks (only accept options)
+            if parent_context_name == 'choice':
+                option_obj, block_info = self._parse_v4_option(line_content)
+                parent_list.append(option_obj)
+                if block_info.get('new_block'):
+                    context_stack.append([option_obj['commands'], indent_size, 'commands', None, None, 'option'])
+                elif edges is not None and 'goto' in option_obj['commands'][0]:
+                    edges.append((option_obj['commands'][0]['goto']['target'], 'option'))
+                return
+
+            # Handle multiline eval
+            if parent_context_name == 'eval':
+                parent_list.append(line_content) # Here parent_list collects the eval source lines
+                return
+
+            # Normal command parsing
+            command_obj, block_info = self._parse_v4_line(line_content)
+            cmd_name, params = self._command_parts(command_obj)
+
+            if block_info.get('is_else'):
+                if_tail = frame[4]
+                if if_tail is None:
+                    raise ValueError(f"第 {line_num} 行: 'else' 或 'else if' 没有匹配的 'if'")
+                if if_tail is self._CLOSED_IF_CHAIN:
+                    raise ValueError(f"第 {line_num} 行: 在一个最终 'else' 块之后不允许 'else'/'else if'")
+                # Attach the new command to the last 'if' in the chain.
+                if not params.get('condition'): # This is a pure 'else'
+                    if_tail['elseCommands'] = params['commands']
+                    frame[4] = self._CLOSED_IF_CHAIN
+                else: # This is an 'else if'
+                    if_tail['elseCommands'] = [command_obj]
+                    frame[4] = params
+            else:
+                parent_list.append(command_obj)
+                frame[4] = params if cmd_name == 'if' else None
+
+            if edges is not None and cmd_name in self._EDGE_COMMANDS and 'target' in params:
+                edges.append((params['target'], edge_kind if cmd_name == 'goto' else cmd_name))
+
+            # Push new context if a block is started
+            if block_info.get('new_block'):
+                if cmd_name == 'timer':
+                    context_stack.append([params['commands'], indent_size, 'timer', params, None, 'timer'])
+                else:
+                    context_stack.append([params['commands'], indent_size, 'commands', params, None, edge_kind])
+            elif block_info.get('new_options_block'):
+                context_stack.append([params['options'], indent_size, 'choice', params, None, 'option'])
+            elif block_info.get('new_notif_block'):
+                context_stack.append([params, indent_size, 'notification.create', params, None, 'notification'])
+            elif block_info.get('is_multiline_eval'):
+                context_stack.append([[], indent_size, 'eval', params, None, edge_kind])
+
+        except Exception as e:
+            # 词法器报告的列是相对于命令文本的，其余错误指向命令开头
+            column = indent_size + (e.column if isinstance(e, OEOSParseError) and e.column else 1)
+            raise OEOSParseError(f"解析第 {line_num} 行时出错: '{line_content}' -> {e}", line_num, column) from e
+
+    def _close_blocks(self, context_stack: deque, indent_size: int):
+        """弹出缩进不小于 indent_size 的块，并在块结束时就地完成收尾，解析完成后无需再遍历整棵树。"""
+        while context_stack and indent_size <= context_stack[-1][1]:
+            container, _, context_name, owner = context_stack.pop()[:4]
+            if context_name == 'eval':
+                owner['action'] = '\n'.join(container).strip()
+            elif context_name == 'timer' and not container:
+                # 没有子命令块的 timer 是同步计时器
+                del owner['commands']
+
+class _CompactV4Emitter(OEOSConverter):
+    """to_v4_compact 使用的输出格式：页面之间不留空行，能原样读回的快捷参数不加引号。"""
+
+    def _page_to_v4(self, page_id: str, commands: list) -> list:
+        lines = [f"> {page_id}"]
+        lines.extend(self._commands_to_v4(commands, 1))
+        return lines
+
+    def _format_shortcut_v4(self, value) -> str:
+        # 插件的 v4-parser.js 只在快捷位置参数上接受裸词，且会用 Number() 尝试转换，因此只对字母开头的词省略引号
+        if isinstance(value, str) and value[:1].isalpha() and value.isascii() and not value.startswith('Infinity'):
+            # 还要求词法器会把它原样读成一个裸词（排除 true/false、`key:` 等形式）
+            tokens = self._tokenize_v4(value)
+            if len(tokens) == 1 and tokens[0][0] == 'word' and tokens[0][1] == value: return value
+        return self._format_value_v4(value)
+
+
+class OEOSStreamParser:
+    """
+    增量式 OEOScript 解析器：可以喂入任意大小的文本块，页面一闭合（遇到下一个 `> id`、`---` 或输入结束）就产出。
+
+    只缓存尚未结束的那一行以及当前正在构建的页面，内存占用与输入总长度无关。
+    """
+
+    def __init__(self, converter: OEOSConverter = None, max_line_length: int = 1 << 20, graph: 'PageGraph' = None,
+                 first_line_num: int = 1, diagnostics: list = None):
+        self.converter = converter or OEOSConverter()
+        self.max_line_length = max_line_length
+        # 若提供 PageGraph，每个页面闭合时把解析过程中记录的跳转边写入其中
+        self.graph = graph
+        # 恢复模式：提供列表时错误不抛出，而是记录下来并跳过出错的页面
+        self.diagnostics = diagnostics
+        self.meta = None
+        self._pending = []
+        self._pending_len = 0
+        self._overlong = False  # 恢复模式下正在丢弃一个超长行的剩余部分
+        self._skipping = False  # 恢复模式下正在跳过出错页面的剩余行
+        # 从文件中间开始解析（懒加载、分片）时，错误信息里的行号仍按整个文件计
+        self._first_line_num = first_line_num
+        self._line_num = first_line_num - 1
+        self._seen_content = False
+        self._meta_lines = None
+        self._meta_line_num = None
+        self._page_id = None
+        self._page_commands = None
+        self._page_lines = None
+        self._page_edges = None
+        self._context_stack = deque()
+
+    def feed(self, chunk: str) -> list:
+        """喂入一段文本，返回本次闭合的页面列表 [(page_id, commands), ...]。"""
+        completed = []
+        parts = chunk.split('\n')
+        if len(parts) > 1:
+            first = 0
+            if self._overlong:
+                # 超长行到此结束：整行丢弃，只计入行号
+                self._overlong = False
+                self._line_num += 1
+                first = 1
+            elif self._pending:
+                self._pending.append(parts[0])
+                parts[0] = ''.join(self._pending)
+                self._pending, self._pending_len = [], 0
+            for line in parts[first:-1]:
+                page = self.feed_line(line)
+                if page: completed.append(page)
+        tail = parts[-1]
+        if tail and not self._overlong:
+            self._pending_len += len(tail)
+            if self._pending_len > self.max_line_length:
+                self._pending, self._pending_len = [], 0
+                line_num = self._line_num + 1
+                self._fail(OEOSParseError(f"第 {line_num} 行: 单行长度超过上限 {self.max_line_length}", line_num, 1))
+                self._overlong = True
+            else:
+                self._pending.append(tail)
+        return completed
+
+    def close(self) -> list:
+        """输入结束：处理缓冲中的最后一行并闭合最后一个页面。"""
+        completed = []
+        if self._overlong:
+            self._overlong = False
+            self._line_num += 1
+        if self._pending:
+            line = ''.join(self._pending)
+            self._pending, self._pending_len = [], 0
+            page = self.feed_line(line)
+            if page: completed.append(page)
+        if self._meta_lines is not None:
+            self._meta_lines = None
+            self._fail(OEOSParseError(f"第 {self._meta_line_num} 行: 元数据块 '---' 未正确闭合", self._meta_line_num, 1))
+        page = self._close_page()
+        if page: completed.append(page)
+        return completed
+
+    def feed_line(self, line: str):
+        """处理完整的一行（不含换行符）。若该行导致一个页面闭合，返回 (page_id, commands)，否则返回 None。"""
+        self._line_num += 1
+        line_num = self._line_num
+        line_content = line.strip()
+
+        if self._meta_lines is not None:
+            if line_content == '---':
+                self._finish_meta()
+                return None
+            if not (self.diagnostics is not None and line_content.startswith('>') and not line.startswith(' ')):
+                self._meta_lines.append(line)
+                return None
+            # 恢复模式：未闭合的元数据块在第一个页面头处结束，后面的页面照常解析
+            self._finish_meta()
+            self.diagnostics.append(OEOSParseError(f"第 {self._meta_line_num} 行: 元数据块 '---' 未正确闭合",
+                                                   self._meta_line_num, 1))
+
+        if not line_content or (line_content.startswith('#') and not line.startswith('#')): return None
+
+        if line_content == '---':
+            if not self._seen_content:
+                self._seen_content = True
+                self._meta_lines = []
+                self._meta_line_num = line_num
+                return None
+            closed = self._close_page()
+            self._skipping = False
+            return closed
+        self._seen_content = True
+
+        indent_size = len(line) - len(line.lstrip(' '))
+
+        if line_content.startswith(('>', '#')) and indent_size == 0:
+            closed = self._close_page()
+            self._skipping = False
+            self._page_id = line_content[1:].strip()
+            self._page_commands = []
+            self._page_edges = []
+            self._context_stack.append([self._page_commands, -1, 'page', None, None, 'goto'])
+            if self.converter.page_cache is not None: self._page_lines = []
+            return closed
+
+        if self._page_id is None:
+            if self._skipping: return None
+            return self._fail(OEOSParseError(f"第 {line_num} 行: 在页面声明之外找到命令 '{line_content}'",
+                                             line_num, indent_size + 1))
+
+        if self._page_lines is not None:
+            # 启用页面缓存时先缓冲整页原文，闭合时按哈希决定是否需要解析
+            self._page_lines.append((line_num, line.rstrip()))
+            return None
+
+        try:
+            self._parse_page_line(line_num, line_content, indent_size)
+        except OEOSParseError as e:
+            self._fail(e)
+        return None
+
+    def _fail(self, error: OEOSParseError):
+        """非恢复模式下直接抛出；恢复模式下记录错误，丢弃当前页面，并跳过其余行直到下一个页面头或 `---`。"""
+        if error.page is None: error.page = self._page_id
+        if self.diagnostics is None: raise error
+        self.diagnostics.append(error.with_traceback(None))
+        self._page_id = self._page_commands = self._page_edges = self._page_lines = None
+        self._context_stack.clear()
+        self._skipping = True
+        return None
+
+    @property
+    def line_count(self) -> int:
+        """已处理的行数（从 first_line_num 起算）。"""
+        return self._line_num - self._first_line_num + 1
+
+    def parse_lines(self, lines) -> list:
+        """喂入一组完整的行并结束输入，返回全部页面 [(page_id, commands), ...]。"""
+        pages = []
+        for line in lines:
+            page = self.feed_line(line)
+            if page: pages.append(page)
+        pages.extend(self.close())
+        return pages
+
+    def _parse_page_line(self, line_num: int, line_content: str, indent_size: int):
+        self.converter._close_blocks(self._context_stack, indent_size)
+        self.converter._parse_block_line(self._context_stack, line_content, indent_size, line_num, self._page_edges)
+
+    def _close_page(self):
+        if self._page_lines is not None:
+            page_lines, self._page_lines = self._page_lines, None
+            cache = self.converter.page_cache
+            key = cache.key('\n'.join(line for _, line in page_lines))
+            cached = cache.get(key)
+            if cached is None:
+                try:
+                    for line_num, line in page_lines:
+                        self._parse_page_line(line_num, line.strip(), len(line) - len(line.lstrip(' ')))
+                except OEOSParseError as e:
+                    return self._fail(e)
+                self.converter._close_blocks(self._context_stack, -1)
+                cache.put(key, self._page_commands, self._page_edges)
+            else:
+                self._context_stack.clear()
+                self._page_commands, self._page_edges = cached
+        self.converter._close_blocks(self._context_stack, -1)
+        if self._page_id is None:
+            return None
+        page = (self._page_id, self._page_commands)
+        if self.graph is not None: self.graph.add_page(self._page_id, self._page_edges)
+        if self.converter.stats is not None: self.converter.stats.count_page(self._page_commands)
+        self._page_id, self._page_commands, self._page_edges = None, None, None
+        return page
+
+    def _finish_meta(self):
+        meta_lines, self._meta_lines = self._meta_lines, None
+        for i, line in enumerate(meta_lines):
+            if line.strip().startswith('init:'):
+                self.meta = {'init': '\n'.join(l.strip() for l in meta_lines[i + 1:])}
+                break
+
+
+class LazyScript(Mapping):
+    """
+    按需解析的 OEOScript 文件：page_id -> commands 的只读映射。
+
+    打开时把文件映射进内存，一次扫描找出所有页面头和元数据块的字节偏移；页面在第一次被访问时才解析并缓存，
+    内存只随实际访问过的页面增长。页面之间（`---` 之后、下一个页面头之前）的游离命令不会被检查，
+    需要完整校验时请用 to_v1。
+    """
+    # 页面边界：行首的 `>`/`#` 页面头（`>` 前允许非空格空白，与 feed_line 的判断一致）或单独的 `---`。
+    # 以换行符开头，正则引擎可以按字面前缀快速跳过页面内容
+    _BOUNDARY_RE = re.compile(rb'\n(?:[^\S \n]*>[^\n]*|#[^\n]*|[^\S\n]*---[^\S\n]*(?=\n|$))')
+
+    def __init__(self, path: str, converter: OEOSConverter = None):
+        self.path = path
+        import mmap
+        self._file = open(path, 'rb')
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        except Exception:
+            self._file.close()
+            raise
+        self._setup(data, converter)
+
+    @classmethod
+    def from_text(cls, text: str, converter: OEOSConverter = None) -> 'LazyScript':
+        """对内存中的脚本文本建立同样的页面索引。"""
+        script = cls.__new__(cls)
+        script.path, script._file = None, None
+        script._setup(text.encode('utf-8'), converter)
+        return script
+
+    def _setup(self, data, converter: OEOSConverter):
+        self.converter = converter or OEOSConverter()
+        self._data = data
+        self._index = {}  # page_id -> (start, end, first_line_num)
+        self._pages = {}
+        self._meta_span = None
+        self._meta = None
+        self._build_index()
+
+    def _build_index(self):
+        data = self._data
+        pos, line_num = self._skip_to_content()
+        if self._line_at(pos).strip() == b'---':
+            pos, line_num = self._index_meta(pos, line_num)
+        page = None  # (page_id, start, first_line_num)
+        for start, header in self._iter_boundaries(pos):
+            line_num += data[pos:start].count(b'\n')
+            pos = start
+            if page is not None:
+                self._index[page[0]] = (page[1], start, page[2])
+            header = header.strip()
+            page = (header[1:].decode('utf-8').strip(), start, line_num) if header != b'---' else None
+        if page is not None:
+            self._index[page[0]] = (page[1], len(data), page[2])
+
+    def _iter_boundaries(self, pos: int):
+        """产出 pos 之后每个边界行的 (起始偏移, 行内容)。"""
+        if pos == 0:
+            match = self._BOUNDARY_RE.match(b'\n' + self._line_at(0))
+            if match: yield 0, match.group()[1:]
+            pos = 1
+        for match in self._BOUNDARY_RE.finditer(self._data, pos - 1):
+            yield match.start() + 1, match.group()[1:]
+
+    def _line_at(self, pos: int) -> bytes:
+        end = self._data.find(b'\n', pos)
+        return self._data[pos:end if end >= 0 else len(self._data)]
+
+    def _skip_to_content(self) -> (int, int):
+        """跳过开头的空行和缩进注释，返回第一行有效内容的位置与行号。"""
+        pos, line_num = 0, 1
+        while pos < len(self._data):
+            line = self._line_at(pos)
+            content = line.strip()
+            if content and not (content.startswith(b'#') and not line.startswith(b'#')):
+                break
+            pos, line_num = pos + len(line) + 1, line_num + 1
+        return pos, line_num
+
+    def _index_meta(self, pos: int, line_num: int) -> (int, int):
+        """记录开头 `---` 元数据块的范围，返回块之后的位置与行号。"""
+        start, first_line_num = pos, line_num
+        pos, line_num = pos + len(self._line_at(pos)) + 1, line_num + 1
+        while pos < len(self._data):
+            line = self._line_at(pos)
+            pos, line_num = pos + len(line) + 1, line_num + 1
+            if line.strip() == b'---':
+                self._meta_span = (start, min(pos, len(self._data)), first_line_num)
+                return pos, line_num
+        raise ValueError("元数据块 '---' 未正确闭合")
+
+    def _parse_span(self, span: tuple) -> (OEOSStreamParser, list):
+        start, end, first_line_num = span
+        parser = OEOSStreamParser(self.converter, first_line_num=first_line_num)
+        pages = parser.parse_lines(self._data[start:end].decode('utf-8').split('\n'))
+        return parser, pages
+
+    @property
+    def meta(self):
+        if self._meta is None and self._meta_span is not None:
+            self._meta = self._parse_span(self._meta_span)[0].meta
+        return self._meta
+
+    def __getitem__(self, page_id: str) -> list:
+        commands = self._pages.get(page_id)
+        if commands is None:
+            commands = self._parse_span(self._index[page_id])[1][-1][1]
+            self._pages[page_id] = commands
+        return commands
+
+    def __contains__(self, page_id):
+        return page_id in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def loaded_pages(self) -> list:
+        """已经解析过的页面 id。"""
+        return list(self._pages)
+
+    def get_page_text(self, page_id: str) -> str:
+        """返回页面的 OEOScript 原文（含页面头），不解析。"""
+        start, end, _ = self._index[page_id]
+        return self._data[start:end].decode('utf-8')
+
+    def get_meta_text(self) -> str:
+        """返回开头 `---` 元数据块的原文，没有时为空字符串。"""
+        if self._meta_span is None: return ''
+        start, end, _ = self._meta_span
+        return self._data[start:end].decode('utf-8')
+
+    def page_digest(self, page_id: str) -> str:
+        """页面原文（含页面头）的哈希，可用于不解析就判断页面是否变化。"""
+        start, end, _ = self._index[page_id]
+        return hashlib.blake2b(self._data[start:end], digest_size=16).hexdigest()
+
+    def to_dict(self) -> dict:
+        """解析全部页面，得到与 to_v1 相同的 v1 数据。"""
+        v1_data = {"pages": {page_id: self[page_id] for page_id in self._index}}
+        if self.meta: v1_data['meta'] = self.meta
+        return v1_data
+
+    def close(self):
+        if self._file is not None:
+            # 从文件打开时数据是 mmap（空文件为 b''），from_text/from_bytes 的数据归调用方所有
+            if not isinstance(self._data, bytes): self._data.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ScriptBundle(Mapping):
+    """
+    预编译的二进制脚本包：page_id -> commands 的只读映射，取出的都是普通 v1 数据。
+
+    布局（小端）: 文件头 | 字符串表 | 页面偏移表 | meta | 各页面数据。字符串表是一个 JSON 字符串数组（打开时由 json 的
+    C 实现一次解码），收录所有字典键（命令名、参数名）、页面 id 以及在脚本中出现两次以上的字符串值；页面偏移表每项为 (页面 id 的字符串编号, 偏移, 长度)；
+    每个页面数据前另有 4 字节长度，可以顺序读取。打开时只解码文件头、字符串表和偏移表，页面在第一次被访问时才解码。
+
+    值编码为 1 字节标记加内容：整数为 zigzag varint，浮点数为 8 字节 double，字符串为字符串表编号或内联的 varint 长度加 UTF-8，
+    列表和字典为 varint 元素个数加各元素，字典的键一律是字符串表编号。编码与解码都用显式栈，深层嵌套不会触发递归上限。
+    """
+    MAGIC = b'OEOB'
+    VERSION = 1
+    _HEADER = struct.Struct('<4sHHIQQQQ')  # magic, version, flags, 页面数, 字符串表长度, 偏移表偏移, meta 偏移, meta 长度
+    _PAGE_ENTRY = struct.Struct('<IQI')
+    _LENGTH = struct.Struct('<I')
+    _DOUBLE = struct.Struct('<d')
+    _NULL, _FALSE, _TRUE, _INT, _FLOAT, _STR, _REF, _LIST, _DICT = range(9)
+    _END = object()  # 遍历哨兵
+
+    def __init__(self, path: str):
+        self.path = path
+        import mmap
+        self._file = open(path, 'rb')
+        try:
+            data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._setup(data)
+        except Exception:
+            self._file.close()
+            raise
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'ScriptBundle':
+        bundle = cls.__new__(cls)
+        bundle.path, bundle._file = None, None
+        bundle._setup(data)
+        return bundle
+
+    def _setup(self, data):
+        self._data = data
+        if len(data) < self._HEADER.size or data[:4] != self.MAGIC:
+            raise ValueError("不是 OEOS 脚本包")
+        _, version, _, page_count, strings_length, table_offset, meta_offset, meta_length = self._HEADER.unpack_from(data)
+        if version != self.VERSION: raise ValueError(f"不支持的脚本包版本: {version}")
+        self._strings = strings = json.loads(data[self._HEADER.size:self._HEADER.size + strings_length])
+        table = data[table_offset:table_offset + page_count * self._PAGE_ENTRY.size]
+        # page_id -> (offset, length)
+        self._index = {strings[name]: (offset, length) for name, offset, length in self._PAGE_ENTRY.iter_unpack(table)}
+        self._meta = self._decode(meta_offset) if meta_length else None
+        self._pages = {}
+
+    @staticmethod
+    def _read_varint(data, pos: int) -> (int, int):
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80: return result, pos
+            shift += 7
+
+    def _decode(self, pos: int):
+        data, strings, read_varint = self._data, self._strings, self._read_varint
+        REF, STR, INT, FLOAT, LIST, DICT = self._REF, self._STR, self._INT, self._FLOAT, self._LIST, self._DICT
+        root = []
+        stack = [[root, 1]]  # [容器, 剩余元素数]
+        while stack:
+            frame = stack[-1]
+            if not frame[1]:
+                stack.pop()
+                continue
+            frame[1] -= 1
+            container = frame[0]
+            is_dict = type(container) is dict
+            if is_dict:
+                # varint 的单字节情形占绝大多数，直接内联
+                key = data[pos]
+                if key < 0x80: pos += 1
+                else: key, pos = read_varint(data, pos)
+                key = strings[key]
+            tag = data[pos]
+            pos += 1
+            if tag == REF:
+                value = data[pos]
+                if value < 0x80: pos += 1
+                else: value, pos = read_varint(data, pos)
+                value = strings[value]
+            elif tag == STR:
+                length, pos = read_varint(data, pos)
+                value = str(data[pos:pos + length], 'utf-8')
+                pos += length
+            elif tag == DICT or tag == LIST:
+                count, pos = read_varint(data, pos)
+                value = {} if tag == DICT else []
+                if count: stack.append([value, count])
+            elif tag == INT:
+                value, pos = read_varint(data, pos)
+                value = (value >> 1) ^ -(value & 1)
+            elif tag == FLOAT:
+                value = self._DOUBLE.unpack_from(data, pos)[0]
+                pos += 8
+            elif tag <= self._TRUE:
+                value = (None, False, True)[tag]
+            else:
+                raise ValueError(f"脚本包数据损坏：偏移 {pos - 1} 处的未知标记 {tag}")
+            if is_dict: container[key] = value
+            else: container.append(value)
+        return root[0]
+
+    @classmethod
+    def compile(cls, v1_data: dict) -> bytes:
+        """把 v1 数据编译为脚本包。"""
+        pages = v1_data.get('pages', {})
+        meta = v1_data.get('meta')
+        strings = cls._build_string_table(pages, meta)
+        intern = {s: i for i, s in enumerate(strings)}
+        payloads = [cls._encode(commands, intern) for commands in pages.values()]
+        meta_payload = cls._encode(meta, intern) if meta else b''
+        out = bytearray(cls._HEADER.size)
+        out += json.dumps(strings, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        strings_length = len(out) - cls._HEADER.size
+        table_offset = len(out)
+        meta_offset = table_offset + cls._PAGE_ENTRY.size * len(payloads)
+        offset = meta_offset + len(meta_payload)
+        for page_id, payload in zip(pages, payloads):
+            out += cls._PAGE_ENTRY.pack(intern[page_id], offset + cls._LENGTH.size, len(payload))
+            offset += cls._LENGTH.size + len(payload)
+        out += meta_payload
+        for payload in payloads:
+            out += cls._LENGTH.pack(len(payload))
+            out += payload
+        cls._HEADER.pack_into(out, 0, cls.MAGIC, cls.VERSION, 0, len(payloads), strings_length,
+                              table_offset, meta_offset, len(meta_payload))
+        return bytes(out)
+
+    @classmethod
+    def _build_string_table(cls, pages: dict, meta) -> list:
+        """字典键和页面 id 全部收录，字符串值出现两次以上才收录；按出现次数降序排列，常用的字符串编号更短。"""
+        counts = {}
+        for page_id in pages: counts[page_id] = counts.get(page_id, 0) + 2
+        stack = [iter(pages.values())]
+        if meta: stack.append(iter((meta,)))
+        while stack:
+            value = next(stack[-1], cls._END)
+            if value is cls._END:
+                stack.pop()
+            elif type(value) is str:
+                counts[value] = counts.get(value, 0) + 1
+            elif type(value) is list:
+                stack.append(iter(value))
+            elif isinstance(value, Mapping):
+                for key in value: counts[key] = counts.get(key, 0) + 2
+                stack.append(iter(value.values()))
+            elif isinstance(value, (list, tuple)):
+                stack.append(iter(value))
+        return sorted((s for s, n in counts.items() if n >= 2), key=counts.get, reverse=True)
+
+    @staticmethod
+    def _write_varint(out: bytearray, value: int):
+        while value >= 0x80:
+            out.append(value & 0x7f | 0x80)
+            value >>= 7
+        out.append(value)
+
+    @classmethod
+    def _encode(cls, value, intern: dict) -> bytes:
+        out = bytearray()
+        write_varint = cls._write_varint
+        stack = [(iter((value,)), False)]  # (迭代器, 是否为字典项)
+        while stack:
+            block, is_dict = stack[-1]
+            item = next(block, cls._END)
+            if item is cls._END:
+                stack.pop()
+                continue
+            if is_dict:
+                key, item = item
+                write_varint(out, intern[key])
+            kind = type(item)
+            if kind is str:
+                index = intern.get(item)
+                if index is not None:
+                    out.append(cls._REF)
+                    write_varint(out, index)
+                else:
+                    encoded = item.encode('utf-8')
+                    out.append(cls._STR)
+                    write_varint(out, len(encoded))
+                    out += encoded
+            elif kind is bool or item is None:
+                out.append(cls._NULL if item is None else cls._TRUE if item else cls._FALSE)
+            elif kind is int:
+                out.append(cls._INT)
+                write_varint(out, item << 1 if item >= 0 else (~item << 1) | 1)
+            elif kind is float:
+                out.append(cls._FLOAT)
+                out += cls._DOUBLE.pack(item)
+            elif kind is list:
+                out.append(cls._LIST)
+                write_varint(out, len(item))
+                stack.append((iter(item), False))
+            elif kind is dict or isinstance(item, Mapping):
+                out.append(cls._DICT)
+                write_varint(out, len(item))
+                stack.append((iter(item.items()), True))
+            elif isinstance(item, (list, tuple)):
+                out.append(cls._LIST)
+                write_varint(out, len(item))
+                stack.append((iter(item), False))
+            else:
+                raise TypeError(f"脚本包不支持的值类型: {kind.__name__}")
+        return bytes(out)
+
+    @property
+    def meta(self):
+        return self._meta
+
+    def __getitem__(self, page_id: str) -> list:
+        commands = self._pages.get(page_id)
+        if commands is None:
+            commands = self._decode(self._index[page_id][0])
+            self._pages[page_id] = commands
+        return commands
+
+    def __contains__(self, page_id):
+        return page_id in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def loaded_pages(self) -> list:
+        """已经解码过的页面 id。"""
+        return list(self._pages)
+
+    def to_dict(self) -> dict:
+        """解码全部页面，得到 v1 数据。"""
+        v1_data = {"pages": {page_id: self[page_id] for page_id in self._index}}
+        if self._meta: v1_data['meta'] = self._meta
+        return v1_data
+
+    def close(self):
+        if self._file is not None:
+            # 从文件打开时数据是 mmap（空文件为 b''），from_text/from_bytes 的数据归调用方所有
+            if not isinstance(self._data, bytes): self._data.close()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _deep_equal(a, b, strict: bool = False) -> bool:
+    """
+    深度比较，使用显式栈，嵌套层数不受递归上限限制。默认与 == 的语义相同；strict 为 True 时类型必须一致
+    （True 与 1、1 与 1.0 视为不同）、字典键顺序必须一致，NaN 与 NaN 视为相等。
+    """
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if isinstance(a, Mapping) and isinstance(b, Mapping):
+            if strict:
+                if list(a) != list(b): return False
+            elif len(a) != len(b) or any(key not in b for key in a):
+                return False
+            stack.extend((value, b[key]) for key, value in a.items())
+        elif isinstance(a, list) and isinstance(b, list):
+            if len(a) != len(b): return False
+            stack.extend(zip(a, b))
+        elif strict:
+            if type(a) is not type(b) or (a != b and not (type(a) is float and a != a and b != b)): return False
+        elif a != b:
+            return False
+    return True
+
+
+def _json_digests(*roots) -> dict:
+    """
+    为 roots 中的每个字典和列表自底向上算出摘要，返回 {id(容器): 摘要}。JSON 文本相同的子树摘要相同，
+    每个节点只处理一次，用显式栈，嵌套深度不受递归上限限制。
+    """
+    digests = {}
+    stack = [(root, False) for root in roots]
+    while stack:
+        value, ready = stack.pop()
+        if id(value) in digests: continue
+        if isinstance(value, Mapping): children = value.values()
+        elif isinstance(value, (list, tuple)): children = value
+        else: continue
+        if not ready:
+            stack.append((value, True))
+            stack.extend((child, False) for child in children)
+            continue
+        digest = hashlib.blake2b(b'{' if isinstance(value, Mapping) else b'[', digest_size=16)
+        for key, child in (value.items() if isinstance(value, Mapping) else enumerate(value)):
+            if isinstance(value, Mapping): digest.update(json.dumps(key, ensure_ascii=False).encode('utf-8') + b':')
+            part = digests.get(id(child))
+            digest.update(part if part is not None else json.dumps(child, ensure_ascii=False).encode('utf-8'))
+            digest.update(b',')
+        digests[id(value)] = digest.digest()
+    return digests
+
+
+def _dumps_json(value, indent: int = None, separators: tuple = None) -> str:
+    """
+    与 json.dumps(value, ensure_ascii=False, indent=indent, separators=separators) 的输出相同。
+    json 模块按嵌套层数递归，超过递归上限（很长的 else if 链、很深的嵌套块）时改用显式栈逐层输出。
+    """
+    try:
+        return json.dumps(value, ensure_ascii=False, indent=indent, separators=separators)
+    except RecursionError:
+        pass
+    item_separator, key_separator = separators or ((',', ': ') if indent is not None else (', ', ': '))
+    out = []
+    # 栈帧: [迭代器, 是否为字典, 层级, 是否已输出过元素]；最外层是层级为 -1 的伪容器
+    stack = [[iter((value,)), False, -1, False]]
+    while stack:
+        frame = stack[-1]
+        item = next(frame[0], ScriptBundle._END)
+        level = frame[2]
+        if item is ScriptBundle._END:
+            stack.pop()
+            if level >= 0:
+                if indent is not None: out.append('\n' + ' ' * (indent * level))
+                out.append('}' if frame[1] else ']')
+            continue
+        if level >= 0:
+            if frame[3]: out.append(item_separator)
+            if indent is not None: out.append('\n' + ' ' * (indent * (level + 1)))
+        frame[3] = True
+        if frame[1]:
+            key, item = item
+            out.append(json.dumps(key, ensure_ascii=False) + key_separator)
+        if isinstance(item, Mapping):
+            if item:
+                out.append('{')
+                stack.append([iter(item.items()), True, level + 1, False])
+            else:
+                out.append('{}')
+        elif isinstance(item, (list, tuple)):
+            if item:
+                out.append('[')
+                stack.append([iter(item), False, level + 1, False])
+            else:
+                out.append('[]')
+        else:
+            out.append(json.dumps(item, ensure_ascii=False))
+    return ''.join(out)
+
+
+class CompactParams:
+    """
+    紧凑的只读参数映射：键元组被驻留并在所有同形节点间共享，值按键顺序存成元组。
+
+    子命令块（commands/elseCommands/timerCommands/options）以节点元组存放。提供与 dict 相同的读取接口，
+    因此可以直接交给 to_v4 等只读的代码；需要普通 v1 数据时调用 to_dict() 按需展开。
+    """
+    __slots__ = ('_keys', '_values')
+    _KEY_TUPLES = {}
+    _BLOCK_KEYS = frozenset(('commands', 'elseCommands', 'timerCommands'))
+
+    def __init__(self, keys: tuple, values: tuple):
+        self._keys = keys
+        self._values = values
+
+    @classmethod
+    def from_dict(cls, params: dict):
+        return cls._from_params(params)
+
+    @classmethod
+    def _from_params(cls, params: dict):
+        keys, values = [], []
+        for key, value in params.items():
+            if key in cls._BLOCK_KEYS and isinstance(value, list):
+                value = tuple(CommandNode.from_dict(command_obj) for command_obj in value)
+            elif key == 'options' and isinstance(value, list):
+                value = tuple(OptionNode.from_dict(option) for option in value)
+            keys.append(sys.intern(key))
+            values.append(value)
+        keys = tuple(keys)
+        return cls(cls._KEY_TUPLES.setdefault(keys, keys), tuple(values))
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
         except ValueError:
-            try: return float(value_str)
-            except ValueError: return value_str
+            raise KeyError(key) from None
 
-    def to_v1_main_loop(self, lines: list, v1_data: dict):
-        """主解析循环"""
-        # (list_to_append_to, indent_level, context_name)
-        context_stack = deque()
-        for line_num, line in enumerate(lines, 1):
-            if not line.strip() or (line.strip().startswith('#') and not line.startswith('#')): continue
+    def get(self, key, default=None):
+        return self._values[self._keys.index(key)] if key in self._keys else default
 
-            indent_size = len(line) - len(line.lstrip(' '))
-            line_content = line.strip()
+    def __contains__(self, key):
+        return key in self._keys
 
-            while context_stack and indent_size <= context_stack[-1][1]:
-                context_stack.pop()
-            
-            if line_content.startswith(('>', '#')) and indent_size == 0:
-                page_id = line_content[1:].strip()
-                page_commands = []
-                v1_data["pages"][page_id] = page_commands
-                context_stack.clear()
-                context_stack.append((page_commands, -1, 'page'))
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return self._keys
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def params_dict(self) -> dict:
+        """展开为普通的参数字典（子块一并展开）。"""
+        params = {}
+        for key, value in zip(self._keys, self._values):
+            if type(value) is tuple:
+                value = [node.to_dict() for node in value]
+            params[key] = value
+        return params
+
+    def to_dict(self) -> dict:
+        return self.params_dict()
+
+    def __eq__(self, other):
+        if isinstance(other, CompactParams):
+            return type(self) is type(other) and self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class OptionNode(CompactParams):
+    """choice 选项节点。"""
+    __slots__ = ()
+
+
+class CommandNode(CompactParams):
+    """
+    命令节点：命令名是类属性（每种命令一个子类，见 of_kind），节点本身就是该命令的参数映射。
+    to_dict() 得到 v1 形式的 {cmd_name: params}。
+    """
+    __slots__ = ()
+    name = ''
+    _KINDS = {}
+
+    @classmethod
+    def of_kind(cls, name: str) -> type:
+        """返回（必要时创建）某种命令对应的节点类。"""
+        kind = cls._KINDS.get(name)
+        if kind is None:
+            class_name = ''.join(part.capitalize() for part in re.split(r'[^0-9A-Za-z]+', name)) + 'Node'
+            kind = type(class_name, (cls,), {'__slots__': (), 'name': sys.intern(name)})
+            cls._KINDS[name] = kind
+        return kind
+
+    @classmethod
+    def from_dict(cls, command_obj: dict):
+        if not command_obj: raise ValueError("空的命令对象")
+        cmd_name, params = OEOSConverter._command_parts(command_obj)
+        return cls.of_kind(cmd_name)._from_params(params)
+
+    def to_dict(self) -> dict:
+        return {self.name: self.params_dict()}
+
+    def __reduce__(self):
+        # 按命令名动态创建的子类不在模块命名空间中，序列化（如发往工作进程）时按名字重建
+        return _restore_command_node, (self.name, self._keys, self._values)
+
+
+def _restore_command_node(name: str, keys: tuple, values: tuple) -> CommandNode:
+    keys = CompactParams._KEY_TUPLES.setdefault(keys, keys)
+    return CommandNode.of_kind(name)(keys, values)
+
+
+class NodeDocument:
+    """
+    紧凑节点形式的完整脚本：pages 为 {page_id: (CommandNode, ...)}。
+
+    提供 get('pages'/'meta')，可以直接作为 to_v4 的输入；to_dict()/to_json() 按需展开为 v1 数据。
+    """
+    __slots__ = ('pages', 'meta')
+
+    def __init__(self, pages: dict = None, meta: dict = None):
+        self.pages = pages if pages is not None else {}
+        self.meta = meta
+
+    @classmethod
+    def from_v1(cls, v1_data: dict):
+        pages = {page_id: tuple(CommandNode.from_dict(c) for c in commands)
+                 for page_id, commands in v1_data.get('pages', {}).items()}
+        return cls(pages, v1_data.get('meta'))
+
+    def get(self, key: str, default=None):
+        if key == 'pages': return self.pages
+        if key == 'meta': return self.meta if self.meta is not None else default
+        return default
+
+    def page_dict(self, page_id: str) -> list:
+        """只展开单个页面。"""
+        return [node.to_dict() for node in self.pages[page_id]]
+
+    def to_dict(self) -> dict:
+        v1_data = {"pages": {page_id: [node.to_dict() for node in nodes] for page_id, nodes in self.pages.items()}}
+        if self.meta is not None: v1_data['meta'] = self.meta
+        return v1_data
+
+    def to_json(self, **kwargs) -> str:
+        kwargs.setdefault('ensure_ascii', False)
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+class PageGraph:
+    """
+    页面跳转图：page -> 出边 (target, kind)，同时维护反向边。
+
+    kind 取值见 EDGE_KINDS。目标为 $ 表达式的跳转无法静态确定，单独记录在 dynamic 中，不参与可达性与悬空目标判断。
+    """
+    EDGE_KINDS = ('goto', 'option', 'enable', 'disable', 'timer', 'notification')
+    # 会真正切换页面的边；enable/disable 只改变页面状态
+    NAVIGATION_EDGE_KINDS = ('goto', 'option', 'timer', 'notification')
+
+    def __init__(self):
+        self.outgoing = {}  # page -> [(target, kind)]，去重且保持出现顺序
+        self.incoming = {}  # target -> {(source, kind): None}
+        self.dynamic = {}   # page -> [(expr, kind)]
+
+    def __contains__(self, page_id):
+        return page_id in self.outgoing
+
+    def add_page(self, page_id: str, edges):
+        """写入（或替换）一个页面的出边。"""
+        if page_id in self.outgoing: self.remove_page(page_id)
+        static, dynamic = {}, {}
+        for target, kind in edges:
+            if not isinstance(target, str): target = str(target)
+            if target.startswith('$'): dynamic[(target, kind)] = None
+            else: static[(target, kind)] = None
+        self.outgoing[page_id] = list(static)
+        if dynamic: self.dynamic[page_id] = list(dynamic)
+        for target, kind in static:
+            self.incoming.setdefault(target, {})[(page_id, kind)] = None
+
+    def update(self, other: 'PageGraph'):
+        """按 other 中页面的顺序合并其出边（同名页面被替换）。"""
+        for page_id, edges in other.outgoing.items():
+            self.add_page(page_id, edges + other.dynamic.get(page_id, []))
+
+    def remove_page(self, page_id: str):
+        for target, kind in self.outgoing.pop(page_id, ()):
+            sources = self.incoming.get(target)
+            if sources is not None:
+                sources.pop((page_id, kind), None)
+                if not sources: del self.incoming[target]
+        self.dynamic.pop(page_id, None)
+
+    def targets(self, page_id: str, kinds=None) -> list:
+        """page_id 指向的页面（去重，保持顺序）。"""
+        return list(dict.fromkeys(t for t, k in self.outgoing.get(page_id, ()) if kinds is None or k in kinds))
+
+    def sources(self, page_id: str, kinds=None) -> list:
+        """指向 page_id 的页面（去重，保持顺序）。"""
+        return list(dict.fromkeys(s for s, k in self.incoming.get(page_id, ()) if kinds is None or k in kinds))
+
+    def dangling(self) -> list:
+        """指向不存在页面的边 [(source, target, kind)]。"""
+        return [(source, target, kind)
+                for source, edges in self.outgoing.items()
+                for target, kind in edges if target not in self.outgoing]
+
+    def distances(self, start: str = 'start', kinds=NAVIGATION_EDGE_KINDS) -> dict:
+        """从 start 出发的 BFS 跳数 {page: distance}，只包含存在的页面。"""
+        if start not in self.outgoing: return {}
+        distance = {start: 0}
+        queue = deque([start])
+        while queue:
+            page_id = queue.popleft()
+            for target, kind in self.outgoing[page_id]:
+                if target not in distance and target in self.outgoing and (kinds is None or kind in kinds):
+                    distance[target] = distance[page_id] + 1
+                    queue.append(target)
+        return distance
+
+    def unreachable(self, start: str = 'start', kinds=NAVIGATION_EDGE_KINDS) -> list:
+        """从 start 出发无法到达的页面（仅按静态跳转计算）。"""
+        reached = self.distances(start, kinds)
+        return [page_id for page_id in self.outgoing if page_id not in reached]
+
+    def to_dict(self) -> dict:
+        return {
+            'pages': {page_id: [{'target': t, 'kind': k} for t, k in edges] for page_id, edges in self.outgoing.items()},
+            'dynamic': {page_id: [{'target': t, 'kind': k} for t, k in edges] for page_id, edges in self.dynamic.items()},
+        }
+
+    def to_graph_text(self, kinds=NAVIGATION_EDGE_KINDS) -> str:
+        """序列化为扩展 Graph 条目使用的 `pageId > child1, child2;` 格式。"""
+        lines = []
+        for page_id in self.outgoing:
+            children = self.targets(page_id, kinds)
+            if children: lines.append(f"{page_id} > {', '.join(children)};")
+        return '\n'.join(lines)
+
+
+class ConversionStats:
+    """
+    转换统计：各阶段耗时、行数、页面数、按命令种类的计数、最大嵌套深度以及输入输出字节数。
+
+    attach() 在转换器实例上用计时包装替换逐行调用的内部方法，不挂接时这些方法保持原样、没有额外开销。
+    输入输出字节数由 to_v1（解析的原文）、to_v4/to_v4_stream（生成的文本、流式读入的 JSON）记录，
+    命令行另外计入读入的 JSON 和写出的 JSON 文本。
+    阶段: split（切行）、tokenize（_parse_v4_line/_parse_v4_option 词法解析）、build（挂接到命令树，不含 tokenize）、
+    close_blocks（块收尾：eval 合并、空 timer 清理）、parse（to_v1_main_loop 总计）、emit（to_v4/to_v4_stream 总计），
+    命令行还会记录 read、serialize、write。并行转换的工作进程中的耗时不计入。
+    """
+    # 实例方法 -> 阶段名
+    _TIMED_METHODS = (('_parse_v4_line', 'tokenize'), ('_parse_v4_option', 'tokenize'),
+                      ('_parse_block_line', 'build'), ('_close_blocks', 'close_blocks'),
+                      ('to_v1_main_loop', 'parse'), ('to_v4', 'emit'), ('to_v4_stream', 'emit'))
+
+    def __init__(self):
+        self.phases = {}
+        self.lines = 0
+        self.pages = 0
+        self.commands = {}
+        self.max_depth = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def attach(self, converter: OEOSConverter) -> 'ConversionStats':
+        converter.stats = self
+        for method_name, phase in self._TIMED_METHODS:
+            setattr(converter, method_name, self._timed(getattr(converter, method_name), phase))
+        return self
+
+    def detach(self, converter: OEOSConverter):
+        converter.stats = None
+        for method_name, _ in self._TIMED_METHODS:
+            converter.__dict__.pop(method_name, None)
+
+    def _timed(self, method, phase: str):
+        phases = self.phases
+        perf_counter = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                phases[phase] = phases.get(phase, 0.0) + perf_counter() - start
+        return timed
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def count_text(self, text_in: str = '', text_out: str = ''):
+        """按 UTF-8 编码累计输入、输出的字节数。"""
+        if text_in: self.bytes_in += len(text_in.encode('utf-8'))
+        if text_out: self.bytes_out += len(text_out.encode('utf-8'))
+
+    def count_lines(self, lines):
+        """
+        逐行转发并累计输入字节数。行可以带行尾换行符（文件对象），也可以不带（split('\n') 的结果，
+        此时行间的分隔符另外计入），两种情况得到的都是原文的字节数。
+        """
+        bytes_in, line = 0, None
+        try:
+            for line in lines:
+                bytes_in += len(line.encode('utf-8')) + (not line.endswith('\n'))
+                yield line
+            if line is not None and not line.endswith('\n'): bytes_in -= 1
+        finally:
+            self.bytes_in += bytes_in
+
+    def count_page(self, commands: list):
+        """统计一个页面的命令种类与嵌套深度（页面顶层为第 1 层）。"""
+        self.pages += 1
+        counts = self.commands
+        stack = [(iter(commands), 1)]
+        while stack:
+            block, depth = stack[-1]
+            command_obj = next(block, None)
+            if command_obj is None:
+                stack.pop()
                 continue
+            if depth > self.max_depth: self.max_depth = depth
+            cmd_name, params = OEOSConverter._command_parts(command_obj)
+            counts[cmd_name] = counts.get(cmd_name, 0) + 1
+            for key in ('commands', 'elseCommands', 'timerCommands'):
+                if params.get(key): stack.append((iter(params[key]), depth + 1))
+            for option in params.get('options', ()):
+                if option.get('commands'): stack.append((iter(option['commands']), depth + 1))
+
+    def to_dict(self) -> dict:
+        phases = dict(self.phases)
+        if 'build' in phases:
+            phases['build'] = max(phases['build'] - phases.get('tokenize', 0.0), 0.0)
+        return {
+            'phases': {name: round(seconds * 1e3, 3) for name, seconds in phases.items()},  # 毫秒
+            'lines': self.lines, 'pages': self.pages,
+            'commands': dict(sorted(self.commands.items(), key=lambda item: -item[1])),
+            'total_commands': sum(self.commands.values()), 'max_depth': self.max_depth,
+            'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+        }
+
+
+class PageCache:
+    """
+    页面级解析缓存：以页面原文的哈希为键保存解析出的命令树，内存中按 LRU 淘汰，可选落盘到目录。
+
+    每个条目是 (commands, edges)：命令树以及解析时记录的跳转边。
+    重复转换同一脚本时，只有内容变化过的页面需要重新解析。内存中的条目以 marshal 字节串保存，每次命中都还原出一份新的命令树，
+    调用方修改返回的页面不会影响缓存，也不会影响同一文档中内容相同的其他页面。
+    嵌套过深、marshal 无法序列化的页面不缓存；超过 json 递归上限的页面只缓存在内存中，不落盘。
+    """
+    # 解析结果的格式版本，解析规则变化时递增，使旧的磁盘缓存自动失效
+    FORMAT_VERSION = 2
+
+    def __init__(self, max_entries: int = 4096, directory: str = None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()  # 常驻服务中多个线程共用一个缓存
+        if directory: os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, page_text: str) -> str:
+        return hashlib.blake2b(page_text.encode('utf-8'), digest_size=16,
+                               person=b'oeos-page-v%d' % self.FORMAT_VERSION).hexdigest()
+
+    def get(self, key: str):
+        """返回缓存的 (commands, edges)；未命中时返回 None。"""
+        with self._lock:
+            blob = self._entries.get(key)
+            if blob is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if blob is not None: return marshal.loads(blob)
+        if self.directory:
+            try:
+                with open(self._path(key), 'r', encoding='utf-8') as f: data = json.load(f)
+                entry = (data['commands'], [tuple(edge) for edge in data['edges']])
+            except (OSError, ValueError, KeyError, TypeError, RecursionError):
+                entry = None
+            if entry is not None:
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                self._remember(key, entry)
+                # 刚从磁盘读出的对象没有别处引用，可以直接返回
+                return entry
+        with self._lock: self.misses += 1
+        return None
+
+    def put(self, key: str, commands: list, edges: list = ()):
+        entry = (commands, list(edges))
+        if not self._remember(key, entry): return
+        if self.directory:
+            try:
+                data = json.dumps({'commands': commands, 'edges': entry[1]}, ensure_ascii=False)
+            except (RecursionError, ValueError):
+                return  # 嵌套超过 json 的递归上限，读回时同样会失败，不落盘
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f: f.write(data)
+                os.replace(tmp_path, path)
+            except OSError:
+                # 磁盘缓存只是加速手段，写入失败不影响转换结果
+                with contextlib.suppress(OSError): os.unlink(tmp_path)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits,
+            'entries': len(self._entries), 'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = self.disk_hits = 0
+
+    def _remember(self, key: str, entry: tuple) -> bool:
+        try:
+            blob = marshal.dumps(entry)
+        except ValueError:
+            return False  # 嵌套超过 marshal 的深度上限
+        with self._lock:
+            self._entries[key] = blob
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
 
-            if not context_stack:
-                if line_content: raise ValueError(f"第 {line_num} 行: 在页面声明之外找到命令 '{line_content}'")
+
+class _JSONStreamReader:
+    """在文本文件上增量读取 JSON 的游标：对象逐键遍历，值用 raw_decode 解码，只缓存当前正在解码的值。"""
+    _WS = re.compile(r'[ \t\n\r]*')
+    _NUMBER_TAIL = re.compile(r'[.eE+\-0-9]*')
+
+    def __init__(self, fp, chunk_size: int = 1 << 16):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self, size: int) -> bool:
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.fp.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.bytes_read += len(data.encode('utf-8'))
+        self.buf += data
+        return True
+
+    def peek(self) -> str:
+        while True:
+            self.pos = self._WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf): return self.buf[self.pos]
+            if not self._fill(self.chunk_size): return ''
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"JSON 格式错误: 期望 '{char}'，但得到 '{found or 'EOF'}'")
+        self.pos += 1
+
+    def read_value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+                # 位于缓冲区末尾的数字可能被截断（包括停在 `1.`、`1e` 之前的情形），需要读到更多数据再确认
+                if (self.eof or isinstance(value, (dict, list, str, bool)) or value is None
+                        or not self._NUMBER_TAIL.fullmatch(self.buf, end)):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof: raise
+            if not self._fill(size):
                 continue
-            
-            parent_list, parent_indent, parent_context_name = context_stack[-1]
+            size *= 2
+
+    def iter_object(self):
+        """逐个产出对象的键；调用方必须在继续迭代前用 read_value() 或 iter_object() 消费对应的值。"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError(f"JSON 格式错误: 对象键必须是字符串，但得到 {key!r}")
+            self.expect(':')
+            yield key
+            found = self.peek()
+            self.pos += 1
+            if found == '}': return
+            if found != ',':
+                raise ValueError(f"JSON 格式错误: 期望 ',' 或 '}}'，但得到 '{found or 'EOF'}'")
+
+
+class _V4LineWriter:
+    """把若干行用换行符连接后写入文件，结果与一次性 join 全部行相同。同时累计写出的字节数。"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.started = False
+        self.bytes_written = 0
+
+    def write(self, text: str):
+        self.fp.write(text)
+        self.bytes_written += len(text.encode('utf-8'))
+
+    def write_lines(self, lines: list):
+        if not lines: return
+        if self.started: self.write('\n')
+        self.write('\n'.join(lines))
+        self.started = True
+
+
+_worker_converter = None
+
+
+def _init_worker(cache_dir: str = None):
+    global _worker_converter
+    _worker_converter = OEOSConverter(PageCache(directory=cache_dir) if cache_dir else None)
+
+
+def _to_v1_shard(shard: tuple) -> tuple:
+    text, first_line_num, with_graph, recover = shard
+    graph = PageGraph() if with_graph else None
+    diagnostics = [] if recover else None
+    parser = OEOSStreamParser(_worker_converter, graph=graph, first_line_num=first_line_num, diagnostics=diagnostics)
+    pages = parser.parse_lines(text.split('\n'))
+    return pages, parser.meta, graph, diagnostics
+
+
+def _to_v4_shard(pages: list) -> str:
+    lines = []
+    for page_id, commands in pages:
+        lines.extend(_worker_converter._page_to_v4(page_id, commands))
+    return "\n".join(lines)
+
+
+BATCH_EXTENSIONS = {'to_v1': ('.oeos', '.json'), 'to_v4': ('.json', '.oeos')}  # 方向 -> (输入扩展名, 输出扩展名)
+BATCH_MANIFEST = '.oeos-manifest.json'
+
+
+def _collect_batch_inputs(direction: str, inputs: list) -> list:
+    """把目录、通配符和文件展开为 [(输入路径, 输出相对路径)]，相对路径保留输入的目录结构。"""
+    import glob
+    in_ext, out_ext = BATCH_EXTENSIONS[direction]
+    found = {}
+    for item in inputs:
+        if os.path.isdir(item):
+            root, paths = item, glob.glob(os.path.join(glob.escape(item), '**', '*' + in_ext), recursive=True)
+        elif glob.has_magic(item):
+            # 通配符之前的目录部分作为镜像的根
+            parts = item.split(os.sep)
+            root = os.sep.join(parts[:next(i for i, part in enumerate(parts) if glob.has_magic(part))]) or '.'
+            paths = glob.glob(item, recursive=True)
+        else:
+            root, paths = os.path.dirname(item) or '.', [item]
+        for path in sorted(paths):
+            if not os.path.isfile(path): continue
+            relative = os.path.splitext(os.path.relpath(path, root))[0] + out_ext
+            found.setdefault(relative, path)
+    return [(path, relative) for relative, path in found.items()]
 
+
+def _file_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _batch_convert(job: tuple) -> tuple:
+    """转换一个文件。返回 (状态, 输入哈希, 输入字节数, 输出字节数, 错误信息)，状态为 'converted'/'skipped'/'failed'。"""
+    direction, input_path, output_path, known_digest = job
+    try:
+        with open(input_path, 'rb') as f: data = f.read()
+        digest = _file_digest(data)
+        if digest == known_digest and os.path.exists(output_path):
+            return 'skipped', digest, len(data), 0, None
+        text = data.decode('utf-8')
+        if direction == 'to_v1':
+            output = _dumps_json(_worker_converter.to_v1(text), indent=2)
+        else:
+            output = _worker_converter.to_v4(json.loads(text))
+        output = output.encode('utf-8')
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        import tempfile
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f: f.write(output)
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return 'converted', digest, len(data), len(output), None
+    except Exception as e:
+        return 'failed', None, 0, 0, str(e)
+
+
+def convert_batch(direction: str, inputs: list, output_dir: str, workers: int = None, manifest_path: str = None,
+                  force: bool = False, cache_dir: str = None, on_result=None) -> dict:
+    """
+    批量转换目录、通配符或文件列表，输出到 output_dir 下的镜像目录树。
+
+    清单（默认 output_dir/.oeos-manifest.json）记录每个输入的哈希、大小和修改时间：大小和修改时间都没变的文件直接跳过，
+    变了的文件先比较内容哈希，内容相同也跳过。本次未涉及的文件在清单中的记录保持不变，因此可以分多次转换不同的输入。
+    转换在进程池中进行，workers 为 1 时在当前进程内完成。
+    on_result(input_path, status, error) 在每个文件处理完后调用。返回汇总统计。
+    """
+    start = time.perf_counter()
+    manifest_path = manifest_path or os.path.join(output_dir, BATCH_MANIFEST)
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f: saved = json.load(f)
+        if saved.get('direction') == direction: entries = saved.get('files', {})
+    manifest = {} if force else dict(entries)
+    summary = {'converted': 0, 'skipped': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0, 'failures': []}
+    jobs = []
+    for input_path, relative in _collect_batch_inputs(direction, inputs):
+        output_path = os.path.join(output_dir, relative)
+        st = os.stat(input_path)
+        entry = manifest.get(relative)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns and os.path.exists(output_path):
+            summary['skipped'] += 1
+            if on_result: on_result(input_path, 'skipped', None)
+            continue
+        jobs.append((relative, st, (direction, input_path, output_path, entry['hash'] if entry else None)))
+
+    def record(relative, st, job, result):
+        status, digest, bytes_in, bytes_out, error = result
+        summary[status] += 1
+        summary['bytes_in'] += bytes_in
+        summary['bytes_out'] += bytes_out
+        if status == 'failed':
+            summary['failures'].append({'input': job[1], 'error': error})
+            entries.pop(relative, None)
+        else:
+            entries[relative] = {'input': job[1], 'hash': digest, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+        if on_result: on_result(job[1], status, error)
+
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(jobs) <= 1:
+        _init_worker(cache_dir)
+        for relative, st, job in jobs:
+            record(relative, st, job, _batch_convert(job))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(cache_dir,)) as executor:
+            results = executor.map(_batch_convert, [job for _, _, job in jobs], chunksize=max(1, len(jobs) // (workers * 8)))
+            for (relative, st, job), result in zip(jobs, results):
+                record(relative, st, job, result)
+
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'direction': direction, 'files': entries}, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def batch_main(argv: list):
+    parser = argparse.ArgumentParser(prog="converter.py batch", description="批量转换目录或通配符匹配的文件，跳过未变化的文件。")
+    parser.add_argument("direction", choices=['to_v1', 'to_v4'], help="转换方向: 'to_v1' (*.oeos -> *.json), 'to_v4' (*.json -> *.oeos)。")
+    parser.add_argument("inputs", nargs='+', help="输入目录、通配符（如 'scripts/**/*.oeos'）或文件。")
+    parser.add_argument("-o", "--output-dir", required=True, help="输出目录，按输入的目录结构镜像。")
+    parser.add_argument("--workers", type=int, default=0, help="进程数，0 表示 CPU 核数，1 表示不使用进程池。")
+    parser.add_argument("--manifest", help=f"增量清单路径，默认为输出目录下的 {BATCH_MANIFEST}。")
+    parser.add_argument("--force", action="store_true", help="忽略清单，全部重新转换。")
+    parser.add_argument("--cache-dir", help="to_v1 时使用的页面解析缓存目录（各进程共享）。")
+    parser.add_argument("-v", "--verbose", action="store_true", help="逐个列出处理的文件。")
+    args = parser.parse_args(argv)
+
+    def report(path, status, error):
+        if status == 'failed': print(f"失败: {path}: {error}", file=sys.stderr)
+        elif args.verbose: print(f"{'转换' if status == 'converted' else '跳过'}: {path}")
+
+    summary = convert_batch(args.direction, args.inputs, args.output_dir, args.workers or None, args.manifest,
+                            args.force, args.cache_dir, on_result=report)
+    seconds = summary['seconds']
+    print(f"完成: 转换 {summary['converted']} 个，跳过 {summary['skipped']} 个，失败 {summary['failed']} 个；"
+          f"读入 {summary['bytes_in'] / 2**20:.2f} MiB，用时 {seconds:.2f} 秒，"
+          f"吞吐 {summary['bytes_in'] / 2**20 / seconds if seconds else 0:.2f} MiB/s")
+    if summary['failed']: sys.exit(1)
+
+
+class ChatExtractor:
+    """
+    从 SillyTavern 聊天记录（JSONL，每行一条消息）中流式提取 `<game><Pages>` 与 `<summary>` 块，
+    规则与插件的 ElementDataManager.extractPagesFromChat / extractSummariesFromChat 一致：同一页面以最后出现的版本为准，
+    顺序保持首次出现的位置。
+
+    逐行读取，每次只持有一条消息；内存占用只与不同页面的数量有关，与消息条数无关。
+    """
+    PAGES_BLOCK_RE = re.compile(r'<game>\s*<Pages>(.*?)</Pages>\s*</game>', re.I | re.S)
+    SUMMARY_BLOCK_RE = re.compile(r'<summary>(.*?)</summary>', re.I | re.S)
+    PAGE_SPLIT_RE = re.compile(r'\r?\n---\r?\n')
+    # 与插件中的 JS 正则一样，\w 只匹配 ASCII
+    PAGE_HEADER_RE = re.compile(r'>\s*(\w+)\s*\r?\n(.*)', re.A | re.S)
+    SUMMARY_LINE_RE = re.compile(r'(\w+)\s*:\s*(.+?);?', re.A | re.S)
+    # 不含这两种标签的行不必做 JSON 解码；SillyTavern 写出的 JSON 不转义 `<`
+    _CANDIDATE_RE = re.compile(rb'<(?:game|summary)>', re.I)
+
+    def __init__(self):
+        self.pages = {}    # pageId -> 页面原文（含 "> pageId" 行）
+        self.summary = {}  # pageId -> 摘要
+        self.messages = 0
+        self.page_versions = 0
+        self.skipped_lines = 0
+
+    def feed_message(self, text: str):
+        for block in self.PAGES_BLOCK_RE.finditer(text):
+            for page in self.PAGE_SPLIT_RE.split(block.group(1)):
+                match = self.PAGE_HEADER_RE.fullmatch(page.strip())
+                if not match: continue
+                page_id = match.group(1)
+                self.pages[page_id] = f"> {page_id}\n{match.group(2).rstrip()}"
+                self.page_versions += 1
+        for block in self.SUMMARY_BLOCK_RE.finditer(text):
+            for line in block.group(1).strip().splitlines():
+                match = self.SUMMARY_LINE_RE.fullmatch(line.strip())
+                if match: self.summary[match.group(1)] = match.group(2).strip()
+
+    def feed_lines(self, lines):
+        """读入聊天记录的各行（bytes 或 str）。首行的会话元数据、没有 mes 字段的行以及无法解码的行会被跳过。"""
+        for line in lines:
+            self.messages += 1
+            if isinstance(line, str): line = line.encode('utf-8')
+            if not self._CANDIDATE_RE.search(line): continue
             try:
-                # Special handling for notification.create sub-blocks
-                if parent_context_name == 'notification.create':
-                    if line_content in ['commands', 'timerCommands']:
-                        # The parent_list IS the notification dict in this case
-                        new_list = []
-                        parent_list[line_content] = new_list
-                        context_stack.append((new_list, indent_size, 'commands'))
-                        continue
-                    else: # A command inside notification's commands/timerCommands list
-                        pass # Fall through to normal command parsing
-
-                # Special handling for choice blocks (only accept options)
-                if parent_context_name == 'choice':
-                    option_obj, block_info = self._parse_v4_option(line_content)
-                    parent_list.append(option_obj)
-                    if block_info.get('new_block'):
-                        context_stack.append((option_obj['commands'], indent_size, 'commands'))
-                    continue
+                message = json.loads(line)
+            except ValueError:
+                self.skipped_lines += 1
+                continue
+            text = message.get('mes') if isinstance(message, dict) else None
+            if isinstance(text, str): self.feed_message(text)
+        return self
 
-                # Handle multiline eval
-                if parent_context_name == 'eval':
-                    parent_list['action'] += line_content + '\n' # Here parent_list is the eval dict
-                    continue
+    def feed_file(self, path: str):
+        with open(path, 'rb') as f:
+            return self.feed_lines(f)
 
-                # Normal command parsing
-                command_obj, block_info = self._parse_v4_line(line_content)
-                cmd_name = list(command_obj.keys())[0]
-
-                if cmd_name == 'if':
-                    is_else = block_info.get('is_else', False)
-                    if is_else:
-                        if not parent_list or 'if' not in parent_list[-1]:
-                            raise ValueError(f"第 {line_num} 行: 'else' 或 'else if' 没有匹配的 'if'")
-
-                        # last_if_struct is the dict like {'if': {...}}
-                        last_if_struct = parent_list[-1]
-
-                        # Traverse the chain of else ifs
-                        while 'elseCommands' in last_if_struct['if']:
-                            else_cmds = last_if_struct['if']['elseCommands']
-                            if not else_cmds: # empty else, can attach here
-                                break
-
-                            # The next link in the chain must be another 'if' statement.
-                            next_if_struct = else_cmds[0]
-                            if 'if' not in next_if_struct:
-                                # This is a terminal `else` block with actions, not another `else if`.
-                                raise ValueError(f"第 {line_num} 行: 在一个最终 'else' 块之后不允许 'else'/'else if'")
-
-                            last_if_struct = next_if_struct
-
-                        # Attach the new command to the last 'if' in the chain.
-                        if not command_obj.get('if', {}).get('condition'): # This is a pure 'else'
-                             last_if_struct['if']['elseCommands'] = command_obj['if']['commands']
-                        else: # This is an 'else if'
-                             last_if_struct['if']['elseCommands'] = [command_obj]
-                    else:
-                        parent_list.append(command_obj)
-                else:
-                    parent_list.append(command_obj)
-                
-                # Push new context if a block is started
-                if block_info.get('new_block'):
-                    context_stack.append((command_obj[cmd_name]['commands'], indent_size, 'commands'))
-                elif block_info.get('new_options_block'):
-                    context_stack.append((command_obj[cmd_name]['options'], indent_size, 'choice'))
-                elif block_info.get('new_notif_block'):
-                    context_stack.append((command_obj[cmd_name], indent_size, 'notification.create'))
-                elif block_info.get('is_multiline_eval'):
-                    context_stack.append((command_obj[cmd_name], indent_size, 'eval'))
-
-            except Exception as e:
-                import traceback; traceback.print_exc()
-                raise ValueError(f"解析第 {line_num} 行时出错: '{line_content}' -> {e}")
-
-        def cleanup(obj):
-            if isinstance(obj, dict):
-                for k, v in list(obj.items()):
-                    if isinstance(v, dict):
-                        if k == 'timer' and 'commands' in v and not v['commands']:
-                            del v['commands']
-                        cleanup(v)
-                    elif isinstance(v, list):
-                        cleanup(v)
-                    elif k == 'action' and isinstance(v, str):
-                        obj[k] = v.strip()
-            elif isinstance(obj, list):
-                for item in obj:
-                    cleanup(item)
-        cleanup(v1_data)
+    def script(self) -> str:
+        """合并后的 OEOScript，页面之间以 `---` 分隔，与插件写入 World Info 的 Pages 条目格式相同。"""
+        return "\n---\n".join(self.pages.values())
+
+    def summary_text(self) -> str:
+        return "\n".join(f"{page_id}: {abstract};" for page_id, abstract in self.summary.items())
+
+    def to_v1(self, converter: OEOSConverter = None, diagnostics: list = None) -> dict:
+        """把合并后的脚本解析为 v1；提供 diagnostics 列表时跳过解析出错的页面（错误行号对应 script() 的文本）。"""
+        converter = converter or OEOSConverter()
+        return converter.to_v1_main_loop(self.script().split('\n'), {"pages": {}}, diagnostics=diagnostics)
+
+
+def extract_main(argv: list):
+    parser = argparse.ArgumentParser(prog="converter.py extract",
+                                     description="从 SillyTavern 聊天记录 (JSONL) 中提取页面和摘要，合并为一个脚本。")
+    parser.add_argument("chat_files", nargs='+', help="聊天记录文件，按给出的顺序读取，后出现的页面版本覆盖先出现的。")
+    parser.add_argument("-o", "--output", required=True, help="合并后的 OEOScript 输出路径。")
+    parser.add_argument("--json", help="同时把解析出的 v1 JSON 写入该文件。")
+    parser.add_argument("--summary", help="同时把页面摘要写入该文件（每行 `页面: 摘要;`）。")
+    parser.add_argument("--recover", action="store_true", help="--json 时跳过解析出错的页面，并列出错误位置。")
+    args = parser.parse_args(argv)
+    extractor = ChatExtractor()
+    try:
+        for path in args.chat_files: extractor.feed_file(path)
+    except OSError as e:
+        print(f"错误: 无法读取聊天记录: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"读取 {extractor.messages} 行，提取页面 {len(extractor.pages)} 个（共 {extractor.page_versions} 个版本），"
+          f"摘要 {len(extractor.summary)} 条")
+    if extractor.skipped_lines: print(f"跳过无法解码的行 {extractor.skipped_lines} 行", file=sys.stderr)
+    with open(args.output, 'w', encoding='utf-8') as f: f.write(extractor.script())
+    print(f"合并脚本已写入 '{args.output}'")
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f: f.write(extractor.summary_text())
+        print(f"页面摘要已写入 '{args.summary}'")
+    if args.json:
+        diagnostics = [] if args.recover else None
+        try:
+            v1_data = extractor.to_v1(diagnostics=diagnostics)
+        except Exception as e:
+            print(f"解析合并脚本时发生错误: {e}", file=sys.stderr)
+            sys.exit(1)
+        if diagnostics: _report_diagnostics(diagnostics)
+        with open(args.json, 'w', encoding='utf-8') as f: f.write(_dumps_json(v1_data, indent=2))
+        print(f"v1 JSON 已写入 '{args.json}'")
+
+
+def diff_main(argv: list):
+    parser = argparse.ArgumentParser(prog="converter.py diff", description="按页面比较两个脚本（.json 为 v1，其余按 OEOScript 读取），或把增量应用到脚本上。")
+    parser.add_argument("old", help="旧脚本；--apply 时为要修改的脚本。")
+    parser.add_argument("new", help="新脚本；--apply 时为增量 JSON 文件。")
+    parser.add_argument("-o", "--output", help="输出路径（增量 JSON 或应用后的脚本），不指定时只打印摘要。")
+    parser.add_argument("--apply", action="store_true", help="把增量应用到 old 上，输出与 old 同格式的脚本。")
+    parser.add_argument("--no-structural", action="store_true", help="不输出修改页面的命令级差异。")
+    args = parser.parse_args(argv)
+
+    def load(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f) if path.endswith('.json') else f.read()
+
+    converter = OEOSConverter()
+    try:
+        if args.apply:
+            with open(args.new, 'r', encoding='utf-8') as f: delta = json.load(f)
+            result = converter.apply_delta(load(args.old), delta)
+        else:
+            delta = converter.diff(load(args.old), load(args.new), not args.no_structural)
+            result = delta
+    except (OSError, ValueError) as e:
+        print(f"错误: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"新增 {len(delta.get('added', {}))} 页，删除 {len(delta.get('removed', []))} 页，"
+          f"修改 {len(delta.get('modified', {}))} 页{'，meta.init 有变化' if 'meta' in delta else ''}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            if isinstance(result, str): f.write(result)
+            else: f.write(_dumps_json(result, indent=2))
+        print(f"结果已写入 '{args.output}'")
+
+
+def assets_main(argv: list):
+    parser = argparse.ArgumentParser(prog="converter.py assets", description="列出脚本引用的图片、音频等资源，按距起始页面的跳数排序，供预取使用。")
+    parser.add_argument("input_file", help="脚本文件（.json 为 v1，其余按 OEOScript 读取）。")
+    parser.add_argument("-o", "--output", help="把资源清单以 JSON 写入该文件，不指定时打印到标准输出。")
+    parser.add_argument("--start", default='start', help="计算跳数的起始页面，默认 start。")
+    parser.add_argument("--max-distance", type=int, help="只列出该跳数以内可达页面的资源。")
+    parser.add_argument("--urls", action="store_true", help="只输出预取顺序的 URL，每行一个。")
+    args = parser.parse_args(argv)
+    try:
+        with open(args.input_file, 'r', encoding='utf-8') as f:
+            document = json.load(f) if args.input_file.endswith('.json') else f.read()
+        manifest = OEOSConverter().asset_manifest(document, args.start, args.max_distance)
+    except (OSError, ValueError) as e:
+        print(f"错误: {e}", file=sys.stderr)
+        sys.exit(1)
+    output = ("\n".join(entry['url'] for entry in manifest['prefetch']) if args.urls
+              else json.dumps(manifest, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f: f.write(output)
+        print(f"资源清单已写入 '{args.output}'（{len(manifest['prefetch'])} 个资源，{len(manifest['dynamic'])} 个动态地址）")
+    else:
+        print(output)
+
+
+def bundle_main(argv: list):
+    parser = argparse.ArgumentParser(prog="converter.py bundle", description="把脚本编译为二进制脚本包，播放器可以按页面直接解码。")
+    parser.add_argument("input_file", help="脚本文件（.json 为 v1，其余按 OEOScript 读取）。")
+    parser.add_argument("output_file", help="脚本包输出路径。")
+    parser.add_argument("--verify", action="store_true", help="编译后读回脚本包，确认与源脚本（OEOScript 时为 to_v1 的结果）无损一致。")
+    args = parser.parse_args(argv)
+    converter = OEOSConverter()
+    try:
+        with open(args.input_file, 'r', encoding='utf-8') as f:
+            v1_data = json.load(f) if args.input_file.endswith('.json') else converter.to_v1_main_loop(f, {"pages": {}})
+        bundle = converter.to_bundle(v1_data)
+        if args.verify: converter.verify_bundle(bundle, v1_data)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"错误: {e}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        with open(args.output_file, 'wb') as f: f.write(bundle)
+    except IOError as e:
+        print(f"错误: 无法写入输出文件 '{args.output_file}': {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"脚本包已写入 '{args.output_file}'：{len(v1_data.get('pages', {}))} 页，{len(bundle)} 字节"
+          f"{'，校验通过' if args.verify else ''}")
+
+
+class ConverterServer:
+    """
+    常驻转换服务：按行读取 JSON 请求（NDJSON），所有请求共用同一个预热好的转换器、页面缓存和页面跳转图，
+    省去每次启动解释器、导入模块和解析命令行的开销。
+
+    请求: {"id": 1, "method": "to_v1", "params": {"script": "..."}}
+    响应: {"id": 1, "result": ..., "time_ms": 0.42}，出错时为 {"id": 1, "error": "...", "time_ms": ...}
+
+    方法: ping、stats、to_v1 (script, graph=false, recover=false)、to_v4 (data)、
+    to_v4_compact (data, elide_eval=false, prune_from=null)、diff (old, new, structural=true)、apply_delta (document, delta)、
+    assets (document, start="start", max_distance=null)、graph.add (script 或 data)、graph.remove (page)、
+    graph.targets / graph.sources (page, kinds=null)、graph.dangling、graph.unreachable / graph.distances (start="start")、
+    graph.dump。to_v1 传 graph=true 时顺带把解析出的页面写入服务端的跳转图；传 recover=true 时跳过出错的页面，
+    结果为 {"data": v1 数据, "diagnostics": [{page, line, column, message}, ...]}。
+    """
+
+    def __init__(self, converter: OEOSConverter = None, threads: int = 4):
+        self.converter = converter or OEOSConverter(PageCache())
+        self.graph = PageGraph()
+        self.threads = threads
+        self.requests = 0
+        self._graph_lock = threading.Lock()
+
+    def handle(self, request: dict) -> dict:
+        """处理一个已解码的请求，返回响应字典。"""
+        start = time.perf_counter()
+        response = {'id': request.get('id') if isinstance(request, dict) else None}
+        try:
+            if not isinstance(request, dict): raise ValueError("请求必须是 JSON 对象")
+            method = request.get('method')
+            handler = getattr(self, '_rpc_' + method.replace('.', '_'), None) if isinstance(method, str) else None
+            if handler is None: raise ValueError(f"未知的方法: {method!r}")
+            response['result'] = handler(**(request.get('params') or {}))
+        except Exception as e:
+            response['error'] = str(e)
+        self.requests += 1
+        response['time_ms'] = round((time.perf_counter() - start) * 1e3, 3)
+        return response
+
+    def handle_line(self, line: str) -> str:
+        """处理一行 NDJSON 请求，返回一行响应（不含换行符）。"""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return json.dumps({'id': None, 'error': f"无法解析请求: {e}"}, ensure_ascii=False)
+        return _dumps_json(self.handle(request))
+
+    def serve_stdio(self, input_fp=None, output_fp=None):
+        """从 input_fp 读请求、向 output_fp 写响应，直到输入结束。请求在线程池中并发处理，响应按完成顺序写出。"""
+        input_fp = input_fp or sys.stdin
+        output_fp = output_fp or sys.stdout
+        write_lock = threading.Lock()
+
+        def respond(line):
+            response = self.handle_line(line)
+            with write_lock:
+                output_fp.write(response + '\n')
+                output_fp.flush()
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(self.threads) as executor:
+            for line in input_fp:
+                if line.strip(): executor.submit(respond, line)
+
+    def serve_unix(self, path: str):
+        """
+        在 Unix 套接字上提供服务。每个连接内按顺序应答，不同连接并发处理。
+        path 处残留的套接字文件会先删除；如果是其他类型的文件则抛出 FileExistsError，不会覆盖。
+        """
+        import socketserver
+        if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+            raise OSError("当前平台不支持 Unix 套接字，请使用标准输入输出模式")
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    line = line.decode('utf-8')
+                    if not line.strip(): continue
+                    self.wfile.write((server.handle_line(line) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+
+        try:
+            mode = os.stat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode): raise FileExistsError(f"{path} 已存在且不是套接字文件，拒绝覆盖")
+            os.unlink(path)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as unix_server:
+            unix_server.daemon_threads = True
+            try:
+                unix_server.serve_forever()
+            finally:
+                os.unlink(path)
+
+    def _rpc_ping(self):
+        return 'pong'
+
+    def _rpc_stats(self) -> dict:
+        cache = self.converter.page_cache
+        return {'requests': self.requests, 'pages': len(self.graph.outgoing),
+                'cache': cache.stats() if cache is not None else None}
+
+    def _rpc_to_v1(self, script: str, graph: bool = False, recover: bool = False) -> dict:
+        page_graph = PageGraph() if graph else None
+        diagnostics = [] if recover else None
+        v1_data = self.converter.to_v1_main_loop(script.split('\n'), {"pages": {}}, graph=page_graph, diagnostics=diagnostics)
+        if page_graph is not None:
+            with self._graph_lock: self.graph.update(page_graph)
+        if recover: return {'data': v1_data, 'diagnostics': [error.to_dict() for error in diagnostics]}
         return v1_data
 
+    def _rpc_to_v4(self, data: dict) -> str:
+        return self.converter.to_v4(data)
+
+    def _rpc_to_v4_compact(self, data: dict, elide_eval: bool = False, prune_from: str = None) -> dict:
+        report = {}
+        text = self.converter.to_v4_compact(data, elide_eval, prune_from, report)
+        return {'script': text, 'report': report}
+
+    def _rpc_assets(self, document, start: str = 'start', max_distance: int = None) -> dict:
+        return self.converter.asset_manifest(document, start, max_distance)
+
+    def _rpc_diff(self, old, new, structural: bool = True) -> dict:
+        return self.converter.diff(old, new, structural)
+
+    def _rpc_apply_delta(self, document, delta: dict):
+        return self.converter.apply_delta(document, delta)
+
+    def _rpc_graph_add(self, script: str = None, data: dict = None) -> int:
+        if script is not None:
+            page_graph = PageGraph()
+            self.converter.to_v1_main_loop(script.split('\n'), {"pages": {}}, graph=page_graph)
+        elif data is not None:
+            page_graph = self.converter.build_graph(data)
+        else:
+            raise ValueError("graph.add 需要 script 或 data 参数")
+        with self._graph_lock: self.graph.update(page_graph)
+        return len(page_graph.outgoing)
+
+    def _rpc_graph_remove(self, page: str):
+        with self._graph_lock: self.graph.remove_page(page)
+
+    def _rpc_graph_targets(self, page: str, kinds: list = None) -> list:
+        with self._graph_lock: return self.graph.targets(page, kinds)
+
+    def _rpc_graph_sources(self, page: str, kinds: list = None) -> list:
+        with self._graph_lock: return self.graph.sources(page, kinds)
+
+    def _rpc_graph_dangling(self) -> list:
+        with self._graph_lock: return [{'source': s, 'target': t, 'kind': k} for s, t, k in self.graph.dangling()]
+
+    def _rpc_graph_unreachable(self, start: str = 'start') -> list:
+        with self._graph_lock: return self.graph.unreachable(start)
+
+    def _rpc_graph_distances(self, start: str = 'start') -> dict:
+        with self._graph_lock: return self.graph.distances(start)
+
+    def _rpc_graph_dump(self) -> dict:
+        with self._graph_lock: return self.graph.to_dict()
+
+
+def serve_main(argv: list):
+    parser = argparse.ArgumentParser(prog="converter.py serve", description="常驻转换服务，按行读取 JSON 请求并返回 JSON 响应。")
+    parser.add_argument("--socket", help="监听的 Unix 套接字路径；不指定时使用标准输入输出。")
+    parser.add_argument("--threads", type=int, default=4, help="并发处理请求的线程数。")
+    parser.add_argument("--cache-size", type=int, default=4096, help="内存页面缓存的条目数上限。")
+    parser.add_argument("--cache-dir", help="页面解析缓存目录，服务重启后仍可复用。")
+    args = parser.parse_args(argv)
+    server = ConverterServer(OEOSConverter(PageCache(args.cache_size, args.cache_dir)), args.threads)
+    if args.socket:
+        print(f"转换服务已在 '{args.socket}' 上就绪", file=sys.stderr)
+        # 收到 SIGTERM 时正常退出，以便清理套接字文件
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_unix(args.socket)
+        except KeyboardInterrupt:
+            pass
+        except FileExistsError as e:
+            print(f"错误: {e}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        server.serve_stdio()
+
+
+def _report_diagnostics(diagnostics: list):
+    for error in diagnostics:
+        location = f"页面 '{error.page}'" if error.page is not None else "页面之外"
+        print(f"{location} 第 {error.line} 行第 {error.column} 列: {error.message}", file=sys.stderr)
+    failed = list(dict.fromkeys(error.page for error in diagnostics if error.page is not None))
+    if failed: print(f"{len(failed)} 个页面解析失败，已跳过: {', '.join(failed)}", file=sys.stderr)
+
+
+def _write_reports(args, stats: ConversionStats, profiler: 'cProfile.Profile'):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"性能剖析已写入 '{args.profile}'")
+    if stats is None: return
+    report = json.dumps(stats.to_dict(), indent=2, ensure_ascii=False)
+    if args.stats == '-':
+        print(report, file=sys.stderr)
+    else:
+        with open(args.stats, 'w', encoding='utf-8') as f: f.write(report)
+        print(f"统计已写入 '{args.stats}'")
+
+
+def _write_graph(graph: PageGraph, path: str):
+    graph_data = graph.to_dict()
+    graph_data['dangling'] = [{'source': s, 'target': t, 'kind': k} for s, t, k in graph.dangling()]
+    graph_data['unreachable'] = graph.unreachable()
+    with open(path, 'w', encoding='utf-8') as f: json.dump(graph_data, f, indent=2, ensure_ascii=False)
+    print(f"页面跳转图已写入 '{path}'")
+
 
 def main():
-    parser = argparse.ArgumentParser(description="OEOS v1 (JSON) 和 v4 (OEOScript) 格式转换器。")
+    if sys.argv[1:2] == ['batch']:
+        return batch_main(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        return serve_main(sys.argv[2:])
+    if sys.argv[1:2] == ['extract']:
+        return extract_main(sys.argv[2:])
+    if sys.argv[1:2] == ['diff']:
+        return diff_main(sys.argv[2:])
+    if sys.argv[1:2] == ['assets']:
+        return assets_main(sys.argv[2:])
+    if sys.argv[1:2] == ['bundle']:
+        return bundle_main(sys.argv[2:])
+    parser = argparse.ArgumentParser(description="OEOS v1 (JSON) 和 v4 (OEOScript) 格式转换器。",
+                                     epilog="批量转换: converter.py batch {to_v1,to_v4} 输入... -o 输出目录；"
+                                            "常驻服务: converter.py serve [--socket 路径]；"
+                                            "提取聊天记录: converter.py extract 聊天.jsonl -o 输出.oeos；"
+                                            "页面级差异: converter.py diff 旧 新 [-o 增量.json]；"
+                                            "资源清单: converter.py assets 脚本 [--start 页面] [--urls]；"
+                                            "二进制脚本包: converter.py bundle 脚本 输出.oeob [--verify]")
     parser.add_argument("direction", choices=['to_v1', 'to_v4'], help="转换方向: 'to_v1' (v4 -> v1), 'to_v4' (v1 -> v4)。")
     parser.add_argument("input_file", help="输入文件路径。")
     parser.add_argument("output_file", help="输出文件路径。")
+    parser.add_argument("--stream", action="store_true", help="to_v4 时逐页流式读取 JSON 并直接写出，内存占用只取决于最大的单个页面。")
+    parser.add_argument("--cache-dir", help="to_v1 时使用的页面解析缓存目录，未变化的页面直接复用上次的解析结果。")
+    parser.add_argument("--graph", help="同时把页面跳转图（出边、悬空目标、不可达页面）以 JSON 写入该文件。")
+    parser.add_argument("--workers", type=int, default=1, help="按页面分片并行转换使用的进程数（0 表示 CPU 核数），小文件自动串行。")
+    parser.add_argument("--page", action="append", help="to_v1 时只解析指定的页面（可重复），通过页面偏移索引直接定位，不解析其余部分。")
+    parser.add_argument("--recover", action="store_true", help="to_v1 时跳过解析出错的页面继续解析，并列出每个错误的页面、行和列。")
+    parser.add_argument("--compact", action="store_true", help="to_v4 时输出精简格式（省略默认参数、减少引号和空行），用于注入 LLM 上下文。")
+    parser.add_argument("--elide-eval", action="store_true", help="与 --compact 一起使用：把 eval 代码替换为占位符。")
+    parser.add_argument("--prune-unreachable", nargs='?', const='start', metavar="START",
+                        help="与 --compact 一起使用：删除从 START 页面（默认 start）出发不可达的页面。")
+    parser.add_argument("--stats", nargs='?', const='-', metavar="FILE", help="输出各阶段耗时、命令计数等统计（JSON），不指定文件时打印到标准错误。")
+    parser.add_argument("--profile", metavar="FILE", help="用 cProfile 记录本次转换并保存到该文件（可用 python -m pstats 查看）。")
     args = parser.parse_args()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
     try:
-        with open(args.input_file, 'r', encoding='utf-8') as f: content = f.read()
+        input_file = open(args.input_file, 'r', encoding='utf-8')
     except FileNotFoundError:
         print(f"错误: 输入文件未找到 '{args.input_file}'", file=sys.stderr)
         sys.exit(1)
-    converter = OEOSConverter()
+    converter = OEOSConverter(PageCache(directory=args.cache_dir) if args.cache_dir else None)
+    stats = ConversionStats().attach(converter) if args.stats else None
+    phase = stats.phase if stats is not None else lambda name: contextlib.nullcontext()
+    if args.stream and args.direction == 'to_v4':
+        graph = PageGraph() if args.graph else None
+        try:
+            with input_file, open(args.output_file, 'w', encoding='utf-8') as output_file:
+                converter.to_v4_stream(input_file, output_file, graph=graph)
+        except IOError as e:
+            print(f"错误: 无法写入输出文件 '{args.output_file}': {e}", file=sys.stderr)
+            sys.exit(1)
+        except Exception as e:
+            print(f"转换过程中发生错误: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"转换成功！结果已写入 '{args.output_file}'")
+        if graph is not None: _write_graph(graph, args.graph)
+        _write_reports(args, stats, profiler)
+        return
     try:
-        if args.direction == 'to_v1':
-            v1_data = converter.to_v1_main_loop(content.split('\n'), {"pages": {}})
-            output_content = json.dumps(v1_data, indent=2, ensure_ascii=False)
-        elif args.direction == 'to_v4':
-            v1_data = json.loads(content)
-            output_content = converter.to_v4(v1_data)
+        with input_file:
+            if args.direction == 'to_v1' and args.page:
+                graph = None
+                with converter.open_lazy(args.input_file) as script:
+                    missing = [page_id for page_id in args.page if page_id not in script]
+                    if missing: raise ValueError(f"页面不存在: {', '.join(missing)}")
+                    v1_data = {"pages": {page_id: script[page_id] for page_id in args.page}}
+                    if script.meta: v1_data['meta'] = script.meta
+                output_content = _dumps_json(v1_data, indent=2)
+                if stats is not None: stats.count_text(text_out=output_content)
+            elif args.direction == 'to_v1':
+                graph = PageGraph() if args.graph else None
+                diagnostics = [] if args.recover else None
+                if args.workers != 1:
+                    with phase('read'): v4_script = input_file.read()
+                    v1_data = converter.to_v1_parallel(v4_script, args.workers or None, graph=graph, diagnostics=diagnostics)
+                else:
+                    # 逐行流式解析，不必先把整个文件读入并切分
+                    v1_data = converter.to_v1_main_loop(input_file, {"pages": {}}, graph=graph, diagnostics=diagnostics)
+                if diagnostics: _report_diagnostics(diagnostics)
+                with phase('serialize'): output_content = _dumps_json(v1_data, indent=2)
+                if stats is not None: stats.count_text(text_out=output_content)
+            elif args.direction == 'to_v4':
+                with phase('read'):
+                    text = input_file.read()
+                    v1_data = json.loads(text)
+                if stats is not None: stats.count_text(text)
+                if args.compact:
+                    report = {}
+                    output_content = converter.to_v4_compact(v1_data, args.elide_eval, args.prune_unreachable, report)
+                    print(f"精简模式: {report['baseline_chars']} → {report['chars']} 字符 (-{report['reduction']:.1%})，"
+                          f"省略默认参数 {report['removed_params']} 个，省略 eval {report['elided_evals']} 段，"
+                          f"删除不可达页面 {len(report['pruned_pages'])} 个")
+                    if 'prune_skipped' in report: print(f"未删除页面: {report['prune_skipped']}", file=sys.stderr)
+                else:
+                    output_content = converter.to_v4_parallel(v1_data, args.workers or None) if args.workers != 1 else converter.to_v4(v1_data)
+                graph = converter.build_graph(v1_data) if args.graph else None
     except Exception as e:
         print(f"转换过程中发生错误: {e}", file=sys.stderr)
         sys.exit(1)
     try:
-        with open(args.output_file, 'w', encoding='utf-8') as f: f.write(output_content)
+        with phase('write'), open(args.output_file, 'w', encoding='utf-8') as f: f.write(output_content)
         print(f"转换成功！结果已写入 '{args.output_file}'")
+        if graph is not None: _write_graph(graph, args.graph)
+        if converter.page_cache is not None and args.direction == 'to_v1':
+            cache_stats = converter.page_cache.stats()
+            print(f"页面缓存: 命中 {cache_stats['hits']}，未命中 {cache_stats['misses']}")
     except IOError as e:
         print(f"错误: 无法写入输出文件 '{args.output_file}': {e}", file=sys.stderr)
         sys.exit(1)
+    _write_reports(args, stats, profiler)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
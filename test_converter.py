@@ -0,0 +1,567 @@
+"""
+converter.py 的回归测试。运行: python -m pytest -q test_converter.py
+"""
+import copy
+import io
+import json
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+from bench_converter import TeaseGenerator, _deep_nesting, _else_if_ladder
+from converter import (BATCH_MANIFEST, ChatExtractor, ConversionStats, ConverterServer, LazyScript, OEOSConverter, PageCache, PageGraph, _deep_equal,
+                       _dumps_json, convert_batch)
+
+
+# ---- 词法器 ----
+
+@pytest.mark.parametrize('line, expected', [
+    ('say "say \\"hi\\"" mode: "instant"', {'say': {'label': 'say "hi"', 'mode': 'instant'}}),
+    ("storage.set key: \"hp\" value: $storage.get('hp') - 10", {'storage.set': {'key': 'hp', 'value': "$storage.get('hp') - 10"}}),
+    ('storage.set key: "k" value: $f("a b", [1, (2)]) when: $a == true',
+     {'storage.set': {'key': 'k', 'value': '$f("a b", [1, (2)])', 'when': '$a == true'}}),
+    ('notification.create duration: 5s align: left', {'notification.create': {'duration': '5s', 'align': 'left'}}),
+    ('x a: null b: true c: -1.5 d: 5 e: "5"', {'x': {'a': None, 'b': True, 'c': -1.5, 'd': 5, 'e': '5'}}),
+    ('goto forest_path', {'goto': {'target': 'forest_path'}}),
+    ('image data:image/png;base64,AAAA', {'image': {'url': 'data:image/png;base64,AAAA'}}),
+    ('goto chapter:2', {'goto': {'target': 'chapter:2'}}),
+    ('image data:image/png;base64,AAAA id: "bg"', {'image': {'url': 'data:image/png;base64,AAAA', 'id': 'bg'}}),
+    ('say label: "hi" mode: "instant"', {'say': {'label': 'hi', 'mode': 'instant'}}),
+])
+def test_tokenizer_lines(line, expected):
+    assert OEOSConverter()._parse_v4_line(line)[0] == expected
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('"a -> b" -> goto x', {'label': 'a -> b', 'commands': [{'goto': {'target': 'x'}}]}),
+    ('"a -> b" when: $a == true', {'label': 'a -> b', 'commands': [], 'visible': '$a == true'}),
+    ('"say \\"hi\\""', {'label': 'say "hi"', 'commands': []}),
+])
+def test_tokenizer_options(line, expected):
+    assert OEOSConverter()._parse_v4_option(line)[0] == expected
+
+
+def test_if_conditions_are_verbatim():
+    v1_data = OEOSConverter().to_v1('> p\n  if $gift == 1 && $life > 0\n    say hi\n  else if $diff <= 2\n    say x')
+    command = v1_data['pages']['p'][0]['if']
+    assert command['condition'] == '$gift == 1 && $life > 0'
+    assert command['elseCommands'][0]['if']['condition'] == '$diff <= 2'
+
+
+def test_parser_entry_points_agree(tmp_path):
+    converter = OEOSConverter()
+    v1_data = TeaseGenerator(seed=7, pages=60, escaping=0.5).v1()
+    text = converter.to_v4(v1_data)
+    expected = converter.to_v1(text)
+    assert converter.to_v4(expected) == text
+    lines = text.split('\n')
+    assert converter.to_v1_main_loop(iter(lines), {}) == expected
+    assert {'pages': dict(converter.iter_pages(text[i:i + 37] for i in range(0, len(text), 37)))} == {'pages': expected['pages']}
+    assert LazyScript.from_text(text, converter).to_dict() == expected
+    assert converter.to_v1_nodes(lines).to_dict() == expected
+    parallel = OEOSConverter()
+    parallel.PARALLEL_MIN_CHARS = 0
+    assert parallel.to_v1_parallel(text, 2) == expected
+    cached = OEOSConverter(PageCache(directory=str(tmp_path)))
+    assert cached.to_v1(text) == expected and OEOSConverter(PageCache(directory=str(tmp_path))).to_v1(text) == expected
+    output = io.StringIO()
+    converter.to_v4_stream(io.StringIO(json.dumps(expected, ensure_ascii=False)), output, chunk_size=101)
+    assert output.getvalue() == text
+
+
+# ---- 精简输出 (to_v4_compact) ----
+
+def test_compact_round_trip():
+    converter = OEOSConverter()
+    for seed in range(5):
+        v1_data = TeaseGenerator(seed=seed, pages=40, escaping=0.5).v1()
+        text = converter.to_v4_compact(v1_data)
+        assert converter.to_v1(text) == v1_data
+
+
+def test_compact_drops_defaults_and_quotes():
+    converter = OEOSConverter()
+    v1_data = {"pages": {"start": [{"say": {"label": "hi", "mode": "auto"}},
+                                   {"say": {"label": "x", "skip": 1}},
+                                   {"image": {"url": "a/b.jpg"}},
+                                   {"image": {"url": "123"}}]}}
+    report = {}
+    text = converter.to_v4_compact(v1_data, report=report)
+    assert text == '> start\n  say hi\n  say x skip: 1\n  image a/b.jpg\n  image "123"'
+    assert report['removed_params'] == 1 and report['chars'] < report['baseline_chars']
+    assert converter.to_v1(text) == {"pages": {"start": [{"say": {"label": "hi"}}, {"say": {"label": "x", "skip": 1}},
+                                                         {"image": {"url": "a/b.jpg"}}, {"image": {"url": "123"}}]}}
+
+
+def test_compact_elide_and_prune():
+    converter = OEOSConverter()
+    v1_data = {"pages": {"start": [{"eval": {"action": "x = 1;"}}, {"goto": {"target": "a"}}],
+                         "a": [{"end": {}}], "orphan": [{"end": {}}]}}
+    report = {}
+    text = converter.to_v4_compact(v1_data, elide_eval=True, prune_from='start', report=report, verify=True)
+    assert report['pruned_pages'] == ['orphan'] and report['elided_evals'] == 1
+    assert list(converter.to_v1(text)['pages']) == ['start', 'a']
+    dynamic = {"pages": {"start": [{"goto": {"target": "$next"}}], "orphan": [{"end": {}}]}}
+    report = {}
+    converter.to_v4_compact(dynamic, prune_from='start', report=report)
+    assert report['pruned_pages'] == [] and 'prune_skipped' in report
+
+
+# ---- 命令树表示 ----
+
+def test_dict_subclasses_are_v1():
+    converter = OEOSConverter()
+    text = '> start\n  say "hi"\n  if $x\n    goto a\n> a\n  image "a.jpg"'
+    v1_data = converter.to_v1(text)
+    ordered = json.loads(json.dumps(v1_data), object_pairs_hook=OrderedDict)
+    assert converter.to_v4(ordered) == converter.to_v4(v1_data)
+    assert converter.build_graph(ordered).targets('start') == ['a']
+    assert converter.asset_manifest(ordered)['prefetch'][0]['url'] == 'a.jpg'
+    assert converter.diff(ordered, v1_data)['modified'] == {}
+    nodes = converter.to_v1_nodes(text.split('\n'))
+    assert converter.to_v4(nodes) == converter.to_v4(v1_data)
+
+
+# ---- 二进制脚本包 ----
+
+def test_bundle_round_trip():
+    converter = OEOSConverter()
+    v1_data = TeaseGenerator(seed=3, pages=30, escaping=0.5).v1()
+    v1_data['pages']['start'].append({'x': {'a': 1.5, 'b': -7, 'c': None, 'd': False, 'e': 2 ** 70, 'g': [], 'h': {}}})
+    bundle = converter.to_bundle(v1_data)
+    converter.verify_bundle(bundle, v1_data)
+    ordered = json.loads(json.dumps(v1_data), object_pairs_hook=OrderedDict)
+    assert converter.to_bundle(ordered) == bundle
+
+
+# ---- 恢复模式 ----
+
+PAGES = ''.join(f'> p{i}\n  say "{i}"\n' for i in range(50))
+UNCLOSED_META = '---\ninit: |\n  x()\n' + PAGES
+
+
+def test_recover_unclosed_meta():
+    converter = OEOSConverter()
+    diagnostics = []
+    v1_data = converter.to_v1(UNCLOSED_META, diagnostics=diagnostics)
+    assert len(v1_data['pages']) == 50 and v1_data['meta'] == {'init': 'x()'}
+    assert [(e.line, e.page) for e in diagnostics] == [(1, None)]
+    with pytest.raises(ValueError):
+        converter.to_v1(UNCLOSED_META)
+
+
+def test_recover_parallel_matches_serial():
+    converter = OEOSConverter()
+    converter.PARALLEL_MIN_CHARS = 0
+    bad_page = '> bad\n  say "unterminated\n'
+    for script in (UNCLOSED_META, UNCLOSED_META + bad_page, '---\ninit: |\n  x()\n---\n' + bad_page + PAGES):
+        serial, parallel = [], []
+        assert converter.to_v1_parallel(script, 2, diagnostics=parallel) == converter.to_v1(script, diagnostics=serial)
+        assert [e.to_dict() for e in parallel] == [e.to_dict() for e in serial]
+
+
+def test_recover_with_cache_matches_plain(tmp_path):
+    fragments = ['> p{i}\n', '  say "{i}"\n', '  say "bad{i}\n', '---\n', '  goto p{i}\n', '    say "x"\n',
+                 '  if $a > {i}\n', '  else\n', '# note\n', 'stray{i}\n']
+    rng = random.Random(5)
+    for _ in range(200):
+        script = '> start\n' + ''.join(rng.choice(fragments).format(i=i) for i in range(rng.randint(1, 25)))
+        plain, cached = [], []
+        expected = OEOSConverter().to_v1(script, diagnostics=plain)
+        assert OEOSConverter(PageCache()).to_v1(script, diagnostics=cached) == expected
+        assert [e.to_dict() for e in cached] == [e.to_dict() for e in plain]
+
+@pytest.mark.parametrize('line, column', [
+    ('  say "abc', 7),
+    ('  say "ok" mode: "x', 18),
+    ('    "a -> b" -> jump x', 14),
+])
+def test_diagnostic_column_points_at_token(line, column):
+    script = '> p\n  choice\n' + line if line.startswith('    ') else '> p\n' + line
+    diagnostics = []
+    OEOSConverter().to_v1(script, diagnostics=diagnostics)
+    assert [(e.line, e.column) for e in diagnostics] == [(script.count('\n') + 1, column)]
+
+
+# ---- 流式 to_v4 ----
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 10, 14, 15, 28, 30, 1 << 16])
+def test_stream_numbers_across_chunks(chunk_size):
+    converter = OEOSConverter()
+    document = {"pages": {"a": [{"audio.play": {"url": "x", "volume": 0.25, "loops": -1e3}}]}, "x": 1.5e10}
+    output = io.StringIO()
+    converter.to_v4_stream(io.StringIO(json.dumps(document)), output, chunk_size=chunk_size)
+    assert output.getvalue() == converter.to_v4(document)
+
+
+def test_stream_stats():
+    converter = OEOSConverter()
+    stats = ConversionStats().attach(converter)
+    document = TeaseGenerator(seed=1, pages=20).v1()
+    converter.to_v4_stream(io.StringIO(json.dumps(document)), io.StringIO())
+    report = stats.to_dict()
+    assert report['pages'] == 20 and 'emit' in report['phases'] and report['commands']['say'] > 0
+
+
+
+def test_stats_byte_counts(tmp_path):
+    converter = OEOSConverter()
+    stats = ConversionStats().attach(converter)
+    text = converter.to_v4(TeaseGenerator(seed=2, pages=15, escaping=0.5).v1()) + '\n'
+    size = len(text.encode('utf-8'))
+    assert stats.bytes_out == size - 1
+    for parse, expected in ((converter.to_v1, size), (lambda t: converter.to_v1_main_loop(io.StringIO(t), {}), size),
+                            (lambda t: converter.to_v1_main_loop(io.StringIO(t.rstrip('\n')), {}), size - 1)):
+        stats.bytes_in = 0
+        parse(text)
+        assert stats.bytes_in == expected
+    document = json.dumps(converter.to_v1(text), ensure_ascii=False)
+    stats.bytes_in = stats.bytes_out = 0
+    output = io.StringIO()
+    converter.to_v4_stream(io.StringIO(document), output, chunk_size=100)
+    assert (stats.bytes_in, stats.bytes_out) == (len(document.encode('utf-8')), len(output.getvalue().encode('utf-8')))
+    source, target, report = tmp_path / 'in.oeos', tmp_path / 'out.json', tmp_path / 'stats.json'
+    source.write_text(text, encoding='utf-8')
+    subprocess.run([sys.executable, 'converter.py', 'to_v1', str(source), str(target), '--stats', str(report)],
+                   check=True, capture_output=True, cwd=__file__.rsplit('/', 1)[0] or '.')
+    counts = json.loads(report.read_text(encoding='utf-8'))
+    assert (counts['bytes_in'], counts['bytes_out']) == (source.stat().st_size, target.stat().st_size)
+
+
+# ---- 页面缓存 ----
+
+def test_cache_hits_are_independent_copies(tmp_path):
+    for directory in (None, str(tmp_path)):
+        converter = OEOSConverter(PageCache(directory=directory))
+        script = '> left\n  say "x"\n> right\n  say "x"'
+        result = converter.to_v1(script)
+        assert result['pages']['left'] is not result['pages']['right']
+        result['pages']['left'].append({'end': {}})
+        assert converter.to_v1(script) == {'pages': {'left': [{'say': {'label': 'x'}}], 'right': [{'say': {'label': 'x'}}]}}
+
+
+
+@pytest.mark.parametrize('size', [450, 3000])
+def test_disk_cache_skips_deep_pages(tmp_path, size):
+    text = '\n'.join(_else_if_ladder(size))
+    expected = OEOSConverter().to_v1(text)
+    for _ in range(2):
+        assert _deep_equal(OEOSConverter(PageCache(directory=str(tmp_path))).to_v1(text), expected)
+    assert not [name for name in tmp_path.iterdir() if name.suffix == '.tmp']
+    cache = PageCache(directory=str(tmp_path))
+    key = cache.key('deep')
+    (tmp_path / f'{key}.json').write_text('{"commands": ' + '[' * 5000 + ']' * 5000 + ', "edges": []}')
+    assert cache.get(key) is None
+
+# ---- 页面跳转图 ----
+
+GRAPH_SCRIPT = """> start
+  goto a
+  choice
+    "去 b" -> goto b
+    "去 c"
+      goto c
+  timer duration: 5
+    goto t
+  notification.create label: "n"
+    commands
+      goto n
+    timerCommands
+      goto n2
+  enable target: "hidden"
+  disable target: "ghost"
+  goto $next
+  if $x
+    goto a
+> a
+  goto start
+> b
+  goto missing
+> c
+> t
+> n
+> n2
+  goto deep
+> deep
+> hidden
+> island
+  goto start"""
+
+
+def test_graph_edge_kinds_and_distances():
+    converter = OEOSConverter()
+    graph = PageGraph()
+    converter.to_v1_main_loop(GRAPH_SCRIPT.split('\n'), {}, graph=graph)
+    assert graph.to_dict() == converter.build_graph(converter.to_v1(GRAPH_SCRIPT)).to_dict()
+    assert graph.outgoing['start'] == [('a', 'goto'), ('b', 'option'), ('c', 'option'), ('t', 'timer'), ('n', 'notification'),
+                                       ('n2', 'notification'), ('hidden', 'enable'), ('ghost', 'disable')]
+    assert graph.dynamic == {'start': [('$next', 'goto')]}
+    assert graph.targets('start', ('option',)) == ['b', 'c'] and graph.sources('start') == ['a', 'island']
+    assert graph.dangling() == [('start', 'ghost', 'disable'), ('b', 'missing', 'goto')]
+    assert graph.distances() == {'start': 0, 'a': 1, 'b': 1, 'c': 1, 't': 1, 'n': 1, 'n2': 1, 'deep': 2}
+    assert graph.unreachable() == ['hidden', 'island']
+    assert graph.unreachable(kinds=None) == ['island'] and graph.distances(kinds=None)['hidden'] == 1
+    assert graph.distances('nowhere') == {}
+    graph.add_page('a', [('deep', 'goto')])
+    assert graph.sources('start') == ['island'] and graph.sources('deep') == ['n2', 'a']
+    graph.remove_page('n2')
+    assert graph.distances()['deep'] == 2 and ('n2', 'notification') in graph.outgoing['start']
+    assert ('start', 'n2', 'notification') in graph.dangling()
+
+
+# ---- 页面级差异 ----
+
+def _apply_ops(items: list, ops: list, options: bool = False) -> list:
+    """按 diff_commands 文档的约定，从后往前应用差异。"""
+    items = list(items)
+    for op in reversed(ops):
+        at = op['at']
+        if op['op'] == 'delete':
+            del items[at:at + op['count']]
+        elif op['op'] == 'insert':
+            items[at:at] = op['commands']
+        elif op['op'] == 'replace':
+            items[at:at + op['count']] = op['commands']
+        else:
+            item = copy.copy(items[at]) if options else {name: dict(params) for name, params in items[at].items()}
+            params = item if options else next(iter(item.values()))
+            for key in op['unset']: del params[key]
+            params.update(op['set'])
+            for key, block_ops in op['blocks'].items():
+                params[key] = _apply_ops(params[key], block_ops, key == 'options')
+            items[at] = item
+    return items
+
+
+def _mutate(commands: list, rng: random.Random):
+    """在命令树中随机挑一个块做一次修改：改参数、插入、删除或替换命令、改选项。"""
+    blocks = [commands]
+    for block in blocks:
+        for command in block:
+            for params in command.values():
+                for key in ('commands', 'elseCommands', 'timerCommands'):
+                    if isinstance(params.get(key), list): blocks.append(params[key])
+                for option in params.get('options', ()):
+                    blocks.append(option['commands'])
+                    if rng.random() < 0.2: option['label'] += '!'
+    block = rng.choice(blocks)
+    choice = rng.randrange(4)
+    # if/choice/eval 的参数在 OEOScript 中是固定的，多出的参数经过文本往返会丢失
+    plain = [command for command in block if not {'if', 'choice', 'eval'} & set(command)]
+    if choice == 0 and plain:
+        next(iter(rng.choice(plain).values()))['x'] = rng.randrange(10)
+    elif choice == 1:
+        block.insert(rng.randint(0, len(block)), {'say': {'label': f'新 {rng.random()}'}})
+    elif choice == 2 and block:
+        del block[rng.randrange(len(block))]
+    elif block:
+        block[rng.randrange(len(block))] = {'goto': {'target': 'start'}}
+
+
+def test_structural_diff_round_trip():
+    converter = OEOSConverter()
+    rng = random.Random(11)
+    for seed in range(8):
+        old = TeaseGenerator(seed=seed, pages=25, escaping=0.3).v1()
+        new = copy.deepcopy(old)
+        page_ids = list(new['pages'])
+        for page_id in rng.sample(page_ids, 8):
+            for _ in range(rng.randint(1, 4)): _mutate(new['pages'][page_id], rng)
+        del new['pages'][page_ids[0]]
+        new['pages']['added'] = [{'end': {}}]
+        delta = converter.diff(old, new)
+        assert delta['removed'] == [page_ids[0]] and delta['added'] == {'added': [{'end': {}}]}
+        for page_id, ops in delta['changes'].items():
+            assert _apply_ops(old['pages'][page_id], ops) == new['pages'][page_id]
+        assert converter.apply_delta(old, delta) == new
+        old_text, new_text = converter.to_v4(old), converter.to_v4(new)
+        text_delta = converter.diff(old_text, new_text)
+        assert set(text_delta['modified']) == set(delta['modified'])
+        patched = converter.apply_delta(old_text, text_delta)
+        assert converter.to_v1(patched) == converter.to_v1(new_text)
+        assert converter.apply_delta(old, converter.diff(old, old)) == old
+
+
+# ---- 资源清单 ----
+
+ASSET_SCRIPT = """> start
+  image "a.jpg"
+  say "<img src='s1.png'>"
+  choice
+    "<img src='o1.png'>" -> goto left
+    "<img src='o2.png'>"
+      audio.play "o2.mp3"
+  if $x
+    image "cond.jpg"
+    image "both.jpg"
+  image both.jpg
+  image $f()
+> orphan
+  image "orphan.jpg"
+> far
+  image "far.jpg"
+  image "a.jpg"
+> left
+  image "left.jpg"
+  goto far"""
+
+
+def test_asset_manifest_contents_and_order():
+    converter = OEOSConverter()
+    manifest = converter.asset_manifest(ASSET_SCRIPT)
+    assert manifest == converter.asset_manifest(converter.to_v1(ASSET_SCRIPT))
+    assert [(e['url'], e['kind'], e['conditional']) for e in manifest['pages']['start']] == [
+        ('a.jpg', 'image', False), ('s1.png', 'image', False), ('o1.png', 'image', False), ('o2.png', 'image', False),
+        ('o2.mp3', 'audio', True), ('cond.jpg', 'image', True), ('both.jpg', 'image', False)]
+    assert [e['url'] for e in manifest['pages']['far']] == ['far.jpg', 'a.jpg']
+    assert [(e['url'], e['page'], e['distance']) for e in manifest['prefetch'][7:]] == [
+        ('left.jpg', 'left', 1), ('far.jpg', 'far', 2), ('orphan.jpg', 'orphan', None)]
+    assert manifest['dynamic'] == [{'page': 'start', 'kind': 'image', 'expression': '$f()'}]
+    nearby = converter.asset_manifest(ASSET_SCRIPT, max_distance=1)['prefetch']
+    assert [e['url'] for e in nearby][-2:] == ['both.jpg', 'left.jpg']
+
+
+# ---- 聊天记录提取 ----
+
+def _chat_line(text: str) -> str:
+    return json.dumps({'name': 'AI', 'is_user': False, 'mes': text}, ensure_ascii=False)
+
+
+def test_extract_block_embedded_in_text():
+    message = ('好的，故事开始了。\n<game>\n<Pages>\n> start\n  say "你好"\n  goto forest\n---\n> forest\n  say "森林"\n'
+               '</Pages>\n</game>\n<summary>\nstart: 开场;\nforest: 森林;\n</summary>\n请选择。')
+    extractor = ChatExtractor().feed_lines([json.dumps({'user_name': 'u'}), _chat_line(message)])
+    assert list(extractor.pages) == ['start', 'forest']
+    assert extractor.pages['forest'] == '> forest\n  say "森林"'
+    assert extractor.summary == {'start': '开场', 'forest': '森林'}
+    assert extractor.to_v1()['pages']['start'] == [{'say': {'label': '你好'}}, {'goto': {'target': 'forest'}}]
+
+
+def test_extract_last_version_wins():
+    extractor = ChatExtractor().feed_lines([
+        _chat_line('<game><Pages>> a\n  say "a1"\n---\n> b\n  say "b1"</Pages></game>'),
+        _chat_line('<game><Pages>> c\n  say "c1"</Pages></game> 又一段 <game><Pages>> a\n  say "a2"</Pages></game>'),
+        _chat_line('<summary>a: 旧;</summary><summary>a: 新;</summary>'),
+    ])
+    assert list(extractor.pages) == ['a', 'b', 'c'] and extractor.page_versions == 4
+    assert extractor.pages['a'] == '> a\n  say "a2"' and extractor.summary == {'a': '新'}
+    assert extractor.script() == '> a\n  say "a2"\n---\n> b\n  say "b1"\n---\n> c\n  say "c1"'
+
+
+def test_extract_skips_malformed_blocks():
+    extractor = ChatExtractor().feed_lines([
+        _chat_line('<game><Pages>> a\n  say "未闭合"'),
+        _chat_line('<game><Pages>没有页面头\n---\n> ok\n  say "x"</Pages></game>'),
+        '{"mes": "<game><Pages>> broken',
+        json.dumps({'mes': None, 'extra': '<game>'}),
+        _chat_line('<summary>不是摘要行\nok: 有效;</summary>'),
+    ])
+    assert list(extractor.pages) == ['ok'] and extractor.summary == {'ok': '有效'}
+    assert extractor.messages == 5 and extractor.skipped_lines == 1
+
+
+def test_extract_cli(tmp_path):
+    chat = tmp_path / 'chat.jsonl'
+    chat.write_text('\n'.join([json.dumps({'user_name': 'u'}),
+                               _chat_line('<game><Pages>> start\n  say "开始"\n---\n> bad\n  say "未闭合</Pages></game>'),
+                               _chat_line('<summary>start: 开场;</summary>')]) + '\n', encoding='utf-8')
+    script, v1_json, summary = tmp_path / 'out.oeos', tmp_path / 'out.json', tmp_path / 'summary.txt'
+    command = [sys.executable, 'converter.py', 'extract', str(chat), '-o', str(script), '--json', str(v1_json), '--summary', str(summary)]
+    cwd = __file__.rsplit('/', 1)[0] or '.'
+    result = subprocess.run(command, capture_output=True, text=True, cwd=cwd)
+    assert result.returncode == 1 and '解析合并脚本时发生错误' in result.stderr
+    assert script.read_text(encoding='utf-8').startswith('> start\n  say "开始"\n---\n> bad')
+    assert summary.read_text(encoding='utf-8') == 'start: 开场;'
+    result = subprocess.run(command + ['--recover'], capture_output=True, text=True, cwd=cwd)
+    assert result.returncode == 0 and "页面 'bad'" in result.stderr
+    assert json.loads(v1_json.read_text(encoding='utf-8')) == {'pages': {'start': [{'say': {'label': '开始'}}]}}
+
+
+# ---- 批量转换 ----
+
+def test_batch_manifest_keeps_other_inputs(tmp_path):
+    source, output = tmp_path / 'src', tmp_path / 'out'
+    source.mkdir()
+    for name in ('a', 'b'):
+        (source / f'{name}.oeos').write_text(f'> start\n  say "{name}"', encoding='utf-8')
+    first = convert_batch('to_v1', [str(source / 'a.oeos')], str(output), workers=1)
+    second = convert_batch('to_v1', [str(source / 'b.oeos')], str(output), workers=1)
+    assert first['converted'] == second['converted'] == 1
+    manifest = json.loads((output / BATCH_MANIFEST).read_text(encoding='utf-8'))
+    assert sorted(manifest['files']) == ['a.json', 'b.json']
+    assert convert_batch('to_v1', [str(source)], str(output), workers=1)['skipped'] == 2
+
+
+# ---- 常驻服务 ----
+
+def test_serve_unix_keeps_regular_files(tmp_path):
+    path = tmp_path / 'not-a-socket'
+    path.write_text('data')
+    with pytest.raises(FileExistsError):
+        ConverterServer().serve_unix(str(path))
+    assert path.read_text() == 'data'
+
+
+def test_serve_unix_replaces_stale_socket(tmp_path):
+    path = str(tmp_path / 's.sock')
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+    threading.Thread(target=ConverterServer().serve_unix, args=(path,), daemon=True).start()
+    for _ in range(100):
+        try:
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(path)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            client.close()
+            time.sleep(0.05)
+    with client, client.makefile('rwb') as stream:
+        stream.write(b'{"id": 1, "method": "ping"}\n')
+        stream.flush()
+        assert json.loads(stream.readline())['result'] == 'pong'
+
+
+# ---- 深层脚本 ----
+
+@pytest.mark.parametrize('indent, separators', [(None, None), (2, None), (None, (',', ':')), (3, (',', ' = '))])
+def test_dumps_json_fallback_matches_json(monkeypatch, indent, separators):
+    value = {"a": [1, 2.5, None, True, "中\"文"], "b": {}, "c": [], "d": {"e": [{"f": []}, []]}, "": [[{}]]}
+    expected = json.dumps(value, ensure_ascii=False, indent=indent, separators=separators)
+    original = json.dumps
+
+    def shallow(obj, **kwargs):
+        if isinstance(obj, (dict, list)) and obj: raise RecursionError
+        return original(obj, **kwargs)
+
+    monkeypatch.setattr(json, 'dumps', shallow)
+    assert _dumps_json(value, indent=indent, separators=separators) == expected
+
+
+@pytest.mark.parametrize('generate', [_else_if_ladder, _deep_nesting])
+def test_deep_scripts_through_cli(tmp_path, generate):
+    source, target = tmp_path / 'deep.oeos', tmp_path / 'deep.json'
+    text = '\n'.join(generate(3000))
+    source.write_text(text, encoding='utf-8')
+    result = subprocess.run([sys.executable, 'converter.py', 'to_v1', str(source), str(target)],
+                            capture_output=True, text=True, cwd=__file__.rsplit('/', 1)[0] or '.')
+    assert result.returncode == 0, result.stderr
+    output = target.read_text(encoding='utf-8')
+    assert output.startswith('{\n  "pages": {\n    "start": [\n') and output.count('"say"') + output.count('"eval"') > 0
+    converter = OEOSConverter()
+    changed = converter.diff(text, text.replace('"0"', '"zero"').replace('done()', 'other()'))
+    assert list(changed['modified']) == ['start']
+
+
+def test_deep_nesting_limit_in_to_v4():
+    # to_v4 按嵌套层递归，深度受递归上限限制（见 to_v4 的说明）；else if 链不受影响
+    converter = OEOSConverter()
+    assert converter.to_v4(converter.to_v1('\n'.join(_else_if_ladder(3000)))).count('else if') == 2999
+    with pytest.raises(RecursionError):
+        converter.to_v4(converter.to_v1('\n'.join(_deep_nesting(3000))))